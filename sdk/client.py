@@ -2,16 +2,38 @@
 
 from __future__ import absolute_import
 
+import collections
 import logging
+import threading
+import time
 import uuid
+from concurrent import futures
 
-from pyVmomi import vim, vmodl
+from six.moves import queue
+
+from .tools.lazy import vim, vmodl
 
 from .session import VcenterSession
-from .tools import vm, vmops, utils, task_utils
+from .tools import vm, vmops, utils, reconfig_queue, slot_allocator, template_cache, template_replica
+from .tools import placement, folder_index, backing_index, orphan_scan, soap_metrics
+from .tools import pchm, task_watcher
+from .tools import tracing
 
 
 LOG = logging.getLogger(__name__)
+# Max concurrent power tasks waited by the batch power operations
+DEFAULT_POWER_WORKERS = 16
+# Bulk teardown concurrency caps
+DEFAULT_DESTROY_WORKERS = 32
+DEFAULT_DESTROY_PER_HOST = 4
+DEFAULT_DESTROY_PER_DATASTORE = 8
+
+
+def _bind(fn):
+    """ fn run on a pool thread, attributed to the caller's operation and span """
+    return tracing.bind(soap_metrics.bind(fn))
+
+
 # python3 default encoding: utf-8
 # reload(sys)
 # sys.setdefaultencoding('utf-8')
@@ -25,6 +47,51 @@ class VMwareClient(object):
         vc_session = VcenterSession(vcenter_info)
         self.session = vc_session
         self.content = vc_session.si.content
+        self.slot_allocators = slot_allocator.SlotAllocatorRegistry(vc_session.si)
+        # merges concurrent reconfigure requests of one vm into one task
+        self.reconfig_queue = reconfig_queue.ReconfigQueue(slot_allocators=self.slot_allocators)
+        self.template_cache = template_cache.TemplateCache(vc_session.si)
+        # full clones onto a registered datastore use the template replica there
+        self.template_replicas = template_replica.TemplateReplicaManager(vc_session.si,
+                                                                         self.template_cache)
+        # serializes creating the linked clone base snapshot
+        self._snapshot_lock = threading.Lock()
+        self._placement = None
+        self._placement_lock = threading.Lock()
+        # path -> folder index, loaded on first use
+        self.folder_index = folder_index.FolderIndex(vc_session.si)
+        # backing -> vm/device index, filled by load_backing_index
+        self.backing_index = backing_index.BackingIndex()
+        # per operation SOAP call accounting, see enable_soap_metrics
+        self.soap_metrics = None
+        # runs the bookkeeping of submitted tasks when they end
+        self.task_watcher = task_watcher.TaskWatcher(vc_session.si)
+
+    def enable_soap_metrics(self, metrics=None):
+        """ record every SOAP round trip of the session, attributed to the
+        VMwareClient method that issued it. Only this client is instrumented,
+        callers using the session directly (e.g. sync_utils.get_vc_properties)
+        open their own scope: with client.soap_metrics.operation(name): ...
+        @ return: soap_metrics.SoapMetrics, see soap_metrics_snapshot
+        """
+        if self.soap_metrics is None:
+            self.soap_metrics = metrics or soap_metrics.SoapMetrics()
+            soap_metrics.instrument_stub(self.session.si._stub, self.soap_metrics)
+            soap_metrics.instrument_object(self, self.soap_metrics,
+                                           exclude=('enable_soap_metrics', 'soap_metrics_snapshot'))
+        return self.soap_metrics
+
+    def soap_metrics_snapshot(self, reset=False):
+        """ {'buckets_ms', 'operations': {operation: {'runs', 'round_trips',
+             'property_reads', 'round_trips_per_run', 'bytes_sent', 'bytes_received',
+             'duration', 'calls'}}}, None unless enable_soap_metrics was called
+        """
+        if self.soap_metrics is None:
+            return None
+        snapshot = self.soap_metrics.snapshot()
+        if reset:
+            self.soap_metrics.reset()
+        return snapshot
 
     def get_datastore_capacity_free(self, name=None, uuid=None, moid=None):
         ds_details = None
@@ -62,28 +129,38 @@ class VMwareClient(object):
     def get_dest_folder(self, datacenter_name, vmfolder_name=None):
         """ get vm/template view folder moref
         """
-        # get datacenter_obj
-        datacenter_obj = utils.get_datacenter_moref(self.content, name=datacenter_name)
-        if not datacenter_obj:
+        # get vm dest folder obj, the deepest existing folder of vmfolder_name
+        destfolder = self.folder_index.get_vm_folder(datacenter_name, vmfolder_name, nearest=True)
+        if destfolder is None:
             raise Exception("Not found datacenter!")
-
-        # get vm dest folder obj
-        destfolder = None
-        # destfolder = utils.filter_vmfolder_obj(self.content, vmfolder_name)
-        if vmfolder_name:
-            destfolder = utils.get_folder_obj(datacenter_obj.vmFolder, vmfolder_name.split('/'))
-        if not destfolder:
-            destfolder = datacenter_obj.vmFolder
         return destfolder
 
+    @tracing.traced('VMwareClient.clone_vm')
     def clone_vm(self, template_name, vm_name, datacenter_name, cluster_name,
                  esxi_name, res_pool_name, datastore_cluster, datastore_name,
                  vmfolder_name, num_cpu, num_core, memoryMB, poweron,
-                 vm_disk, vm_net, dnslist, domain, hostname,  vm_uuid, is_template=False):
+                 vm_disk, vm_net, dnslist, domain, hostname,  vm_uuid, is_template=False,
+                 clone_mode=vmops.CLONE_MODE_FULL, anti_affinity=None):
         """
         Clone a VM from a template/VM, datacenter_name, datastore_name, vm_folder
         cluster_name, resource_pool, and poweron are all optional.
+        Without esxi_name or datastore_name the placement engine picks them,
+        anti_affinity: placement group whose members go to different hosts
+        clone_mode:
+        - full: copy the template disks
+        - linked: child disks on top of a template snapshot, created if missing
+        - instant: fork the running source VM, cpu/memory/disks are inherited
+          (num_cpu/num_core/memoryMB other than the source's are rejected),
+          the network settings and vm_uuid are passed via guestinfo. vCenter
+          assigns the BIOS uuid: without vm_uuid the returned uuid is None, the
+          clone's uuid is in get_build_task_state once the task finished
         """
+        if clone_mode not in vmops.CLONE_MODES:
+            raise Exception("Unsupported clone mode: %s" % clone_mode)
+        vm_disk = vm_disk or []
+        span = tracing.current_span()
+        span.set_attributes(vm=vm_name, template=template_name, clone_mode=clone_mode)
+        span.phase('lookup')
         # get template_obj
         template_obj = utils.get_vm_moref(self.content, name=template_name, uuid=None)
         if not template_obj:
@@ -91,57 +168,176 @@ class VMwareClient(object):
 
         destfolder = self.get_dest_folder(datacenter_name, vmfolder_name)
 
-        # get vm dest datastore obj
-        datastore_moref = utils.get_datastore_moref(self.content, name=datastore_name)
-        if not datastore_moref:
-            raise Exception("Not found datastore!")
-
-        # get cluster_obj if none git the first one
-        cluster_obj = utils.get_cluster_moref(self.content, name=cluster_name)
-        if not cluster_obj:
-            raise Exception("Not found cluster!")
-
-        # get esxi host obj
-        esxi_moref = None
-        for host_mo in cluster_obj.host:
-            if host_mo.name == esxi_name:
-                esxi_moref = host_mo
-
-        # get res_pool moref
-        if res_pool_name:
-            res_pool_moref = utils.get_res_pool_moref(self.content, res_pool_name)
-        else:
-            res_pool_moref = cluster_obj.resourcePool
-
-        # Get vm teplate system type
-        sys_type = utils.get_system_type(template_obj.config)
-        # Extended network pg_moref attribute
-        vm_net = utils.extended_network_moref(self.content, vm_net)
-        # Extended datastore ds_moref attribute
-        vm_disk = utils.extended_datastore_moref(self.content, vm_disk)
-        if not vm_uuid:
-            vm_uuid = str(uuid.uuid1())
-        # Verify vm hostname
-        hostname = vmops.sanitize_hostname(vm_name, hostname)
-
-        # make clone spec
-        vmclonespec = vmops.VmCloneSpec(template_obj, sys_type, vm_uuid,
-                                        vm_net, vm_disk,
-                                        num_cpu, num_core, memoryMB,
-                                        res_pool_moref, esxi_moref, datastore_moref,
-                                        poweron, hostname, domain, dnslist, is_template)
-
-        LOG.debug("cloning VM [%s]..." % vm_name)
+        vm_placement = None
+        # a template replica resolve() handed out, released when the clone ends
+        held_replica = None
+        if not esxi_name or not datastore_name:
+            span.phase('placement')
+            request = {'num_cpu': num_cpu, 'memory_mb': memoryMB,
+                       'disk_gb': sum(int(d.get('disk_size') or 0) for d in vm_disk if d),
+                       'cluster': cluster_name, 'anti_affinity': anti_affinity}
+            engine = self.get_placement_engine()
+            if esxi_name:
+                request['host_moid'] = engine.find_moid('host', esxi_name)
+                if not request['host_moid']:
+                    raise Exception("Not found host!")
+            if datastore_name:
+                request['datastore_moid'] = engine.find_moid('datastore', datastore_name)
+                if not request['datastore_moid']:
+                    raise Exception("Not found datastore!")
+            vm_placement = engine.place(request)
+            LOG.debug("placed VM [%s] on %s/%s" % (vm_name, vm_placement['host_name'],
+                                                   vm_placement['datastore_name']))
+            esxi_name = vm_placement['host_name']
+            datastore_name = vm_placement['datastore_name']
+            cluster_name = cluster_name or vm_placement['cluster_name']
+            span.phase('lookup')
         try:
-            task = template_obj.Clone(name=vm_name, folder=destfolder, spec=vmclonespec.clone_spec)
-        except vmodl.MethodFault as error:
-            LOG.exception("Caught vmodl fault : " + error.msg)
-
-        ret_data = {"task_key": task.info.key, "name": vm_name, "uuid": vm_uuid,
-                    "numCPUs": num_cpu, "numCores": num_core,
-                    "memoryMB": memoryMB}
-        return ret_data
+            span.set_attributes(host=esxi_name, datastore=datastore_name, cluster=cluster_name)
+            # get vm dest datastore obj
+            if vm_placement and vm_placement['datastore_moref']:
+                datastore_moref = vm_placement['datastore_moref']
+            else:
+                datastore_moref = utils.get_datastore_moref(self.content, name=datastore_name)
+            if not datastore_moref:
+                raise Exception("Not found datastore!")
+
+            # get cluster_obj if none git the first one
+            cluster_obj = utils.get_cluster_moref(self.content, name=cluster_name)
+            if not cluster_obj:
+                raise Exception("Not found cluster!")
+
+            # get esxi host obj
+            esxi_moref = None
+            if vm_placement and vm_placement['host_moref']:
+                esxi_moref = vm_placement['host_moref']
+            else:
+                for host_mo in cluster_obj.host:
+                    if host_mo.name == esxi_name:
+                        esxi_moref = host_mo
 
+            # get res_pool moref
+            if res_pool_name:
+                res_pool_moref = utils.get_res_pool_moref(self.content, res_pool_name)
+            else:
+                res_pool_moref = cluster_obj.resourcePool
+
+            span.phase('template')
+            if clone_mode == vmops.CLONE_MODE_FULL:
+                source_obj = self.template_replicas.resolve(template_obj, datastore_moref)
+                if source_obj is not template_obj:
+                    template_obj = held_replica = source_obj
+
+            # Get vm teplate system type and devices
+            template_info = self.template_cache.get(template_obj)
+            sys_type = template_info.sys_type
+            span.phase('spec')
+            # Extended network pg_moref attribute
+            vm_net = utils.extended_network_moref(self.content, vm_net)
+            # Extended datastore ds_moref attribute
+            vm_disk = utils.extended_datastore_moref(self.content, vm_disk)
+            if not vm_uuid and clone_mode != vmops.CLONE_MODE_INSTANT:
+                vm_uuid = str(uuid.uuid1())
+            # Verify vm hostname
+            hostname = vmops.sanitize_hostname(vm_name, hostname)
+
+            if clone_mode == vmops.CLONE_MODE_INSTANT:
+                inherited = {'numCPUs': template_info.num_cpu, 'numCores': template_info.num_cores,
+                             'memoryMB': template_info.memory_mb}
+                for (key, requested) in (('numCPUs', num_cpu), ('numCores', num_core),
+                                         ('memoryMB', memoryMB)):
+                    if requested and inherited[key] and int(requested) != inherited[key]:
+                        raise Exception("Instant clone inherits %s %s of the source vm, "
+                                        "can not set %s !" % (key, inherited[key], requested))
+                vmclonespec = vmops.VmInstantCloneSpec(vm_name, template_obj, vm_uuid, vm_net, vm_disk,
+                                                       res_pool_moref, datastore_moref, destfolder,
+                                                       hostname, domain, dnslist,
+                                                       template_info=template_info)
+                LOG.debug("instant cloning VM [%s]..." % vm_name)
+                span.phase('submit')
+                try:
+                    task = template_obj.InstantClone_Task(spec=vmclonespec.clone_spec)
+                except vmodl.MethodFault as error:
+                    LOG.exception("Caught vmodl fault : " + error.msg)
+                    raise
+                self._watch_clone(task, vm_placement, held_replica)
+                vm_placement = held_replica = None
+                task_key = task.info.key
+                span.set_attribute('task', task_key)
+                tracing.record_task(task_key)
+                # what the clone gets, not what was asked for
+                return {"task_key": task_key, "name": vm_name, "uuid": vm_uuid or None,
+                        "numCPUs": inherited['numCPUs'], "numCores": inherited['numCores'],
+                        "memoryMB": inherited['memoryMB']}
+
+            snapshot = None
+            if clone_mode == vmops.CLONE_MODE_LINKED:
+                with self._snapshot_lock:
+                    snapshot = vmops.get_linked_clone_snapshot(template_obj)
+
+            # make clone spec
+            vmclonespec = vmops.VmCloneSpec(template_obj, sys_type, vm_uuid,
+                                            vm_net, vm_disk,
+                                            num_cpu, num_core, memoryMB,
+                                            res_pool_moref, esxi_moref, datastore_moref,
+                                            poweron, hostname, domain, dnslist, is_template,
+                                            template_info=template_info,
+                                            clone_mode=clone_mode, snapshot=snapshot)
+            if held_replica is not None:
+                # the clone is not a replica itself
+                template_replica.clear_stamps(vmclonespec.clone_spec.config)
+
+            LOG.debug("cloning VM [%s]..." % vm_name)
+            span.phase('submit')
+            try:
+                task = template_obj.Clone(name=vm_name, folder=destfolder, spec=vmclonespec.clone_spec)
+            except vmodl.MethodFault as error:
+                LOG.exception("Caught vmodl fault : " + error.msg)
+                raise
+            self._watch_clone(task, vm_placement, held_replica)
+            vm_placement = held_replica = None
+
+            task_key = task.info.key
+            span.set_attribute('task', task_key)
+            tracing.record_task(task_key)
+            ret_data = {"task_key": task_key, "name": vm_name, "uuid": vm_uuid,
+                        "numCPUs": num_cpu, "numCores": num_core,
+                        "memoryMB": memoryMB}
+            return ret_data
+        except Exception:
+            if vm_placement:
+                self._placement.release(vm_placement)
+            if held_replica is not None:
+                self.template_replicas.release(held_replica)
+            raise
+
+    def _watch_clone(self, task, vm_placement, held_replica):
+        """ when the clone task ends, release the template replica it cloned
+        from and, if it failed, its placement
+        """
+        if not vm_placement and held_replica is None:
+            return
+        engine = self._placement
+
+        def clone_done(state, error):
+            if held_replica is not None:
+                self.template_replicas.release(held_replica)
+            if vm_placement and state == 'error':
+                engine.release(vm_placement)
+        self.task_watcher.watch(task, clone_done)
+
+    def get_placement_engine(self, max_age=placement.DEFAULT_MAX_AGE):
+        """ placement engine over cached host/datastore capacity,
+        re-collected when older than max_age seconds
+        """
+        with self._placement_lock:
+            if self._placement is None:
+                self._placement = placement.PlacementEngine.collect(self.session.si)
+            elif self._placement.age() > max_age:
+                self._placement.refresh()
+            return self._placement
+
+    @tracing.traced('VMwareClient.poweroff_destroy_vm')
     def poweroff_destroy_vm(self, name=None, uuid=None):
         """ delete vm
         """
@@ -163,6 +359,7 @@ class VMwareClient(object):
             ret_status = -1
         return ret_status
 
+    @tracing.traced('VMwareClient.destroy_vm')
     def destroy_vm(self, name=None, uuid=None):
         """ delete vm
         """
@@ -178,6 +375,7 @@ class VMwareClient(object):
             ret_status = -1
         return ret_status
 
+    @tracing.traced('VMwareClient.poweron_vm')
     def poweron_vm(self, name=None, uuid=None):
         """ power on vm
         """
@@ -196,6 +394,7 @@ class VMwareClient(object):
         except Exception as ex:
             return -1
 
+    @tracing.traced('VMwareClient.poweroff_vm')
     def poweroff_vm(self, name=None, uuid=None):
         """ power off vm
         """
@@ -214,6 +413,7 @@ class VMwareClient(object):
         except Exception as ex:
             return -1
 
+    @tracing.traced('VMwareClient.reboot_vm')
     def reboot_vm(self, name=None, uuid=None):
         """
         reboot vm
@@ -233,6 +433,276 @@ class VMwareClient(object):
             ret_status = -1
         return ret_status
 
+    def _find_vms_by_datacenter(self, names=None, uuids=None, moids=None, path_set=None):
+        """ bulk lookup vms, grouped by datacenter
+        @ return: ([(dc_moref, [vm])], [not found result])
+        """
+        dc_vms = []
+        found = []
+        dc_objs = utils.get_objs(self.content, self.content.rootFolder, [vim.Datacenter])
+        for dc_moref in dc_objs:
+            vms = utils.find_vms(self.session.si, names=names, uuids=uuids, moids=moids,
+                                 path_set=path_set, container=dc_moref)
+            if vms:
+                dc_vms.append((dc_moref, vms))
+                found += vms
+        not_found = [{"name": n, "state": "notfound", "error": "Vm not found by name: %s" % n}
+                     for n in set(names or []) - set(v['name'] for v in found)]
+        not_found += [{"uuid": u, "state": "notfound", "error": "Vm not found by uuid: %s" % u}
+                      for u in set(uuids or []) - set(v.get('summary.config.uuid') for v in found)]
+        not_found += [{"moid": m, "state": "notfound", "error": "Vm not found by moid: %s" % m}
+                      for m in set(moids or []) - set(v['moid'] for v in found)]
+        return (dc_vms, not_found)
+
+    @staticmethod
+    def _vm_result(vm, state, error=None):
+        return {"name": vm.get('name'), "moid": vm['moid'],
+                "uuid": vm.get('summary.config.uuid'), "state": state, "error": error}
+
+    def _wait_vm_task(self, vm, task):
+        """ wait a vm task, return the per vm result
+        """
+        if task is None:
+            return self._vm_result(vm, "success")
+        (ret_status, ret_str) = utils.wait_for_task(task)
+        if ret_status == 0:
+            return self._vm_result(vm, "success")
+        try:
+            error = task.info.error.msg
+        except Exception:
+            error = "Task failed"
+        return self._vm_result(vm, "error", error)
+
+    def _run_vm_task(self, vm, method):
+        try:
+            task = method()
+        except vmodl.MethodFault as error:
+            LOG.exception("Caught vmodl fault : " + error.msg)
+            return self._vm_result(vm, "error", error.msg)
+        return self._wait_vm_task(vm, task)
+
+    def poweron_vms(self, names=None, uuids=None, moids=None,
+                    max_workers=DEFAULT_POWER_WORKERS):
+        """ power on vms, one PowerOnMultiVM_Task per datacenter
+        @ return: [{'name', 'moid', 'uuid', 'state': success|error|skipped|notfound, 'error'}]
+        """
+        (dc_vms, results) = self._find_vms_by_datacenter(names, uuids, moids,
+                                                         path_set=['runtime.powerState'])
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            jobs = []
+            for (dc_moref, vms) in dc_vms:
+                todo = {}
+                for vm in vms:
+                    if vm.get('runtime.powerState') == 'poweredOn':
+                        results.append(self._vm_result(vm, "skipped"))
+                    else:
+                        todo[vm['moid']] = vm
+                if not todo:
+                    continue
+                LOG.debug("powering on %d vms in %s" % (len(todo), dc_moref._moId))
+                try:
+                    task = dc_moref.PowerOnMultiVM_Task(vm=[v['obj'] for v in todo.values()])
+                except vmodl.MethodFault as error:
+                    LOG.exception("Caught vmodl fault : " + error.msg)
+                    results += [self._vm_result(v, "error", error.msg) for v in todo.values()]
+                    continue
+                (ret_status, multi_result) = utils.wait_for_task(task)
+                if ret_status != 0 or multi_result is None:
+                    results += [self._vm_result(v, "error", "PowerOnMultiVM_Task failed")
+                                for v in todo.values()]
+                    continue
+                for info in multi_result.attempted:
+                    vm = todo.pop(info.vm._moId, None)
+                    if vm:
+                        jobs.append(executor.submit(_bind(self._wait_vm_task), vm, info.task))
+                for info in multi_result.notAttempted:
+                    vm = todo.pop(info.vm._moId, None)
+                    if vm:
+                        results.append(self._vm_result(vm, "error", info.fault.msg))
+                # e.g. left as a recommendation by a manual DRS cluster
+                results += [self._vm_result(v, "error", "Power on not attempted")
+                            for v in todo.values()]
+            for job in futures.as_completed(jobs):
+                results.append(job.result())
+        return results
+
+    def poweroff_vms(self, names=None, uuids=None, moids=None,
+                     max_workers=DEFAULT_POWER_WORKERS):
+        """ power off vms, at most max_workers tasks at a time
+        @ return: [{'name', 'moid', 'uuid', 'state': success|error|skipped|notfound, 'error'}]
+        """
+        (dc_vms, results) = self._find_vms_by_datacenter(names, uuids, moids,
+                                                         path_set=['runtime.powerState'])
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            jobs = []
+            for (dc_moref, vms) in dc_vms:
+                for vm in vms:
+                    if vm.get('runtime.powerState') == 'poweredOff':
+                        results.append(self._vm_result(vm, "skipped"))
+                    else:
+                        jobs.append(executor.submit(_bind(self._run_vm_task), vm, vm['obj'].PowerOff))
+            for job in futures.as_completed(jobs):
+                results.append(job.result())
+        return results
+
+    def _reboot_vm(self, vm):
+        if vm.get('guest.toolsRunningStatus') == 'guestToolsRunning':
+            try:
+                # RebootGuest does not return a task
+                vm['obj'].RebootGuest()
+                return self._vm_result(vm, "success")
+            except vmodl.MethodFault as error:
+                LOG.warning("Caught fault : %s, reset vm %s" % (error.msg, vm['name']))
+        # forceably reset, needed if vmware tools isn't running
+        return self._run_vm_task(vm, vm['obj'].ResetVM_Task)
+
+    def reboot_vms(self, names=None, uuids=None, moids=None,
+                   max_workers=DEFAULT_POWER_WORKERS):
+        """ reboot vms, at most max_workers at a time
+        @ return: [{'name', 'moid', 'uuid', 'state': success|error|notfound, 'error'}]
+        """
+        (dc_vms, results) = self._find_vms_by_datacenter(names, uuids, moids,
+                                                         path_set=['runtime.powerState',
+                                                                   'guest.toolsRunningStatus'])
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            jobs = []
+            for (dc_moref, vms) in dc_vms:
+                for vm in vms:
+                    if vm.get('runtime.powerState') != 'poweredOn':
+                        results.append(self._vm_result(vm, "error", "Vm is not powered on"))
+                    else:
+                        jobs.append(executor.submit(_bind(self._reboot_vm), vm))
+            for job in futures.as_completed(jobs):
+                results.append(job.result())
+        return results
+
+    def _destroy_vm(self, vm, poweroff):
+        """ power off (if needed) and destroy one vm
+        """
+        if vm.get('runtime.powerState') == 'poweredOn':
+            if not poweroff:
+                return self._vm_result(vm, "error", "Vm is powered on")
+            result = self._run_vm_task(vm, vm['obj'].PowerOff)
+            if result['state'] != "success":
+                return result
+        return self._run_vm_task(vm, vm['obj'].Destroy_Task)
+
+    def _dispatch_destroys(self, vms, poweroff, max_workers, max_per_host,
+                           max_per_datastore, results):
+        """ submit a vm only once its host and datastores are below their caps,
+        so a vm waiting for a busy host does not hold up the vms behind it.
+        Results go to the results queue, followed by None.
+        """
+        def cap(key):
+            return max_per_host if key[0] == 'host' else max_per_datastore
+
+        in_flight = collections.Counter()
+        pending = list(vms)
+        jobs = {}
+        try:
+            with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                while pending or jobs:
+                    waiting = []
+                    for (i, vm) in enumerate(pending):
+                        if len(jobs) >= max_workers:
+                            waiting += pending[i:]
+                            break
+                        keys = vm['_limit_keys']
+                        if all(in_flight[k] < cap(k) for k in keys):
+                            in_flight.update(keys)
+                            jobs[executor.submit(_bind(self._destroy_vm), vm, poweroff)] = (vm, keys)
+                        else:
+                            waiting.append(vm)
+                    pending = waiting
+                    if not jobs:
+                        # nothing in flight and nothing could be submitted
+                        for vm in pending:
+                            results.put(self._vm_result(vm, "error", "Vm exceeds the destroy caps"))
+                        break
+                    (done, _) = futures.wait(list(jobs), return_when=futures.FIRST_COMPLETED)
+                    for job in done:
+                        (vm, keys) = jobs.pop(job)
+                        in_flight.subtract(keys)
+                        try:
+                            results.put(job.result())
+                        except Exception as ex:
+                            LOG.exception(ex)
+                            results.put(self._vm_result(vm, "error", str(ex)))
+        finally:
+            results.put(None)
+
+    def destroy_vms(self, names=None, uuids=None, moids=None, poweroff=True,
+                    max_workers=DEFAULT_DESTROY_WORKERS,
+                    max_per_host=DEFAULT_DESTROY_PER_HOST,
+                    max_per_datastore=DEFAULT_DESTROY_PER_DATASTORE,
+                    include_templates=False):
+        """ bulk delete vms, return an iterator of per vm results as they finish
+        All vms are resolved with one property collection, then each vm is
+        powered off and destroyed, with at most max_per_host vms of one host and
+        max_per_datastore vms of one datastore in flight. The teardown starts
+        before this returns and goes on whether or not the results are read.
+        A name or uuid matching several vms is an error, none of them is
+        destroyed. Templates are skipped unless include_templates.
+        @ return: iterator of {'name', 'moid', 'uuid', 'state': success|error|notfound, 'error'}
+        """
+        if min(max_workers, max_per_host, max_per_datastore) < 1:
+            raise Exception("max_workers, max_per_host and max_per_datastore must be at least 1 !")
+        found = utils.find_vms(self.session.si, names=names, uuids=uuids, moids=moids,
+                               path_set=['runtime.powerState', 'runtime.host', 'datastore',
+                                         'config.template'])
+        candidates = [v for v in found if include_templates or not v.get('config.template')]
+        templates = [v for v in found if v not in candidates]
+        (vms, not_found) = self._select_destroy_vms(candidates, templates, names, uuids, moids)
+
+        for vm in vms:
+            host = vm.get('runtime.host')
+            keys = set([('ds', ds._moId) for ds in vm.get('datastore', [])])
+            if host is not None:
+                keys.add(('host', host._moId))
+            vm['_limit_keys'] = keys
+
+        results = queue.Queue()
+        dispatcher = threading.Thread(target=_bind(self._dispatch_destroys),
+                                      args=(vms, poweroff, max_workers, max_per_host,
+                                            max_per_datastore, results))
+        dispatcher.daemon = True
+        dispatcher.start()
+        return self._iter_destroy_results(not_found, results)
+
+    def _select_destroy_vms(self, candidates, templates, names, uuids, moids):
+        """ the vms each name/uuid/moid picks, and the results of those that
+        pick none or more than one
+        """
+        selected = {}
+        failed = []
+        for (key, field, values) in (('moid', 'moid', moids), ('name', 'name', names),
+                                     ('uuid', 'summary.config.uuid', uuids)):
+            for value in set(values or []):
+                matches = [v for v in candidates if v.get(field) == value]
+                if len(matches) == 1:
+                    selected[matches[0]['moid']] = matches[0]
+                elif matches:
+                    failed.append({key: value, "state": "error",
+                                   "error": "Vm %s %s is ambiguous, it matches %s"
+                                            % (key, value, ', '.join(sorted(v['moid'] for v in matches)))})
+                elif any(v.get(field) == value for v in templates):
+                    failed.append({key: value, "state": "error",
+                                   "error": "Vm %s %s is a template" % (key, value)})
+                else:
+                    failed.append({key: value, "state": "notfound",
+                                   "error": "Vm not found by %s: %s" % (key, value)})
+        return (list(selected.values()), failed)
+
+    def _iter_destroy_results(self, not_found, results):
+        for result in not_found:
+            yield result
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            yield result
+
+    @tracing.traced('VMwareClient.get_task_result_by_key')
     def get_task_result_by_key(self, task_key):
         """ get task info
         """
@@ -267,9 +737,14 @@ class VMwareClient(object):
                 task_result["error"] = task_mo.info.error.msg
         return task_result
 
+    @tracing.traced('VMwareClient.get_build_task_state')
     def get_build_task_state(self, task_key):
-        """ get task info
+        """ get task info, with a successful clone also the state of its
+        guest customization (vmops.get_customization_state)
         """
+        span = tracing.current_span()
+        span.set_attribute('task', task_key)
+        tracing.link_task(task_key)
         task_result = {}
         try:
             recent_tasks = self.content.taskManager.recentTask
@@ -277,10 +752,25 @@ class VMwareClient(object):
                 if task_key != task_mo.info.key:
                     continue
                 task_state = task_mo.info.state
+                span.set_attribute('state', task_state)
                 task_result["state"] = task_state
                 task_result["progress"] = task_mo.info.progress
                 if task_state == 'success':
-                    task_result["vm"] = vm.vm_info_json(task_mo.info.entity)
+                    # a clone task's entity is its source, the result is the new vm
+                    new_vm = task_mo.info.result
+                    if not isinstance(new_vm, vim.VirtualMachine):
+                        new_vm = None
+                    with tracing.span('vm_info_json'):
+                        task_result["vm"] = vm.vm_info_json(new_vm or task_mo.info.entity)
+                    if new_vm is not None:
+                        # instant clones get their uuid from vCenter
+                        task_result["uuid"] = task_result["vm"].get("uuid")
+                    if new_vm is not None:
+                        try:
+                            task_result["customization"] = vmops.get_customization_state(
+                                self.content, new_vm)
+                        except Exception as ex:
+                            LOG.warning("get customization state failed: %s" % ex)
                     task_result["progress"] = 100
                 if task_mo.info.error:
                     task_result["error"] = task_mo.info.error.msg
@@ -305,24 +795,134 @@ class VMwareClient(object):
                 if task_state == 'success':
                     vm_obj = task_mo.info.entity
                     if vdev_node and vm_obj:
-                        task_result["disk"] = vm.get_vm_disk_device_info(vm_obj.config.hardware.device,
-                                                                         vdev_node)
+                        devices = vm_obj.config.hardware.device
+                        task_result["disk"] = vm.get_vm_disk_device_info(devices, vdev_node)
+                        if self.backing_index.has_vm(vm_obj._moId):
+                            self.backing_index.update_vm_devices(vm_obj._moId, devices)
                     task_result["progress"] = 99
                 if task_mo.info.error:
                     task_result["error"] = task_mo.info.error.msg
                     task_result["progress"] = 99
+                    if task_mo.info.entity:
+                        self.backing_index.remove_vm(task_mo.info.entity._moId)
                 break
         except Exception as error:
             task_result = {"progress": 99, "error": str(error)}
             LOG.exception("Caught fault : " + error)
         return task_result
 
+    def _reserve_disk_slots(self, vm_moref, disks):
+        """ reserve a scsi slot for every disk, disks without vdev_node get the next free one
+        """
+        slots = self.slot_allocators.get(vm_moref)
+        reserved = []
+        try:
+            for disk in disks:
+                if disk.get('vdev_node'):
+                    slot = slots.reserve(*slot_allocator.parse_vdev_node(disk['vdev_node']))
+                else:
+                    slot = slots.reserve()
+                    disk['vdev_node'] = slot_allocator.format_vdev_node(slot)
+                reserved.append(slot)
+        except Exception:
+            for slot in reserved:
+                slots.release(slot)
+            raise
+        return (slots, reserved)
+
+    def _submit_disk_reconfig(self, vm_moref, disks, make_config_spec):
+        """ reserve slots for disks, build (make_config_spec(slots)) and submit
+        the attach config spec. The slots are committed when the task succeeds
+        and given back when it fails.
+        """
+        (slots, reserved) = self._reserve_disk_slots(vm_moref, disks)
+        moid = vm_moref._moId
+        try:
+            config_spec = make_config_spec(slots)
+            task_moref = self.reconfig_queue.submit(vm_moref, config_spec)
+        except Exception:
+            self.slot_allocators.release(moid, reserved)
+            raise
+
+        def attach_done(state, error):
+            if state == 'success':
+                self.slot_allocators.commit(moid, reserved)
+            else:
+                self.slot_allocators.release(moid, reserved)
+        self.task_watcher.watch(task_moref, attach_done)
+        return task_moref
+
+    def _submit_disk_removal(self, vm_moref, slots, config_spec):
+        """ submit a detach config spec, the slots of the removed disks are
+        freed when the task succeeds
+        """
+        moid = vm_moref._moId
+        removed = [dc.device for dc in config_spec.deviceChange
+                   if dc.operation == 'remove' and isinstance(dc.device, vim.vm.device.VirtualDisk)]
+        task_moref = self.reconfig_queue.submit(vm_moref, config_spec)
+
+        def detach_done(state, error):
+            if state != 'success':
+                # whatever was removed, the next get re-reads the devices
+                self.slot_allocators.invalidate(moid)
+                return
+            freed = []
+            for dev in removed:
+                bus = slots.bus_number(dev.controllerKey)
+                if bus is not None:
+                    freed.append((bus, dev.unitNumber))
+            self.slot_allocators.release(moid, freed)
+            if removed:
+                self.backing_index.remove_disks(moid, [dev.key for dev in removed])
+        self.task_watcher.watch(task_moref, detach_done)
+        return task_moref
+
+    def _refresh_backing_index(self, vm_moref, slots):
+        """ re-read the indexed disks of vm_moref when they are older than
+        slots.change_version, so the detach spec can be built from the index
+        """
+        moid = vm_moref._moId
+        if not self.backing_index.has_vm(moid) or slots.change_version is None:
+            return
+        if self.backing_index.change_version(moid) == slots.change_version:
+            return
+        props = pchm.get_object_properties(self.session.si, vm_moref,
+                                           ['config.changeVersion', 'config.hardware.device'])
+        self.backing_index.update_vm_devices(moid, props.get('config.hardware.device'),
+                                             props.get('config.changeVersion'))
+
+    def load_backing_index(self, vms=None):
+        """ (re)build the backing index
+        vms: parsed vms of the sync (e.g. SyncScheduler.inventory()['vm']),
+             collected from vCenter when None
+        """
+        if vms is None:
+            return self.backing_index.collect(self.session.si)
+        return self.backing_index.load(vms)
+
+    def orphaned_disks_report(self, datastore_names=None, keep_files=False,
+                              min_age=orphan_scan.DEFAULT_MIN_AGE):
+        """ reclaimable space of vmdk files no vm uses
+        @ return: {'total_files', 'total_bytes', 'datastores': {name: {'files', 'bytes'}},
+                   'errors', 'files' when keep_files}
+        """
+        scanner = orphan_scan.OrphanScanner(self.session.si, self.backing_index, min_age=min_age)
+        return scanner.report(datastore_names, keep_files)
+
+    def find_disk_owners(self, disk_path=None, disk_uuid=None, content_id=None):
+        """ vms a vmdk is attached to, from the backing index
+        @ return: [{'vm_moid', 'key', 'controller_key', 'unit_number', 'uuid',
+                    'file_name', 'contentid', 'ds_moid', 'is_raw'}]
+        """
+        return self.backing_index.owners(uuid=disk_uuid, file_name=disk_path,
+                                         content_id=content_id)
+
     def vm_extra_config(self, vm_moid, options):
         """ add or update vm extra configure
         """
         vm_moref = utils.get_vm_moref(self.content, moid=vm_moid)
         config_spec = vmops.create_extra_config_spec(options)
-        task_moref = task_utils.reconfig_vm_task(vm_moref, config_spec)
+        task_moref = self.reconfig_queue.submit(vm_moref, config_spec)
         return task_moref.info.key
 
     def attach_vmdk_sharing_disk(self, vm_moid, disk):
@@ -331,8 +931,9 @@ class VMwareClient(object):
         """
         vm_moref = utils.get_vm_moref(self.content, moid=vm_moid)
         ds_moref = utils.get_datastore_moref(self.content, moid=disk['ds_moid'])
-        config_spec = vmops.vm_add_vmdk_disk(vm_moref, ds_moref, disk, sharing=True)
-        task_moref = task_utils.reconfig_vm_task(vm_moref, config_spec)
+        task_moref = self._submit_disk_reconfig(
+            vm_moref, [disk],
+            lambda slots: vmops.vm_add_vmdk_disk(vm_moref, ds_moref, disk, sharing=True, slots=slots))
         return task_moref.info.key
 
     def dettach_disk(self, vm_moid, disk_file_path):
@@ -340,8 +941,11 @@ class VMwareClient(object):
         disk_file_path: '[DS5020_1] test_004/test_004_2.vmdk'
         """
         vm_moref = utils.get_vm_moref(self.content, moid=vm_moid)
-        config_spec = vmops.vm_remove_vmdk_disk(vm_moref, disk_file_path)
-        task_moref = task_utils.reconfig_vm_task(vm_moref, config_spec)
+        slots = self.slot_allocators.get(vm_moref)
+        self._refresh_backing_index(vm_moref, slots)
+        config_spec = vmops.vm_remove_vmdk_disk(vm_moref, disk_file_path, self.backing_index,
+                                                slots=slots)
+        task_moref = self._submit_disk_removal(vm_moref, slots, config_spec)
         return task_moref.info.key
 
     def attach_disks(self, vm_name, disks):
@@ -352,8 +956,9 @@ class VMwareClient(object):
         utils.extended_datastore_moref(self.content, disks)
         # vm_moref = utils.get_vm_moref(self.content, uuid=vm_uuid)
         vm_moref = utils.get_vm_moref(self.content, name=vm_name)
-        config_spec = vmops.create_attach_disks_config_spec(vm_moref, disks)
-        task_moref = task_utils.reconfig_vm_task(vm_moref, config_spec)
+        task_moref = self._submit_disk_reconfig(
+            vm_moref, disks,
+            lambda slots: vmops.create_attach_disks_config_spec(vm_moref, disks, slots=slots))
         return task_moref.info.key
 
     def dettach_disks(self, vm_name, disks):
@@ -362,6 +967,9 @@ class VMwareClient(object):
                ]
         """
         vm_moref = utils.get_vm_moref(self.content, name=vm_name)
-        config_spec = vmops.create_remove_disks_config_spec(vm_moref, disks)
-        task_moref = task_utils.reconfig_vm_task(vm_moref, config_spec)
+        slots = self.slot_allocators.get(vm_moref)
+        self._refresh_backing_index(vm_moref, slots)
+        config_spec = vmops.create_remove_disks_config_spec(vm_moref, disks, self.backing_index,
+                                                            slots=slots)
+        task_moref = self._submit_disk_removal(vm_moref, slots, config_spec)
         return task_moref.info.key
@@ -5,10 +5,6 @@ from __future__ import absolute_import
 import atexit
 import logging
 import ssl
-from builtins import object
-
-from pyVim import connect
-from pyVmomi import vmodl
 
 LOG = logging.getLogger(__name__)
 
@@ -35,6 +31,8 @@ class VcenterSession(object):
         self.auth_vcenter()
 
     def auth_vcenter(self):
+        # pyVim loads the whole pyVmomi type system, only pay for it on connect
+        from pyVim import connect
         try:
             context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
             context.verify_mode = ssl.CERT_NONE
@@ -74,6 +72,7 @@ class VcenterSession(object):
 
     def disconnect(self):
         if self.si:
+            from pyVim import connect
             connect.Disconnect(self.si)
 
     def is_connected(self):
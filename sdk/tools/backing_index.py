@@ -0,0 +1,208 @@
+# -*- coding:utf-8 -*-
+"""
+Global VMDK backing index.
+
+Finding the device of a disk used to mean locating the VM and scanning its
+config.hardware.device. BackingIndex maps every disk backing uuid, fileName
+and contentId to its (vm moid, device key, controller key, datastore), built
+from the sync's disk dicts (sync_utils.get_vm_device_info) and updated one
+VM at a time, so owner and device lookups are dict lookups.
+
+A shared (multi-writer) backing is owned by several VMs, so every lookup
+returns one entry per owning VM.
+
+The index only learns about the changes this process makes. Each VM's
+entries keep the config.changeVersion they were read at (None when not
+known), so a caller about to act on a device key can check it against the
+VM's current version first.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from .lazy import vim
+
+from . import pchm
+
+
+LOG = logging.getLogger(__name__)
+
+_ENTRY_FIELDS = ['key', 'controller_key', 'unit_number', 'uuid', 'file_name',
+                 'contentid', 'ds_moid', 'is_raw']
+
+
+def disk_entries(devices):
+    """
+    Sync-style disk dicts (index fields only) from config.hardware.device,
+    without the remote datastore name reads of sync_utils.get_vm_disk_info
+    """
+    disks = []
+    for dev in devices or []:
+        if not isinstance(dev, vim.vm.device.VirtualDisk):
+            continue
+        backing = dev.backing
+        is_raw = isinstance(backing, vim.vm.device.VirtualDisk.RawDiskMappingVer1BackingInfo)
+        datastore = getattr(backing, 'datastore', None)
+        disks.append({'key': dev.key,
+                      'controller_key': dev.controllerKey,
+                      'unit_number': dev.unitNumber,
+                      'uuid': getattr(backing, 'lunUuid' if is_raw else 'uuid', None),
+                      'file_name': getattr(backing, 'fileName', None),
+                      'contentid': getattr(backing, 'contentId', None),
+                      'ds_moid': datastore._moId if datastore is not None else None,
+                      'is_raw': is_raw})
+    return disks
+
+
+class BackingIndex(object):
+    """
+    uuid / fileName / contentId -> {vm moid: disk entry}
+    An entry is a dict: vm_moid, key, controller_key, unit_number, uuid,
+    file_name, contentid, ds_moid, is_raw
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # vm moid -> [entry]
+        self._vms = {}
+        # vm moid -> config.changeVersion its entries were read at
+        self._versions = {}
+        self._by_uuid = {}
+        self._by_file = {}
+        self._by_contentid = {}
+
+    def _indexes(self, entry):
+        return ((self._by_uuid, entry.get('uuid')),
+                (self._by_file, entry.get('file_name')),
+                (self._by_contentid, entry.get('contentid')))
+
+    def _drop_vm(self, vm_moid):
+        self._versions.pop(vm_moid, None)
+        for entry in self._vms.pop(vm_moid, []):
+            for (index, value) in self._indexes(entry):
+                owners = index.get(value)
+                if owners is not None:
+                    owners.pop(vm_moid, None)
+                    if not owners:
+                        del index[value]
+
+    def update_vm(self, vm_moid, disks, change_version=None):
+        """
+        Replace the disks of a vm.
+        disks: sync disk dicts, as in the 'disk' list of a parsed vm
+        change_version: the vm's config.changeVersion disks were read at
+        """
+        entries = []
+        for disk in disks or []:
+            entry = dict((f, disk.get(f)) for f in _ENTRY_FIELDS)
+            entry['vm_moid'] = vm_moid
+            entries.append(entry)
+        with self._lock:
+            self._drop_vm(vm_moid)
+            if not entries:
+                return
+            self._vms[vm_moid] = entries
+            if change_version is not None:
+                self._versions[vm_moid] = change_version
+            for entry in entries:
+                for (index, value) in self._indexes(entry):
+                    if value:
+                        index.setdefault(value, {})[vm_moid] = entry
+
+    def update_vm_devices(self, vm_moid, devices, change_version=None):
+        """
+        Replace the disks of a vm from its config.hardware.device
+        """
+        self.update_vm(vm_moid, disk_entries(devices), change_version)
+
+    def remove_vm(self, vm_moid):
+        """
+        Forget a vm, e.g. destroyed, or its device list is no longer trusted
+        """
+        with self._lock:
+            self._drop_vm(vm_moid)
+
+    def remove_disks(self, vm_moid, keys):
+        """
+        Forget the disks with device keys of a vm after they were removed,
+        the vm's change version is unknown afterwards
+        """
+        keys = set(keys)
+        with self._lock:
+            remaining = [dict(e) for e in self._vms.get(vm_moid, []) if e['key'] not in keys]
+        self.update_vm(vm_moid, remaining)
+
+    def load(self, vms, complete=True):
+        """
+        Index parsed vms, e.g. SyncScheduler.inventory()['vm'].
+        complete: vms is the whole inventory, vms missing from it are dropped
+        """
+        vms = vms.values() if isinstance(vms, dict) else vms
+        seen = set()
+        for vm in vms:
+            seen.add(vm['moid'])
+            self.update_vm(vm['moid'], vm.get('disk'), vm.get('change_version'))
+        if complete:
+            with self._lock:
+                for vm_moid in [m for m in self._vms if m not in seen]:
+                    self._drop_vm(vm_moid)
+        return len(seen)
+
+    def collect(self, si):
+        """
+        (Re)build the index from one device collection over all vms
+        """
+        view_ref = pchm.get_container_view(si, [vim.VirtualMachine])
+        try:
+            obj_contents = pchm.collect_properties(si, view_ref, vim.VirtualMachine,
+                                                   ['config.changeVersion',
+                                                    'config.hardware.device'])
+        finally:
+            pchm.destroy_container_view(view_ref)
+        vms = [{'moid': vm['moid'], 'disk': disk_entries(vm.get('config.hardware.device')),
+                'change_version': vm.get('config.changeVersion')}
+               for vm in pchm.parse_properties(obj_contents)]
+        n_vms = self.load(vms)
+        LOG.debug("backing index loaded %d vms" % n_vms)
+        return n_vms
+
+    def has_vm(self, vm_moid):
+        with self._lock:
+            return vm_moid in self._vms
+
+    def change_version(self, vm_moid):
+        """
+        config.changeVersion the vm's entries were read at, None if unknown
+        """
+        with self._lock:
+            return self._versions.get(vm_moid)
+
+    def file_names(self):
+        with self._lock:
+            return set(self._by_file)
+
+    def vm_disks(self, vm_moid):
+        with self._lock:
+            return [dict(e) for e in self._vms.get(vm_moid, [])]
+
+    def owners(self, uuid=None, file_name=None, content_id=None):
+        """
+        Return the entries of every vm that has the backing attached
+        """
+        with self._lock:
+            if uuid:
+                owners = self._by_uuid.get(uuid)
+            elif file_name:
+                owners = self._by_file.get(file_name)
+            else:
+                owners = self._by_contentid.get(content_id)
+            return [dict(e) for e in (owners or {}).values()]
+
+    def find_disk(self, vm_moid, uuid=None, file_name=None, content_id=None):
+        """
+        Return the entry of the backing's disk on vm_moid, None if not indexed
+        """
+        for entry in self.owners(uuid, file_name, content_id):
+            if entry['vm_moid'] == vm_moid:
+                return entry
+        return None
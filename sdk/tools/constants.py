@@ -4,7 +4,7 @@
 Shared constants
 """
 
-from pyVmomi import vim
+from .lazy import vim
 
 
 DISK_TYPE_THIN = 'thin'
@@ -12,19 +12,40 @@ DISK_TYPE_PREALLOCATED = 'preallocated'
 DISK_TYPE_EAGER_ZEROED_THICK = 'eagerZeroedThick'
 
 
-NIC_ADAPTER_TYPES = {
-    'E1000': vim.vm.device.VirtualE1000,
-    'E1000E': vim.vm.device.VirtualE1000e,
-    'VMXNET3': vim.vm.device.VirtualVmxnet3,
-}
+# NIC_ADAPTER_TYPES and SCSI_CONTROLLER_TYPES map to vim types, they are
+# built on first access (see __getattr__) so importing constants does not
+# load pyVmomi
+def _nic_adapter_types():
+    return {
+        'E1000': vim.vm.device.VirtualE1000,
+        'E1000E': vim.vm.device.VirtualE1000e,
+        'VMXNET3': vim.vm.device.VirtualVmxnet3,
+    }
+
+
+def _scsi_controller_types():
+    return {
+        'BusLogic': vim.vm.device.VirtualBusLogicController,
+        'LsiLogic': vim.vm.device.VirtualLsiLogicController,
+        'LsiLogicSAS': vim.vm.device.VirtualLsiLogicSASController,
+        'ParaVirtual': vim.vm.device.ParaVirtualSCSIController,
+    }
 
-SCSI_CONTROLLER_TYPES = {
-    'BusLogic': vim.vm.device.VirtualBusLogicController,
-    'LsiLogic': vim.vm.device.VirtualLsiLogicController,
-    'LsiLogicSAS': vim.vm.device.VirtualLsiLogicSASController,
-    'ParaVirtual': vim.vm.device.ParaVirtualSCSIController,
+
+_LAZY_TABLES = {
+    'NIC_ADAPTER_TYPES': _nic_adapter_types,
+    'SCSI_CONTROLLER_TYPES': _scsi_controller_types,
 }
 
+
+def __getattr__(name):
+    build = _LAZY_TABLES.get(name)
+    if build is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    # cached as a plain module attribute, later lookups do not come here
+    value = globals()[name] = build()
+    return value
+
 SCSI_CONTROLLER_NAMES = {
         'vim.vm.device.VirtualBusLogicController': 'BusLogic',
         'vim.vm.device.VirtualLsiLogicController': 'LsiLogic',
@@ -0,0 +1,361 @@
+# -*- coding:utf-8 -*-
+"""
+Inventory path index for folders.
+
+Folder lookups by path ("DC1/vm/a/b") used to walk childEntity and read
+every child's name remotely. FolderIndex loads all folders and datacenters
+(name and parent) in one property collector pass, keeps them current with
+WaitForUpdatesEx, and serves path lookups from memory. Every lookup first
+applies the changes pending since the last poll (a WaitForUpdatesEx that
+does not wait), unless a run() thread is already waiting for them. get_or_create
+creates missing folders one level at a time under a per-path lock, so
+concurrent callers neither race nor create duplicates.
+
+Paths are made of the inventory names below the root folder, joined by
+'/', e.g. "<datacenter>/vm/<folder>/<folder>". vCenter returns names with
+'%', '/' and '\\' escaped (%25, %2f, %5c); the index keeps every name in that
+escaped form, so a '/' in a name never splits a path, and escapes the names
+it is given the same way. Each update re-indexes only the paths of the
+folders it changed and of their subtrees.
+"""
+from __future__ import absolute_import
+
+import logging
+import re
+import threading
+
+from .lazy import vim, vmodl
+
+from . import pchm
+
+
+LOG = logging.getLogger(__name__)
+
+VM_FOLDER_NAME = 'vm'
+_PATH_SET = ['name', 'parent']
+
+
+_ESCAPED = re.compile(r'%(25|2[fF]|5[cC])')
+_UNESCAPE = {'25': '%', '2f': '/', '5c': '\\'}
+
+
+def unescape_name(name):
+    """ 'a%2fb' -> 'a/b', the name as created """
+    return _ESCAPED.sub(lambda m: _UNESCAPE[m.group(1).lower()], name)
+
+
+def escape_name(name):
+    """ 'a/b' -> 'a%2fb', the name as the property collector returns it """
+    return name.replace('%', '%25').replace('/', '%2f').replace('\\', '%5c')
+
+
+def normalize_name(name):
+    """ the escaped form of a raw or already escaped name """
+    return escape_name(unescape_name(name))
+
+
+def split_path(path):
+    """ path -> its normalized names """
+    return [normalize_name(p) for p in path.split('/') if p] if path else []
+
+
+class FolderIndex(object):
+    """
+    path -> folder moref index over all vim.Folder and vim.Datacenter
+    """
+    def __init__(self, si):
+        self.si = si
+        self._lock = threading.RLock()
+        self._poll_lock = threading.Lock()
+        # moid -> [escaped name, parent moid, moref]
+        self._nodes = {}
+        # parent moid -> set of child moids
+        self._children = {}
+        # path -> moid, moid -> path, datacenter name -> path
+        self._paths = {}
+        self._moid_paths = {}
+        self._datacenters = {}
+        self._path_locks = {}
+        self._collector = None
+        self._view = None
+        self._version = None
+
+    def _ensure_loaded(self):
+        """ load the index, or apply the changes pending since the last poll """
+        if not self._version:
+            self.poll()
+        elif self._poll_lock.acquire(False):
+            try:
+                self._poll(0)
+            finally:
+                self._poll_lock.release()
+        # else a poll is running (e.g. run() waiting for changes), it applies them
+
+    def _create_filter(self):
+        content = self.si.content
+        self._collector = content.propertyCollector.CreatePropertyCollector()
+        self._view = pchm.get_container_view(self.si, [vim.Folder, vim.Datacenter])
+
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec()
+        obj_spec.obj = self._view
+        obj_spec.skip = True
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec()
+        traversal_spec.name = 'traverseEntities'
+        traversal_spec.path = 'view'
+        traversal_spec.skip = False
+        traversal_spec.type = self._view.__class__
+        obj_spec.selectSet = [traversal_spec]
+
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [obj_spec]
+        filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=t, pathSet=_PATH_SET)
+                               for t in (vim.Folder, vim.Datacenter)]
+        self._collector.CreateFilter(filter_spec, partialUpdates=False)
+        self._version = ''
+
+    def poll(self, max_wait=0):
+        """
+        Apply pending inventory changes (the first call loads everything).
+        max_wait: seconds to wait for a change, 0 returns at once
+        @ return: number of changed objects
+        """
+        # lookups only wait for the updates to be applied, not for vCenter
+        with self._poll_lock:
+            return self._poll(max_wait)
+
+    def _poll(self, max_wait):
+        """ poll() holding _poll_lock """
+        if self._collector is None:
+            self._create_filter()
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max_wait)
+        n_changes = 0
+        version = self._version
+        while True:
+            update = self._collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                break
+            version = update.version
+            with self._lock:
+                changed = []
+                for filter_update in update.filterSet:
+                    for obj_update in filter_update.objectSet:
+                        changed.append(self._apply(obj_update))
+                self._reindex(changed)
+                n_changes += len(changed)
+            if not update.truncated:
+                break
+        self._version = version
+        return n_changes
+
+    def _apply(self, obj_update):
+        """ apply one object update, return its moid """
+        moid = obj_update.obj._moId
+        if obj_update.kind == 'leave':
+            node = self._nodes.pop(moid, None)
+            if node is not None:
+                self._set_parent(moid, node[1], None)
+            return moid
+        node = self._nodes.setdefault(moid, [None, None, obj_update.obj])
+        for change in obj_update.changeSet:
+            if change.name == 'name':
+                node[0] = normalize_name(change.val) if change.val is not None else None
+            elif change.name == 'parent':
+                parent = change.val._moId if change.val is not None else None
+                self._set_parent(moid, node[1], parent)
+                node[1] = parent
+        return moid
+
+    def _set_parent(self, moid, old_parent, new_parent):
+        if old_parent is not None:
+            children = self._children.get(old_parent)
+            if children is not None:
+                children.discard(moid)
+                if not children:
+                    del self._children[old_parent]
+        if new_parent is not None:
+            self._children.setdefault(new_parent, set()).add(moid)
+
+    def run(self, stop_event, max_wait=30):
+        """
+        Keep the index current until stop_event is set
+        """
+        while not stop_event.is_set():
+            try:
+                self.poll(max_wait)
+            except Exception as ex:
+                LOG.exception(ex)
+                stop_event.wait(max_wait)
+
+    def close(self):
+        with self._poll_lock:
+            if self._collector is not None:
+                self._collector.Destroy()
+                pchm.destroy_container_view(self._view)
+            self._collector = self._view = self._version = None
+
+    def _reindex(self, moids):
+        """
+        Recompute the paths of moids and of everything below them, under _lock
+        """
+        # drop the old paths of the changed subtrees
+        stale = set()
+        pending = list(moids)
+        while pending:
+            moid = pending.pop()
+            if moid in stale:
+                continue
+            stale.add(moid)
+            pending.extend(self._children.get(moid, ()))
+        removed = set()
+        for moid in stale:
+            path = self._moid_paths.pop(moid, None)
+            if path is not None and self._paths.get(path) == moid:
+                del self._paths[path]
+                removed.add(path)
+        if removed:
+            self._datacenters = dict((name, path) for (name, path) in self._datacenters.items()
+                                     if path not in removed)
+
+        unresolved = set()
+
+        def path_of(moid):
+            path = self._moid_paths.get(moid)
+            if path is not None or moid in unresolved:
+                return path
+            node = self._nodes.get(moid)
+            if node is None or node[0] is None:
+                # gone, or its name is not known yet
+                path = None
+            elif node[1] not in self._nodes:
+                # the view does not contain the root folder, its children are top level
+                path = node[0]
+            else:
+                parent_path = path_of(node[1])
+                path = parent_path + '/' + node[0] if parent_path is not None else None
+            if path is None:
+                unresolved.add(moid)
+            else:
+                self._moid_paths[moid] = path
+            return path
+
+        for moid in stale:
+            path = path_of(moid)
+            if path is not None:
+                node = self._nodes[moid]
+                self._paths[path] = moid
+                if isinstance(node[2], vim.Datacenter):
+                    self._datacenters[node[0]] = path
+
+    def _lookup(self, path):
+        moid = self._paths.get(path)
+        return self._nodes[moid][2] if moid else None
+
+    def path_of(self, obj_ref):
+        """
+        Return the index path of a folder/datacenter moref, '' for the root folder,
+        None if it is not indexed
+        """
+        if obj_ref._moId == self.si.content.rootFolder._moId:
+            return ''
+        self._ensure_loaded()
+        return self._path_of(obj_ref)
+
+    def _path_of(self, obj_ref):
+        if obj_ref._moId == self.si.content.rootFolder._moId:
+            return ''
+        with self._lock:
+            if obj_ref._moId not in self._nodes:
+                return None
+            return self._moid_paths.get(obj_ref._moId)
+
+    def get(self, path, nearest=False, min_depth=0):
+        """
+        Return the folder at path, None if missing, or with nearest the
+        deepest existing folder along path that is at least min_depth deep
+        """
+        self._ensure_loaded()
+        return self._get(path, nearest, min_depth)
+
+    def _get(self, path, nearest=False, min_depth=0):
+        names = split_path(path)
+        with self._lock:
+            found = self._lookup('/'.join(names))
+            if found is not None or not nearest:
+                return found
+            while len(names) > min_depth:
+                names.pop()
+                found = self._lookup('/'.join(names))
+                if found is not None:
+                    return found
+        return None
+
+    def get_vm_folder(self, datacenter_name, folder_path=None, nearest=False):
+        """
+        Return <datacenter>/vm/<folder_path>, with nearest the deepest
+        existing folder down to the datacenter's vm folder
+        """
+        self._ensure_loaded()
+        with self._lock:
+            dc_path = self._datacenters.get(normalize_name(datacenter_name))
+        if dc_path is None:
+            return None
+        base = split_path(dc_path) + [VM_FOLDER_NAME]
+        return self._get('/'.join(base + split_path(folder_path)), nearest=nearest,
+                         min_depth=len(base))
+
+    def _path_lock(self, path):
+        with self._lock:
+            lock = self._path_locks.get(path)
+            if lock is None:
+                lock = self._path_locks[path] = threading.Lock()
+            return lock
+
+    def get_or_create(self, path, parent=None):
+        """
+        Return the folder at path, creating missing folders.
+        parent: folder moref path is relative to, default the root folder
+        """
+        self._ensure_loaded()
+        names = split_path(path)
+        if parent is not None:
+            parent_path = self._path_of(parent)
+            if parent_path is None:
+                raise Exception("Folder %s is not in the folder index!" % parent._moId)
+            names = split_path(parent_path) + names
+        folder = self.si.content.rootFolder
+        for i in range(1, len(names) + 1):
+            prefix = '/'.join(names[:i])
+            with self._lock:
+                found = self._lookup(prefix)
+            if found is not None:
+                folder = found
+                continue
+            with self._path_lock(prefix):
+                with self._lock:
+                    found = self._lookup(prefix)
+                folder = found if found is not None else self._create(folder, names[i - 1])
+        return folder
+
+    def _create(self, parent_folder, name):
+        """ create folder name (escaped) in parent_folder """
+        try:
+            folder = parent_folder.CreateFolder(unescape_name(name))
+            LOG.info("Created folder %s in %s" % (name, parent_folder._moId))
+        except vim.fault.DuplicateName:
+            # created outside of this index since the last poll
+            folder = None
+            for child in parent_folder.childEntity:
+                if isinstance(child, vim.Folder) and normalize_name(child.name) == name:
+                    folder = child
+                    break
+            if folder is None:
+                raise
+        with self._lock:
+            node = self._nodes.get(folder._moId)
+            if node is None:
+                node = self._nodes[folder._moId] = [None, None, folder]
+            node[0] = name
+            self._set_parent(folder._moId, node[1], parent_folder._moId)
+            node[1] = parent_folder._moId
+            self._reindex([folder._moId])
+        return folder
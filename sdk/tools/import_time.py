@@ -0,0 +1,128 @@
+# -*- coding:utf-8 -*-
+"""
+Import time budget check.
+
+Imports a module in a fresh interpreter with `python -X importtime`, reports
+its cumulative import time and the slowest imports, and fails when it is over
+budget or when a module that must stay lazy (pyVmomi, see lazy.py) got
+imported:
+
+    python -m sdk.tools.import_time --budget-ms 150 sdk.client
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+DEFAULT_MODULE = 'sdk.client'
+DEFAULT_BUDGET_MS = 150
+# heavy modules a plain `import sdk.client` must not load
+DEFAULT_FORBIDDEN = ['pyVmomi', 'pyVim', 'past', 'future', 'urllib.request']
+DEFAULT_RUNS = 3
+
+_PROBE = ("import sys, json; import %s; "
+          "sys.stdout.write(json.dumps(sorted(sys.modules)))")
+
+
+def _repo_root():
+    return os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_importtime(output):
+    """
+    Parse `-X importtime` stderr.
+    @ return: [(module, self us, cumulative us)] in import order
+    """
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        try:
+            self_us = int(fields[0])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            # the header line
+            continue
+        rows.append((fields[2].strip(), self_us, cumulative_us))
+    return rows
+
+
+def measure(module=DEFAULT_MODULE, python=None, cwd=None):
+    """
+    Import module once in a fresh interpreter.
+    @ return: {'module', 'total_ms', 'imports': [(module, self us, cumulative us)],
+               'modules': [names in sys.modules afterwards]}
+    """
+    cmd = [python or sys.executable, '-X', 'importtime', '-c', _PROBE % module]
+    proc = subprocess.Popen(cmd, cwd=cwd or _repo_root(), stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    (out, err) = proc.communicate()
+    if proc.returncode != 0:
+        raise Exception("import %s failed: %s" % (module, err.strip().splitlines()[-1:]))
+    imports = parse_importtime(err)
+    total_us = 0
+    for (name, _, cumulative_us) in imports:
+        if name == module:
+            total_us = cumulative_us
+    return {'module': module, 'total_ms': total_us / 1000.0, 'imports': imports,
+            'modules': json.loads(out)}
+
+
+def check(module=DEFAULT_MODULE, budget_ms=DEFAULT_BUDGET_MS, forbidden=None,
+          runs=DEFAULT_RUNS, python=None):
+    """
+    Measure module runs times, the best run counts against budget_ms.
+    @ return: (ok, report dict)
+    """
+    forbidden = DEFAULT_FORBIDDEN if forbidden is None else forbidden
+    results = [measure(module, python) for _ in range(max(1, runs))]
+    best = min(results, key=lambda r: r['total_ms'])
+    loaded = set(best['modules'])
+    leaked = [name for name in forbidden
+              if name in loaded or any(m.startswith(name + '.') for m in loaded)]
+    slowest = sorted(best['imports'], key=lambda r: r[1], reverse=True)[:15]
+    report = {'module': module,
+              'total_ms': best['total_ms'],
+              'budget_ms': budget_ms,
+              'runs_ms': [r['total_ms'] for r in results],
+              'leaked': leaked,
+              'slowest': [{'module': name, 'self_ms': self_us / 1000.0,
+                           'cumulative_ms': cumulative_us / 1000.0}
+                          for (name, self_us, cumulative_us) in slowest]}
+    ok = best['total_ms'] <= budget_ms and not leaked
+    return (ok, report)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the import time of a module')
+    parser.add_argument('module', nargs='?', default=DEFAULT_MODULE)
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--forbid', action='append', default=None,
+                        help='module that must not be imported (repeatable)')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args(argv)
+
+    (ok, report) = check(args.module, args.budget_ms, args.forbid, args.runs)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("import %s: %.1fms (budget %.1fms, runs %s)"
+              % (report['module'], report['total_ms'], report['budget_ms'],
+                 ', '.join('%.1f' % t for t in report['runs_ms'])))
+        for row in report['slowest']:
+            print("  %8.1fms %8.1fms  %s" % (row['self_ms'], row['cumulative_ms'], row['module']))
+        if report['leaked']:
+            print("imported eagerly: %s" % ', '.join(report['leaked']))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+"""
+Lazy module references.
+
+Importing pyVmomi builds its whole type system, which is most of the import
+time of sdk.client. The sdk modules import vim/vmodl from here instead: the
+names are stand-ins that import the real module on first attribute access,
+so `from .lazy import vim` costs nothing until a vim type is actually used.
+Nothing may touch them at module level (use a function, see
+constants.__getattr__), or the import is paid up front again.
+"""
+from __future__ import absolute_import
+
+import importlib
+import threading
+
+
+_import_lock = threading.Lock()
+
+
+class LazyModule(object):
+    """
+    Stand-in for module `name` (or its attribute `attr`), loaded on first use
+    """
+    def __init__(self, name, attr=None):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_attr'] = attr
+        self.__dict__['_lazy_target'] = None
+
+    def _lazy_load(self):
+        target = self.__dict__['_lazy_target']
+        if target is None:
+            with _import_lock:
+                target = self.__dict__['_lazy_target']
+                if target is None:
+                    target = importlib.import_module(self._lazy_name)
+                    if self._lazy_attr:
+                        target = getattr(target, self._lazy_attr)
+                    self.__dict__['_lazy_target'] = target
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy_load(), name, value)
+
+    def __dir__(self):
+        return dir(self._lazy_load())
+
+    def __repr__(self):
+        name = self._lazy_name + ('.' + self._lazy_attr if self._lazy_attr else '')
+        state = 'loaded' if self.__dict__['_lazy_target'] is not None else 'not loaded'
+        return "<lazy module %s (%s)>" % (name, state)
+
+
+def is_loaded(module):
+    """
+    True once a LazyModule has been imported (always True for real modules)
+    """
+    if isinstance(module, LazyModule):
+        return module.__dict__['_lazy_target'] is not None
+    return True
+
+
+vim = LazyModule('pyVmomi', 'vim')
+vmodl = LazyModule('pyVmomi', 'vmodl')
+VmomiSupport = LazyModule('pyVmomi.VmomiSupport')
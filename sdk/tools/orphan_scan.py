@@ -0,0 +1,251 @@
+# -*- coding:utf-8 -*-
+"""
+Orphaned VMDK scanner.
+
+Disks created by a failed attach/detach flow (fileOperation "create" that
+never got attached, removed devices whose file was kept) stay on the
+datastores. The scanner lists the vmdk files of every datastore, one
+SearchDatastore_Task per folder (not per subtree, so a task result is one
+folder's listing), a few at a time per datastore and several datastores in
+parallel, and diffs them against the files of all registered VMs
+(layoutEx.file). Subfolders are queued as they are found and submitted
+while fewer than max_per_datastore searches run. Orphans are streamed
+through a bounded queue as each search finishes, so memory does not grow
+with the number of files on a datastore.
+"""
+from __future__ import absolute_import
+
+import calendar
+import logging
+import threading
+import time
+from concurrent import futures
+
+from six.moves import queue
+from .lazy import vim
+
+from . import pchm, soap_metrics, tracing, utils
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_DATASTORES = 8
+DEFAULT_MAX_PER_DATASTORE = 2
+# files changed more recently may belong to an attach still in flight
+DEFAULT_MIN_AGE = 3600
+# orphans buffered between the searches and the consumer
+_QUEUE_SIZE = 1000
+_DONE = object()
+
+
+def _bind(fn):
+    """ fn run on a pool thread, attributed to the caller's operation and span """
+    return tracing.bind(soap_metrics.bind(fn))
+
+
+def join_datastore_path(folder_path, file_name):
+    """ '[ds1] vm1' + 'vm1.vmdk' -> '[ds1] vm1/vm1.vmdk' """
+    if folder_path.endswith(']'):
+        return "%s %s" % (folder_path, file_name)
+    if folder_path.endswith('/') or folder_path.endswith('] '):
+        return folder_path + file_name
+    return "%s/%s" % (folder_path, file_name)
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple()) if dt else None
+
+
+def _disk_search_spec():
+    query = vim.host.DatastoreBrowser.VmDiskQuery()
+    query.details = vim.host.DatastoreBrowser.VmDiskQuery.Details(
+        diskType=True, capacityKb=True, hardwareVersion=False)
+    search_spec = vim.host.DatastoreBrowser.SearchSpec()
+    search_spec.query = [query]
+    search_spec.matchPattern = ['*.vmdk']
+    search_spec.details = vim.host.DatastoreBrowser.FileInfo.Details(
+        fileType=True, fileSize=True, modification=True)
+    return search_spec
+
+
+def _folder_search_spec():
+    search_spec = _disk_search_spec()
+    search_spec.query.append(vim.host.DatastoreBrowser.FolderQuery())
+    search_spec.matchPattern = None
+    return search_spec
+
+
+class OrphanScanner(object):
+    """
+    Find vmdk files no registered VM uses.
+    @ parameters:
+    @@ backing_index: optional backing_index.BackingIndex, its file names
+                      count as attached too
+    @@ max_datastores: datastores searched at once
+    @@ max_per_datastore: folder searches in flight on one datastore
+    @@ min_age: seconds, younger files are never reported
+    """
+    def __init__(self, si, backing_index=None, max_datastores=DEFAULT_MAX_DATASTORES,
+                 max_per_datastore=DEFAULT_MAX_PER_DATASTORE, min_age=DEFAULT_MIN_AGE):
+        self.si = si
+        self.backing_index = backing_index
+        self.max_datastores = max_datastores
+        self.max_per_datastore = max_per_datastore
+        self.min_age = min_age
+        self.errors = []
+
+    def attached_files(self):
+        """
+        Set of every file of every registered VM (disks, snapshots, deltas)
+        """
+        view_ref = pchm.get_container_view(self.si, [vim.VirtualMachine])
+        try:
+            obj_contents = pchm.collect_properties(self.si, view_ref, vim.VirtualMachine,
+                                                   ['layoutEx.file'])
+        finally:
+            pchm.destroy_container_view(view_ref)
+        attached = set()
+        for obj in obj_contents:
+            for prop in obj.propSet:
+                attached.update(f.name for f in prop.val or [])
+        return attached
+
+    def _datastores(self, datastore_names=None):
+        view_ref = pchm.get_container_view(self.si, [vim.Datastore])
+        try:
+            obj_contents = pchm.collect_properties(self.si, view_ref, vim.Datastore,
+                                                   ['name', 'browser', 'summary.accessible'])
+        finally:
+            pchm.destroy_container_view(view_ref)
+        datastores = []
+        for ds in pchm.parse_properties(obj_contents, include_mors=True):
+            if datastore_names and ds.get('name') not in datastore_names:
+                continue
+            if not ds.get('summary.accessible', True):
+                LOG.warning("datastore %s is not accessible, skipped" % ds.get('name'))
+                continue
+            datastores.append(ds)
+        return datastores
+
+    def scan(self, datastore_names=None):
+        """
+        Generator of orphaned vmdk files as they are found:
+        {'path', 'datastore', 'ds_moid', 'size', 'capacity_kb', 'disk_type', 'modified'}
+        Search failures are logged and kept in self.errors.
+        """
+        attached = self.attached_files()
+        if self.backing_index is not None:
+            attached.update(self.backing_index.file_names())
+        datastores = self._datastores(datastore_names)
+        LOG.debug("orphan scan of %d datastores against %d attached files"
+                  % (len(datastores), len(attached)))
+        self.errors = []
+        results = queue.Queue(maxsize=_QUEUE_SIZE)
+        stop = threading.Event()
+        min_mtime = time.time() - self.min_age if self.min_age else None
+
+        def emit(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def search_results(ds, task_results):
+            for result in task_results or []:
+                for f in result.file or []:
+                    if not isinstance(f, vim.host.DatastoreBrowser.VmDiskInfo):
+                        continue
+                    path = join_datastore_path(result.folderPath, f.path)
+                    if path in attached:
+                        continue
+                    modified = _timestamp(f.modification)
+                    if min_mtime and modified and modified > min_mtime:
+                        continue
+                    emit({'path': path, 'datastore': ds['name'], 'ds_moid': ds['moid'],
+                          'size': f.fileSize or 0, 'capacity_kb': f.capacityKb,
+                          'disk_type': f.diskType, 'modified': modified})
+
+        def search(ds, task, what):
+            (state, result) = utils.wait_for_task(task)
+            if state != 0:
+                msg = "search %s of %s failed: %s" % (what, ds['name'], result)
+                LOG.warning(msg)
+                self.errors.append(msg)
+                return None
+            return result
+
+        def scan_folder(ds, folder):
+            """ emit the orphans of one folder, return its subfolders """
+            if stop.is_set():
+                return []
+            result = search(ds, ds['browser'].SearchDatastore_Task(
+                datastorePath=folder, searchSpec=_folder_search_spec()), folder)
+            if result is None:
+                return []
+            search_results(ds, [result])
+            return [join_datastore_path(folder, f.path) for f in result.file or []
+                    if isinstance(f, vim.host.DatastoreBrowser.FolderInfo)]
+
+        def scan_datastore(ds):
+            folders = ["[%s]" % ds['name']]
+            jobs = set()
+            with futures.ThreadPoolExecutor(max_workers=self.max_per_datastore) as executor:
+                while (folders or jobs) and not stop.is_set():
+                    while folders and len(jobs) < self.max_per_datastore:
+                        jobs.add(executor.submit(_bind(scan_folder), ds, folders.pop()))
+                    (done, jobs) = futures.wait(jobs, return_when=futures.FIRST_COMPLETED)
+                    for job in done:
+                        try:
+                            folders.extend(job.result())
+                        except Exception as ex:
+                            LOG.exception(ex)
+                            self.errors.append(str(ex))
+
+        def run():
+            try:
+                with futures.ThreadPoolExecutor(max_workers=self.max_datastores) as executor:
+                    for job in [executor.submit(_bind(scan_datastore), ds) for ds in datastores]:
+                        try:
+                            job.result()
+                        except Exception as ex:
+                            LOG.exception(ex)
+                            self.errors.append(str(ex))
+            finally:
+                emit(_DONE)
+
+        runner = threading.Thread(target=_bind(run))
+        runner.daemon = True
+        runner.start()
+        try:
+            while True:
+                item = results.get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # the consumer stopped early, let the searches wind down
+            stop.set()
+
+    def report(self, datastore_names=None, keep_files=False):
+        """
+        Reclaimable space summary:
+        {'total_files', 'total_bytes', 'datastores': {name: {'files', 'bytes'}},
+         'errors', 'files': [orphan] when keep_files}
+        """
+        summary = {'total_files': 0, 'total_bytes': 0, 'datastores': {}}
+        files = []
+        for orphan in self.scan(datastore_names):
+            ds_summary = summary['datastores'].setdefault(orphan['datastore'],
+                                                          {'files': 0, 'bytes': 0})
+            ds_summary['files'] += 1
+            ds_summary['bytes'] += orphan['size']
+            summary['total_files'] += 1
+            summary['total_bytes'] += orphan['size']
+            if keep_files:
+                files.append(orphan)
+        summary['errors'] = list(self.errors)
+        if keep_files:
+            summary['files'] = files
+        return summary
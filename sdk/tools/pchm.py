@@ -3,7 +3,9 @@
 Property Collector helper module.
 """
 
-import pyVmomi
+from __future__ import absolute_import
+
+from .lazy import vmodl
 
 
 def get_container_view(service_instance, obj_type, container=None):
@@ -31,6 +33,26 @@ def get_container_view(service_instance, obj_type, container=None):
     return view_ref
 
 
+def get_list_view(service_instance, obj_refs):
+    """
+    Get a vSphere List View reference over the given managed objects.
+
+    The List View can be handed to collect_properties in place of a
+    Container View, and must be destroyed by the caller as well.
+
+    Args:
+        obj_refs (list): A list of managed object references
+
+    Returns:
+        A list view ref to the given managed objects
+
+    """
+    view_ref = service_instance.content.viewManager.CreateListView(
+        obj=obj_refs
+    )
+    return view_ref
+
+
 def destroy_container_view(view_ref):
     # destroy view
     view_ref.Destroy()
@@ -62,12 +84,12 @@ def collect_properties(service_instance, view_ref, obj_type, path_set=None,
 
     # Create object specification to define the starting point of
     # inventory navigation
-    obj_spec = pyVmomi.vmodl.query.PropertyCollector.ObjectSpec()
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec()
     obj_spec.obj = view_ref
     obj_spec.skip = True
 
     # Create a traversal specification to identify the path for collection
-    traversal_spec = pyVmomi.vmodl.query.PropertyCollector.TraversalSpec()
+    traversal_spec = vmodl.query.PropertyCollector.TraversalSpec()
     traversal_spec.name = 'traverseEntities'
     traversal_spec.path = 'view'
     traversal_spec.skip = False
@@ -75,7 +97,7 @@ def collect_properties(service_instance, view_ref, obj_type, path_set=None,
     obj_spec.selectSet = [traversal_spec]
 
     # Identify the properties to the retrieved
-    property_spec = pyVmomi.vmodl.query.PropertyCollector.PropertySpec()
+    property_spec = vmodl.query.PropertyCollector.PropertySpec()
     property_spec.type = obj_type
 
     if not path_set:
@@ -85,7 +107,7 @@ def collect_properties(service_instance, view_ref, obj_type, path_set=None,
 
     # Add the object and property specification to the
     # property filter specification
-    filter_spec = pyVmomi.vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
     filter_spec.objectSet = [obj_spec]
     filter_spec.propSet = [property_spec]
 
@@ -95,6 +117,41 @@ def collect_properties(service_instance, view_ref, obj_type, path_set=None,
     return props
 
 
+def get_object_properties(service_instance, obj_ref, path_set):
+    """
+    Collect properties of a single managed object in one round trip
+
+    Args:
+        si          (ServiceInstance): ServiceInstance connection
+        obj_ref     (pyVmomi.vim.*): Managed object ref
+        path_set               (list): List of properties to retrieve
+
+    Returns:
+        A dict of property path to value, unset properties are left out
+
+    """
+    collector = service_instance.content.propertyCollector
+
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec()
+    obj_spec.obj = obj_ref
+    obj_spec.skip = False
+
+    property_spec = vmodl.query.PropertyCollector.PropertySpec()
+    property_spec.type = obj_ref.__class__
+    property_spec.pathSet = path_set
+
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [obj_spec]
+    filter_spec.propSet = [property_spec]
+
+    props = collector.RetrieveContents([filter_spec])
+    properties = {}
+    for obj in props or []:
+        for prop in obj.propSet:
+            properties[prop.name] = prop.val
+    return properties
+
+
 def parse_properties(props, include_mors=False, key=None):
     # Parse properties
     data = []
@@ -0,0 +1,259 @@
+# -*- coding:utf-8 -*-
+"""
+Bulk performance counter collector.
+
+Counter ids are resolved once from PerformanceManager.perfCounter, then every
+collection cycle issues batched QueryPerf calls across all powered on hosts
+and VMs, a few batches in parallel. Samples are kept in fixed-size ring
+buffers per (entity, counter).
+"""
+from __future__ import absolute_import
+
+import calendar
+import collections
+import logging
+import threading
+import time
+from concurrent import futures
+
+from .lazy import vim
+
+from . import pchm
+
+
+LOG = logging.getLogger(__name__)
+
+REALTIME_INTERVAL = 20
+DEFAULT_METRICS = ['cpu.usage.average',
+                   'cpu.ready.summation',
+                   'mem.usage.average',
+                   'mem.active.average',
+                   'disk.usage.average',
+                   'net.usage.average']
+DEFAULT_BATCH_SIZE = 250
+MIN_BATCH_SIZE = 25
+MAX_BATCH_SIZE = 2000
+DEFAULT_MAX_WORKERS = 4
+# one hour of real-time samples
+DEFAULT_HISTORY = 180
+
+# vim type names, looked up when used so importing does not load pyVmomi
+_ENTITY_TYPES = {
+    'host': 'HostSystem',
+    'vm': 'VirtualMachine',
+}
+
+
+class PerfCollector(object):
+    """
+    Collect real-time performance counters for many entities per request.
+
+    @ parameters:
+    @@ metrics: counter names as "group.name.rollup", e.g. cpu.usage.average
+    @@ interval_id: sampling interval in seconds (20 is real-time)
+    @@ batch_size: entities per QueryPerf call, grown when a cycle does not
+                   fit in cycle_budget and shrunk when single calls are slow
+                   or fail
+    @@ max_workers: QueryPerf calls in flight at the same time
+    @@ history: samples kept per (entity, counter)
+    """
+    def __init__(self, si, metrics=None, interval_id=REALTIME_INTERVAL,
+                 batch_size=DEFAULT_BATCH_SIZE, max_workers=DEFAULT_MAX_WORKERS,
+                 history=DEFAULT_HISTORY, entity_types=('host', 'vm'),
+                 cycle_budget=None):
+        self.si = si
+        self.metrics = list(metrics or DEFAULT_METRICS)
+        self.interval_id = interval_id
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.history = history
+        self.entity_types = entity_types
+        # leave a quarter of the interval as headroom
+        self.cycle_budget = cycle_budget or interval_id * 0.75
+        self._counter_ids = None
+        self._counter_names = None
+        self._buffers = {}
+        self._last_ts = {}
+        self._latencies = []
+        self._lock = threading.Lock()
+
+    def resolve_counters(self):
+        """
+        Resolve metric names to counter ids once, unknown names are dropped
+        """
+        if self._counter_ids is not None:
+            return self._counter_ids
+        perf_manager = self.si.content.perfManager
+        available = {}
+        for counter in perf_manager.perfCounter:
+            name = "%s.%s.%s" % (counter.groupInfo.key, counter.nameInfo.key,
+                                 counter.rollupType)
+            available[name] = counter.key
+        counter_ids = {}
+        for name in self.metrics:
+            if name in available:
+                counter_ids[name] = available[name]
+            else:
+                LOG.warning("Performance counter not found: %s" % name)
+        self._counter_ids = counter_ids
+        self._counter_names = dict((v, k) for k, v in counter_ids.items())
+        return counter_ids
+
+    def get_entities(self):
+        """
+        Return powered on host and VM refs, in one collection per type
+        """
+        entities = []
+        for entity_type in self.entity_types:
+            vim_type = getattr(vim, _ENTITY_TYPES[entity_type])
+            view_ref = pchm.get_container_view(self.si, [vim_type])
+            try:
+                obj_contents = pchm.collect_properties(self.si, view_ref, vim_type,
+                                                       ['runtime.powerState'])
+            finally:
+                pchm.destroy_container_view(view_ref)
+            for obj in obj_contents:
+                for prop in obj.propSet:
+                    if prop.val == 'poweredOn':
+                        entities.append(obj.obj)
+        return entities
+
+    def _make_query_specs(self, entities, max_sample):
+        metric_ids = [vim.PerformanceManager.MetricId(counterId=counter_id, instance='')
+                      for counter_id in self._counter_ids.values()]
+        return [vim.PerformanceManager.QuerySpec(entity=entity,
+                                                 metricId=metric_ids,
+                                                 intervalId=self.interval_id,
+                                                 maxSample=max_sample,
+                                                 format='normal')
+                for entity in entities]
+
+    def _query_batch(self, entities, max_sample):
+        query_specs = self._make_query_specs(entities, max_sample)
+        return self.si.content.perfManager.QueryPerf(querySpec=query_specs)
+
+    def _timed_query_batch(self, entities, max_sample):
+        started = time.time()
+        try:
+            return self._query_batch(entities, max_sample)
+        finally:
+            self._latencies.append(time.time() - started)
+
+    def collect(self, entities=None, max_sample=1):
+        """
+        Run one collection cycle over entities (all powered on hosts and VMs
+        by default) and return the cycle statistics
+        """
+        started = time.time()
+        if not self.resolve_counters():
+            raise Exception("No valid performance counters to collect!")
+        if entities is None:
+            entities = self.get_entities()
+            # only a full listing tells which entities went away
+            self._prune(set(entity._moId for entity in entities))
+        batch_size = self.batch_size
+        batches = [entities[i:i + batch_size]
+                   for i in range(0, len(entities), batch_size)]
+        n_samples = 0
+        n_errors = 0
+        self._latencies = []
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            jobs = [executor.submit(self._timed_query_batch, batch, max_sample)
+                    for batch in batches]
+            for job in futures.as_completed(jobs):
+                try:
+                    n_samples += self._store(job.result())
+                except Exception as ex:
+                    n_errors += 1
+                    LOG.exception(ex)
+        elapsed = time.time() - started
+        max_latency = max(self._latencies) if self._latencies else 0.0
+        self._tune_batch_size(elapsed, len(entities), max_latency, n_errors)
+        stats = {'entities': len(entities), 'batches': len(batches),
+                 'batch_size': batch_size, 'samples': n_samples,
+                 'errors': n_errors, 'elapsed': elapsed,
+                 'max_latency': max_latency}
+        LOG.debug("perf collect: %s" % stats)
+        return stats
+
+    def _tune_batch_size(self, elapsed, n_entities, max_latency=0.0, n_errors=0):
+        """
+        Smaller QueryPerf calls when one call fails or takes more than half
+        the budget, fewer, larger calls when a cycle overruns its budget
+        """
+        batch_budget = self.cycle_budget / 2
+        if n_errors or max_latency > batch_budget:
+            if self.batch_size <= MIN_BATCH_SIZE:
+                LOG.warning("perf collect batch took %.1fs (%d errors), "
+                            "batch size already at %d"
+                            % (max_latency, n_errors, MIN_BATCH_SIZE))
+                return
+            if n_errors:
+                factor = 0.5
+            else:
+                factor = max(0.5, batch_budget / max_latency)
+            self.batch_size = max(MIN_BATCH_SIZE, int(self.batch_size * factor))
+            LOG.info("perf collect batch took %.1fs (%d errors), batch size "
+                     "lowered to %d" % (max_latency, n_errors, self.batch_size))
+            return
+        if elapsed <= self.cycle_budget or n_entities <= self.batch_size:
+            return
+        if self.batch_size >= MAX_BATCH_SIZE:
+            LOG.warning("perf collect cycle took %.1fs over %d entities, "
+                        "batch size already at %d" % (elapsed, n_entities, MAX_BATCH_SIZE))
+            return
+        factor = min(2.0, elapsed / self.cycle_budget)
+        self.batch_size = min(MAX_BATCH_SIZE, int(self.batch_size * factor) + 1)
+        LOG.info("perf collect cycle took %.1fs, batch size raised to %d"
+                 % (elapsed, self.batch_size))
+
+    def _prune(self, moids):
+        """
+        Drop the buffers of entities that are no longer collected
+        """
+        with self._lock:
+            for key in [k for k in self._buffers if k[0] not in moids]:
+                del self._buffers[key]
+                self._last_ts.pop(key, None)
+
+    def _store(self, entity_metrics):
+        n_samples = 0
+        with self._lock:
+            for entity_metric in entity_metrics or []:
+                moid = entity_metric.entity._moId
+                timestamps = [calendar.timegm(s.timestamp.utctimetuple())
+                              for s in entity_metric.sampleInfo]
+                for series in entity_metric.value:
+                    name = self._counter_names.get(series.id.counterId)
+                    if not name:
+                        continue
+                    key = (moid, name)
+                    buf = self._buffers.get(key)
+                    if buf is None:
+                        buf = self._buffers[key] = collections.deque(maxlen=self.history)
+                    last_ts = self._last_ts.get(key)
+                    for (ts, value) in zip(timestamps, series.value):
+                        # -1 means the sample is not available
+                        if value < 0 or (last_ts is not None and ts <= last_ts):
+                            continue
+                        buf.append((ts, value))
+                        last_ts = ts
+                        n_samples += 1
+                    self._last_ts[key] = last_ts
+        return n_samples
+
+    def samples(self, moid, metric):
+        """
+        Return [(timestamp, value)] kept for an entity counter, oldest first
+        """
+        with self._lock:
+            return list(self._buffers.get((moid, metric), []))
+
+    def latest(self, moid, metric):
+        with self._lock:
+            buf = self._buffers.get((moid, metric))
+            return buf[-1] if buf else None
+
+    def entities(self):
+        with self._lock:
+            return sorted(set(moid for (moid, metric) in self._buffers))
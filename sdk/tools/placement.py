@@ -0,0 +1,291 @@
+# -*- coding:utf-8 -*-
+"""
+Capacity-aware host/datastore placement.
+
+The engine scores hosts and datastores from cached capacity data (as
+collected by the inventory sync): datastore free space, host CPU and memory
+usage and VM count, with configurable weights and anti-affinity groups.
+Every placement reserves its resources in memory, so a batch (or a burst of
+single requests) spreads out instead of piling onto the same host before the
+next capacity refresh. Nothing here talks to vCenter except collect/refresh.
+"""
+from __future__ import absolute_import, division
+
+import logging
+import threading
+import time
+
+import six
+from .lazy import vim
+
+from . import pchm, sync_utils
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_WEIGHTS = {'cpu': 1.0,          # free host cpu ratio
+                   'memory': 1.0,       # free host memory ratio
+                   'vms': 0.5,          # fewer vms than the busiest host
+                   'datastore': 1.0,    # free datastore space ratio
+                   'affinity': 2.0}     # penalty per group member (soft anti-affinity)
+# share of a physical core a vcpu is expected to use
+DEFAULT_VCPU_DEMAND = 0.5
+# never fill a datastore above 1 - DEFAULT_DS_MIN_FREE or a host memory above 1 - DEFAULT_MEM_HEADROOM
+DEFAULT_DS_MIN_FREE = 0.1
+DEFAULT_MEM_HEADROOM = 0.05
+# capacity data older than this is re-collected by callers that own a connection
+DEFAULT_MAX_AGE = 300
+
+PLACEMENT_HOST_PROPERTIES = ['name',
+                             'runtime.connectionState',
+                             'runtime.inMaintenanceMode',
+                             'summary.hardware.memorySize',
+                             'summary.hardware.cpuMhz',
+                             'summary.hardware.numCpuCores',
+                             'summary.quickStats.overallMemoryUsage',
+                             'summary.quickStats.overallCpuUsage',
+                             'vm',
+                             'datastore']
+PLACEMENT_DATASTORE_PROPERTIES = ['name',
+                                  'summary.capacity',
+                                  'summary.freeSpace',
+                                  'summary.accessible',
+                                  'summary.maintenanceMode']
+PLACEMENT_CLUSTER_PROPERTIES = ['name', 'host']
+
+
+class _Host(object):
+    def __init__(self, props, cluster=None):
+        self.moid = props['moid']
+        self.name = props.get('name')
+        self.obj = props.get('obj')
+        self.cluster = cluster or {}
+        self.available = (props.get('runtime.connectionState', 'connected') == 'connected'
+                          and not props.get('runtime.inMaintenanceMode'))
+        self.cpu_mhz = props.get('summary.hardware.cpuMhz') or 0
+        self.cpu_capacity = self.cpu_mhz * (props.get('summary.hardware.numCpuCores') or 0)
+        self.cpu_used = props.get('summary.quickStats.overallCpuUsage') or 0
+        self.mem_capacity = (props.get('summary.hardware.memorySize') or 0) / 1024 ** 2
+        self.mem_used = props.get('summary.quickStats.overallMemoryUsage') or 0
+        self.n_vms = len(props.get('vm') or [])
+        self.datastores = [_moid(ds) for ds in props.get('datastore') or []]
+
+
+class _Datastore(object):
+    def __init__(self, props):
+        self.moid = props['moid']
+        self.name = props.get('name')
+        self.obj = props.get('obj')
+        self.available = (props.get('summary.accessible', True)
+                          and props.get('summary.maintenanceMode', 'normal') == 'normal')
+        self.capacity = props.get('summary.capacity') or 0
+        self.free = props.get('summary.freeSpace') or 0
+
+
+def _moid(obj):
+    return obj if isinstance(obj, six.string_types) else obj._moId
+
+
+def _values(objs):
+    return list(objs.values()) if isinstance(objs, dict) else list(objs or [])
+
+
+class PlacementEngine(object):
+    """
+    Place VMs on (host, datastore) pairs.
+
+    A request is a dict:
+        {'num_cpu': 2, 'memory_mb': 4096, 'disk_gb': 40,
+         'cluster': name, 'cluster_moid': moid,          # optional filter
+         'host_moid': moid, 'datastore_moid': moid,      # optional pin
+         'anti_affinity': group name}                    # optional
+    A placement is a dict with host/datastore/cluster names and moids, the
+    host and datastore morefs when known, and the score.
+    @ parameters:
+    @@ hosts/datastores/clusters: sync dicts (keyed or lists), e.g. from
+       SyncScheduler.inventory() or sync_utils parsers
+    @@ strict_anti_affinity: never put two members of a group on one host
+    """
+    def __init__(self, hosts, datastores, clusters=None, weights=None,
+                 vcpu_demand=DEFAULT_VCPU_DEMAND, ds_min_free=DEFAULT_DS_MIN_FREE,
+                 mem_headroom=DEFAULT_MEM_HEADROOM, strict_anti_affinity=True):
+        self.si = None
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.vcpu_demand = vcpu_demand
+        self.ds_min_free = ds_min_free
+        self.mem_headroom = mem_headroom
+        self.strict_anti_affinity = strict_anti_affinity
+        self._lock = threading.Lock()
+        # anti-affinity group -> {host moid: members}
+        self._groups = {}
+        self.update(hosts, datastores, clusters)
+
+    @classmethod
+    def collect(cls, si, **kwargs):
+        """
+        Build an engine from one property collection per object type
+        """
+        engine = cls([], [], **kwargs)
+        engine.si = si
+        engine.refresh()
+        return engine
+
+    def refresh(self):
+        """
+        Re-collect the capacity data, drops the in-memory reservations
+        """
+        if self.si is None:
+            raise Exception("Placement engine has no vCenter connection to refresh from!")
+        collected = {}
+        for (name, vim_type, path_set) in (
+                ('host', vim.HostSystem, PLACEMENT_HOST_PROPERTIES),
+                ('datastore', vim.Datastore, PLACEMENT_DATASTORE_PROPERTIES),
+                ('cluster', vim.ClusterComputeResource, PLACEMENT_CLUSTER_PROPERTIES)):
+            view_ref = pchm.get_container_view(self.si, [vim_type])
+            try:
+                obj_contents = pchm.collect_properties(self.si, view_ref, vim_type, path_set)
+            finally:
+                pchm.destroy_container_view(view_ref)
+            collected[name] = pchm.parse_properties(obj_contents, include_mors=True)
+        clusters = sync_utils.parse_cluster_dicts(
+            [dict((k, v) for k, v in c.items() if k != 'obj') for c in collected['cluster']])
+        self.update(collected['host'], collected['datastore'], clusters)
+
+    def update(self, hosts, datastores, clusters=None):
+        """
+        Replace the capacity data, drops the in-memory reservations
+        """
+        host_cluster = {}
+        for c in _values(clusters):
+            for host in c.get('host') or []:
+                host_cluster[_moid(host)] = c
+        with self._lock:
+            self._hosts = [_Host(h, host_cluster.get(h['moid'])) for h in _values(hosts)]
+            self._datastores = dict((d['moid'], _Datastore(d)) for d in _values(datastores))
+            self.updated_at = time.time()
+
+    def age(self):
+        return time.time() - self.updated_at
+
+    def find_moid(self, obj_type, name):
+        """
+        Return the moid of the host/datastore called name, None if unknown
+        """
+        if not name:
+            return None
+        with self._lock:
+            objs = self._hosts if obj_type == 'host' else self._datastores.values()
+            for obj in objs:
+                if obj.name == name:
+                    return obj.moid
+        return None
+
+    def add_to_group(self, group, host_moids):
+        """
+        Seed an anti-affinity group with the hosts of its existing members
+        """
+        with self._lock:
+            members = self._groups.setdefault(group, {})
+            for moid in host_moids:
+                members[moid] = members.get(moid, 0) + 1
+
+    def place(self, request):
+        """
+        Place one request and reserve its resources, raise if nothing fits
+        """
+        with self._lock:
+            return self._place(request)
+
+    def place_batch(self, requests):
+        """
+        Place requests in order, a request that does not fit gets {'error': msg}
+        """
+        placements = []
+        with self._lock:
+            for request in requests:
+                try:
+                    placements.append(self._place(request))
+                except Exception as ex:
+                    placements.append({'error': str(ex)})
+        return placements
+
+    def release(self, placement):
+        """
+        Give back the resources of a placement that was not used
+        """
+        if not placement or 'error' in placement:
+            return
+        (host, ds, cpu, mem, disk, group) = placement.pop('_reservation')
+        with self._lock:
+            host.cpu_used -= cpu
+            host.mem_used -= mem
+            host.n_vms -= 1
+            ds.free += disk
+            if group:
+                members = self._groups.get(group, {})
+                members[host.moid] = max(0, members.get(host.moid, 0) - 1)
+
+    def _place(self, request):
+        cpu = (request.get('num_cpu') or 1) * self.vcpu_demand
+        mem = request.get('memory_mb') or 0
+        disk = (request.get('disk_gb') or 0) * 1024 ** 3
+        group = request.get('anti_affinity')
+        members = self._groups.get(group, {}) if group else {}
+        cluster_name = request.get('cluster')
+        cluster_moid = request.get('cluster_moid')
+        pinned_host = request.get('host_moid')
+        pinned_ds = request.get('datastore_moid')
+
+        # datastore scores are shared by all hosts, computed once per request
+        ds_scores = {}
+        for ds in self._datastores.values():
+            if not ds.available or ds.capacity <= 0 or (pinned_ds and ds.moid != pinned_ds):
+                continue
+            free_after = ds.free - disk
+            if free_after < ds.capacity * self.ds_min_free:
+                continue
+            ds_scores[ds.moid] = self.weights['datastore'] * free_after / ds.capacity
+
+        max_vms = max([h.n_vms for h in self._hosts] + [1])
+        best = None
+        for host in self._hosts:
+            if not host.available or (pinned_host and host.moid != pinned_host):
+                continue
+            if cluster_name and host.cluster.get('name') != cluster_name:
+                continue
+            if cluster_moid and host.cluster.get('moid') != cluster_moid:
+                continue
+            if members.get(host.moid) and self.strict_anti_affinity:
+                continue
+            mem_limit = host.mem_capacity * (1 - self.mem_headroom)
+            if host.cpu_capacity <= 0 or host.mem_capacity <= 0 or host.mem_used + mem > mem_limit:
+                continue
+            ds_candidates = [(ds_scores[m], m) for m in host.datastores if m in ds_scores]
+            if not ds_candidates:
+                continue
+            (ds_score, ds_moid) = max(ds_candidates)
+            cpu_mhz = cpu * host.cpu_mhz
+            score = (self.weights['cpu'] * max(0.0, 1 - (host.cpu_used + cpu_mhz) / host.cpu_capacity)
+                     + self.weights['memory'] * (1 - (host.mem_used + mem) / host.mem_capacity)
+                     + self.weights['vms'] * (1 - host.n_vms / max_vms)
+                     + ds_score
+                     - self.weights['affinity'] * members.get(host.moid, 0))
+            if best is None or score > best[0]:
+                best = (score, host, ds_moid, cpu_mhz)
+        if best is None:
+            raise Exception("No host and datastore fit the placement request: %s" % request)
+
+        (score, host, ds_moid, cpu_mhz) = best
+        ds = self._datastores[ds_moid]
+        host.cpu_used += cpu_mhz
+        host.mem_used += mem
+        host.n_vms += 1
+        ds.free -= disk
+        if group:
+            group_members = self._groups.setdefault(group, {})
+            group_members[host.moid] = group_members.get(host.moid, 0) + 1
+        return {'host_name': host.name, 'host_moid': host.moid, 'host_moref': host.obj,
+                'datastore_name': ds.name, 'datastore_moid': ds.moid, 'datastore_moref': ds.obj,
+                'cluster_name': host.cluster.get('name'), 'cluster_moid': host.cluster.get('moid'),
+                'score': score,
+                '_reservation': (host, ds, cpu_mhz, mem, disk, group)}
@@ -0,0 +1,246 @@
+# -*- coding:utf-8 -*-
+"""
+Per-VM reconfigure coalescing queue.
+
+vCenter runs the tasks of one VM one after the other, so concurrent
+ReconfigVM_Task calls against the same VM only wait on each other. The
+queue collects the ConfigSpecs submitted for a VM during a short window,
+merges them into one ConfigSpec and submits a single reconfigure task whose
+moref is handed back to every caller.
+
+A request for a VM nothing was submitted for during the last window goes
+out at once; only requests following it within the window are held back
+and coalesced. A merged task is waited for before it is handed out: when it
+fails, every request is submitted again on its own, so one bad request does
+not fail the others.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from .lazy import vim
+
+from . import slot_allocator
+from . import task_utils
+from . import utils
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 0.2
+
+
+class _Pending(object):
+    def __init__(self, config_spec):
+        self.config_spec = config_spec
+        self.done = threading.Event()
+        self.task = None
+        self.error = None
+
+
+class ReconfigQueue(object):
+    """
+    The first caller for a VM submits right away, unless the VM had a
+    submission less than `window` seconds ago: then it waits out the window
+    for other callers of the same VM, and merges and submits everything
+    collected so far.
+    slot_allocators: slot_allocator.SlotAllocatorRegistry, saves reading the
+                     device list when disk adds are merged
+    """
+    def __init__(self, window=DEFAULT_WINDOW, slot_allocators=None):
+        self.window = window
+        self.slot_allocators = slot_allocators
+        self._lock = threading.Lock()
+        self._pending = {}
+        # moid -> time of the vm's last submission
+        self._submitted = {}
+
+    def submit(self, vm_moref, config_spec):
+        """
+        Queue config_spec for vm_moref, return the (shared) reconfigure task
+        """
+        moid = vm_moref._moId
+        pending = _Pending(config_spec)
+        with self._lock:
+            batch = self._pending.get(moid)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._pending[moid] = []
+            batch.append(pending)
+            if is_leader:
+                delay = self._delay(moid)
+
+        if is_leader:
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                batch = self._pending.pop(moid)
+                self._submitted[moid] = time.time()
+            self._run(vm_moref, batch)
+        else:
+            pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.task
+
+    def _delay(self, moid):
+        """ seconds the leader of moid waits for followers, under _lock """
+        now = time.time()
+        for (key, submitted) in list(self._submitted.items()):
+            if now - submitted >= self.window:
+                del self._submitted[key]
+        submitted = self._submitted.get(moid)
+        if submitted is None:
+            return 0
+        return self.window - (now - submitted)
+
+    def _run(self, vm_moref, batch):
+        try:
+            if len(batch) == 1:
+                self._run_one(vm_moref, batch[0])
+                return
+            LOG.debug("coalescing %d reconfigure requests of vm %s"
+                      % (len(batch), vm_moref._moId))
+            saved = _save_disk_slots([p.config_spec for p in batch])
+            try:
+                config_spec = merge_config_specs(vm_moref, [p.config_spec for p in batch],
+                                                 self.slot_allocators)
+                task = task_utils.reconfig_vm_task(vm_moref, config_spec)
+                (state, result) = utils.wait_for_task(task)
+            except Exception as ex:
+                LOG.exception(ex)
+                state = 1
+            if state == 0:
+                for p in batch:
+                    p.task = task
+                return
+            LOG.warning("merged reconfigure of vm %s failed, submitting the %d requests "
+                        "one by one" % (vm_moref._moId, len(batch)))
+            _restore_disk_slots(saved)
+            for p in batch:
+                self._run_one(vm_moref, p)
+        finally:
+            for p in batch:
+                p.done.set()
+
+    def _run_one(self, vm_moref, pending):
+        try:
+            pending.task = task_utils.reconfig_vm_task(vm_moref, pending.config_spec)
+        except Exception as ex:
+            LOG.exception(ex)
+            pending.error = ex
+
+
+def _save_disk_slots(config_specs):
+    """ the slot fields of the added disks, which merging may move """
+    return [(dc.device, dc.device.controllerKey, dc.device.unitNumber, dc.device.key)
+            for spec in config_specs for dc in spec.deviceChange
+            if dc.operation == 'add' and isinstance(dc.device, vim.vm.device.VirtualDisk)]
+
+
+def _restore_disk_slots(saved):
+    for (dev, controller_key, unit_number, key) in saved:
+        dev.controllerKey = controller_key
+        dev.unitNumber = unit_number
+        dev.key = key
+
+
+def _is_unset(value):
+    # list properties default to [] rather than None
+    return value is None or (isinstance(value, list) and not value)
+
+
+def merge_config_specs(vm_moref, config_specs, slot_allocators=None):
+    """
+    Merge several vim.vm.ConfigSpec of one vm into one.
+    - plain properties: the later spec wins
+    - extraConfig: merged by key, the later value wins
+    - deviceChange: duplicate controller adds and duplicate removes are
+      dropped, disks added on an already used controller/unit slot are moved
+      to a free unit of the same controller
+    """
+    merged = vim.vm.ConfigSpec()
+    extra_config = {}
+    device_changes = []
+    for spec in config_specs:
+        for prop in spec._GetPropertyList():
+            if prop.name in ('deviceChange', 'extraConfig'):
+                continue
+            value = getattr(spec, prop.name)
+            if _is_unset(value):
+                continue
+            current = getattr(merged, prop.name)
+            if not _is_unset(current) and current != value:
+                LOG.warning("Conflicting reconfigure property %s, the later one wins" % prop.name)
+            setattr(merged, prop.name, value)
+        for opt in spec.extraConfig:
+            extra_config.pop(opt.key, None)
+            extra_config[opt.key] = opt
+        device_changes.append(list(spec.deviceChange))
+    merged.extraConfig = list(extra_config.values())
+    merged.deviceChange = _merge_device_changes(vm_moref, device_changes, slot_allocators)
+    return merged
+
+
+def _is_scsi_controller(dev):
+    return isinstance(dev, vim.vm.device.VirtualSCSIController)
+
+
+def _merge_device_changes(vm_moref, device_changes, slot_allocators=None):
+    has_adds = any(dc.operation == 'add' and isinstance(dc.device, vim.vm.device.VirtualDisk)
+                   for changes in device_changes for dc in changes)
+    slots = None
+    if has_adds and slot_allocators is not None:
+        # the slots the requests reserved are theirs, only used slots conflict
+        slots = slot_allocators.get(vm_moref).copy_used()
+    elif has_adds:
+        slots = slot_allocator.SlotAllocator.from_devices(vm_moref.config.hardware.device)
+
+    merged = []
+    removed_keys = set()
+    controller_keys = {}      # busNumber -> key of the controller being added
+    added_buses = {}          # key of a controller being added -> busNumber
+
+    def bus_number(controller_key):
+        bus = slots.bus_number(controller_key)
+        return added_buses.get(controller_key) if bus is None else bus
+
+    for changes in device_changes:
+        key_map = {}
+        for dc in changes:
+            dev = dc.device
+            if dc.operation == 'remove':
+                if dev.key in removed_keys:
+                    continue
+                removed_keys.add(dev.key)
+                if slots and isinstance(dev, vim.vm.device.VirtualDisk):
+                    bus = bus_number(dev.controllerKey)
+                    if bus is not None:
+                        slots.release((bus, dev.unitNumber))
+            elif dc.operation == 'add' and _is_scsi_controller(dev):
+                if dev.busNumber in controller_keys:
+                    # another request already adds this controller
+                    key_map[dev.key] = controller_keys[dev.busNumber]
+                    continue
+                controller_keys[dev.busNumber] = dev.key
+                added_buses[dev.key] = dev.busNumber
+            elif dc.operation == 'add' and isinstance(dev, vim.vm.device.VirtualDisk):
+                dev.controllerKey = key_map.get(dev.controllerKey, dev.controllerKey)
+                bus = bus_number(dev.controllerKey)
+                if bus is None:
+                    LOG.warning("Disk added on unknown controller %s, slot not checked"
+                                % dev.controllerKey)
+                elif slots.is_free(bus, dev.unitNumber):
+                    slots.reserve(bus, dev.unitNumber)
+                else:
+                    (bus, unit) = slots.reserve(bus)
+                    LOG.warning("Disk slot %s:%s is already used, moved to unit %s"
+                                % (bus, dev.unitNumber, unit))
+                    if dev.key == 2000 + bus * 16 + dev.unitNumber:
+                        dev.key = 2000 + bus * 16 + unit
+                    dev.unitNumber = unit
+            merged.append(dc)
+    return merged
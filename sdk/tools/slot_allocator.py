@@ -0,0 +1,240 @@
+# -*- coding:utf-8 -*-
+"""
+In-memory SCSI disk slot allocator.
+
+Every controller bus is a 16 bit bitmap of used unit numbers, with unit 7
+always taken by the controller itself. Slots go through reserve -> commit
+(attach task succeeded) or reserve -> release (attach failed), so parallel
+attach workflows on one VM never pick the same slot. The allocator also
+keeps the VM's SCSI controllers, so the attach/detach specs are built
+without reading the device list. The registry checks the VM's
+config.changeVersion on every get and re-reads the device list only when
+the VM changed since the allocator was built.
+"""
+from __future__ import absolute_import
+
+import threading
+
+from .lazy import vim
+
+from . import pchm
+
+
+SCSI_MAX_BUS = 4
+SCSI_MAX_UNIT = 16
+# unitNumber 7 reserved for scsi controller
+SCSI_RESERVED_UNIT = 7
+
+_FULL_MASK = (1 << SCSI_MAX_UNIT) - 1
+_RESERVED_MASK = 1 << SCSI_RESERVED_UNIT
+
+
+def parse_vdev_node(vdev_node):
+    """ '1:3' -> (1, 3) """
+    (bus, unit) = vdev_node.split(':')
+    return (int(bus), int(unit))
+
+
+def format_vdev_node(slot):
+    """ (1, 3) -> '1:3' """
+    return "%d:%d" % slot
+
+
+class SlotAllocator(object):
+    """
+    Free SCSI slots of one vm.
+    @ parameters:
+    @@ used: iterable of (bus_number, unit_number) already taken
+    @@ controllers: the vm's vim.vm.device.VirtualSCSIController devices
+    @@ change_version: config.changeVersion the slots were read at
+    """
+    def __init__(self, used=None, controllers=None, change_version=None):
+        self._used = [_RESERVED_MASK] * SCSI_MAX_BUS
+        self._reserved = [0] * SCSI_MAX_BUS
+        self._lock = threading.Lock()
+        self._controllers = list(controllers or [])
+        self.change_version = change_version
+        for (bus, unit) in used or []:
+            if 0 <= bus < SCSI_MAX_BUS and 0 <= unit < SCSI_MAX_UNIT:
+                self._used[bus] |= 1 << unit
+
+    @classmethod
+    def from_devices(cls, devices, change_version=None):
+        """
+        Build from vim.vm.device.VirtualDevice[] (config.hardware.device)
+        """
+        controllers = [dev for dev in devices
+                       if isinstance(dev, vim.vm.device.VirtualSCSIController)]
+        bus_numbers = dict((dev.key, dev.busNumber) for dev in controllers)
+        used = [(bus_numbers[dev.controllerKey], dev.unitNumber) for dev in devices
+                if isinstance(dev, vim.vm.device.VirtualDisk)
+                and dev.controllerKey in bus_numbers]
+        return cls(used, controllers, change_version)
+
+    def scsi_controllers(self):
+        """
+        The vm's SCSI controller devices (a new list, callers may append)
+        """
+        return list(self._controllers)
+
+    def bus_number(self, controller_key):
+        """
+        Bus number of the controller with key controller_key, None if unknown
+        """
+        for dev in self._controllers:
+            if dev.key == controller_key:
+                return dev.busNumber
+        return None
+
+    def n_disks(self, bus):
+        """
+        Number of disks on bus, not counting reservations
+        """
+        with self._lock:
+            return bin(self._used[bus] & ~_RESERVED_MASK).count('1')
+
+    def copy_used(self):
+        """
+        A new allocator with the used slots and controllers of this one
+        and no reservations
+        """
+        with self._lock:
+            copy = SlotAllocator(controllers=self._controllers,
+                                 change_version=self.change_version)
+            copy._used = list(self._used)
+        return copy
+
+    def _carry_reservations(self, other):
+        # the slots reserved on other, whose tasks are still running
+        with other._lock:
+            reserved = list(other._reserved)
+        with self._lock:
+            self._reserved = [a | b for (a, b) in zip(self._reserved, reserved)]
+
+    def _lowest_free(self, bus):
+        free = ~(self._used[bus] | self._reserved[bus]) & _FULL_MASK
+        if not free:
+            return None
+        return (free & -free).bit_length() - 1
+
+    def _check_bus(self, bus):
+        if not 0 <= bus < SCSI_MAX_BUS:
+            raise Exception("Invalid SCSI bus number %s, must be 0 to %d !"
+                            % (bus, SCSI_MAX_BUS - 1))
+
+    def is_free(self, bus, unit):
+        self._check_bus(bus)
+        with self._lock:
+            return not ((self._used[bus] | self._reserved[bus]) >> unit) & 1
+
+    def reserve(self, bus=None, unit=None):
+        """
+        Reserve a slot, the exact one when bus and unit are given, otherwise
+        the lowest free unit (of bus, or of any bus).
+        @ return: (bus_number, unit_number)
+        """
+        with self._lock:
+            if bus is not None and unit is not None:
+                if not 0 <= bus < SCSI_MAX_BUS or not 0 <= unit < SCSI_MAX_UNIT:
+                    raise Exception("Invalid SCSI slot %d:%d !" % (bus, unit))
+                if ((self._used[bus] | self._reserved[bus]) >> unit) & 1:
+                    raise Exception("SCSI slot %d:%d is already in use !" % (bus, unit))
+                self._reserved[bus] |= 1 << unit
+                return (bus, unit)
+            if bus is not None:
+                self._check_bus(bus)
+            buses = [bus] if bus is not None else range(SCSI_MAX_BUS)
+            for b in buses:
+                u = self._lowest_free(b)
+                if u is not None:
+                    self._reserved[b] |= 1 << u
+                    return (b, u)
+        raise Exception("No SCSI controllers are available !")
+
+    def commit(self, slot):
+        """
+        The reserved slot now holds a disk
+        """
+        (bus, unit) = slot
+        with self._lock:
+            self._reserved[bus] &= ~(1 << unit)
+            self._used[bus] |= 1 << unit
+
+    def release(self, slot):
+        """
+        Give a reserved slot back, or free the slot of a removed disk
+        """
+        (bus, unit) = slot
+        if unit == SCSI_RESERVED_UNIT:
+            return
+        with self._lock:
+            self._reserved[bus] &= ~(1 << unit)
+            self._used[bus] &= ~(1 << unit)
+
+    def free_slots(self):
+        with self._lock:
+            return [(b, u) for b in range(SCSI_MAX_BUS) for u in range(SCSI_MAX_UNIT)
+                    if not ((self._used[b] | self._reserved[b]) >> u) & 1]
+
+
+class SlotAllocatorRegistry(object):
+    """
+    One SlotAllocator per vm, rebuilt from the vm's device list when the
+    vm's config.changeVersion moved. Slots reserved for running tasks are
+    carried over to the rebuilt allocator.
+    """
+    def __init__(self, si):
+        self.si = si
+        self._allocators = {}
+        self._lock = threading.Lock()
+
+    def get(self, vm_moref):
+        moid = vm_moref._moId
+        with self._lock:
+            allocator = self._allocators.get(moid)
+        if allocator is not None:
+            props = pchm.get_object_properties(self.si, vm_moref, ['config.changeVersion'])
+            if props.get('config.changeVersion') == allocator.change_version:
+                return allocator
+        props = pchm.get_object_properties(self.si, vm_moref,
+                                           ['config.changeVersion', 'config.hardware.device'])
+        fresh = SlotAllocator.from_devices(props.get('config.hardware.device') or [],
+                                           props.get('config.changeVersion'))
+        with self._lock:
+            current = self._allocators.get(moid)
+            if current is not None:
+                fresh._carry_reservations(current)
+            self._allocators[moid] = fresh
+        return fresh
+
+    def peek(self, moid):
+        """
+        The allocator of a vm if already built, None otherwise
+        """
+        with self._lock:
+            return self._allocators.get(moid)
+
+    def commit(self, moid, slots):
+        """
+        The attach task of the reserved slots succeeded
+        """
+        allocator = self.peek(moid)
+        if allocator is not None:
+            for slot in slots:
+                allocator.commit(slot)
+
+    def release(self, moid, slots):
+        """
+        Give back reserved slots, or free the slots of detached disks
+        """
+        allocator = self.peek(moid)
+        if allocator is not None:
+            for slot in slots:
+                allocator.release(slot)
+
+    def invalidate(self, moid):
+        """
+        Forget a vm, e.g. after a failed reconfigure, it is rebuilt on next use
+        """
+        with self._lock:
+            self._allocators.pop(moid, None)
@@ -0,0 +1,351 @@
+# -*- coding:utf-8 -*-
+"""
+SOAP round trip accounting.
+
+instrument_stub patches a session's SOAP stub (si._stub) so that every
+round trip is recorded: count, errors, bytes sent/received and a latency
+histogram. Each call is attributed to the operation that issued it, the
+outermost SoapMetrics.operation scope on the calling thread. instrument_object
+opens such a scope around the public methods of one object, e.g. a
+VMwareClient. Shared modules are not patched: code calling sync_utils/vmops
+directly opens its own scope with `with metrics.operation(name):`.
+
+Lazy attribute reads (vm.summary.config.name) are one RetrieveContents round
+trip each. They are recorded as kind 'property' under the managed object
+type and property name, so an operation whose round trips per run grow with
+the inventory shows up in snapshot().
+
+Calls made on worker threads are attributed only when the function was
+wrapped with bind() on the thread that opened the operation.
+"""
+from __future__ import absolute_import, division
+
+import functools
+import inspect
+import threading
+import time
+
+
+# latency histogram bucket upper bounds, milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+UNATTRIBUTED = '<unattributed>'
+
+_local = threading.local()
+
+
+def _operation_stack():
+    stack = getattr(_local, 'operations', None)
+    if stack is None:
+        stack = _local.operations = []
+    return stack
+
+
+def current_operation():
+    """
+    The outermost operation of the calling thread, None outside any operation
+    """
+    stack = _operation_stack()
+    return stack[0] if stack else None
+
+
+def bind(fn):
+    """
+    Wrap fn so it runs in the operations of the calling thread, for
+    functions submitted to a thread pool
+    """
+    operations = list(_operation_stack())
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        saved = getattr(_local, 'operations', None)
+        _local.operations = list(operations)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.operations = saved
+    return wrapper
+
+
+class Histogram(object):
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for (i, bound) in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        n = sum(self.counts)
+        buckets = [[bound, count] for (bound, count) in zip(self.bounds, self.counts)]
+        buckets.append(['inf', self.counts[-1]])
+        return {'count': n, 'total_ms': self.total, 'max_ms': self.max,
+                'avg_ms': self.total / n if n else 0.0, 'buckets': buckets}
+
+
+class _CallStats(object):
+    def __init__(self, kind):
+        self.kind = kind
+        self.count = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        return {'kind': self.kind, 'count': self.count, 'errors': self.errors,
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                'latency': self.latency.snapshot()}
+
+
+class _OperationStats(object):
+    def __init__(self):
+        self.runs = 0
+        self.duration = Histogram()
+        # call name -> _CallStats
+        self.calls = {}
+
+    def snapshot(self):
+        calls = dict((name, stats.snapshot()) for (name, stats) in self.calls.items())
+        round_trips = sum(c['count'] for c in calls.values())
+        return {'runs': self.runs,
+                'duration': self.duration.snapshot(),
+                'round_trips': round_trips,
+                'property_reads': sum(c['count'] for c in calls.values()
+                                      if c['kind'] == 'property'),
+                'round_trips_per_run': round_trips / self.runs if self.runs else None,
+                'bytes_sent': sum(c['bytes_sent'] for c in calls.values()),
+                'bytes_received': sum(c['bytes_received'] for c in calls.values()),
+                'calls': calls}
+
+
+class SoapMetrics(object):
+    """
+    Per operation SOAP call statistics, see snapshot()
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # operation name -> _OperationStats
+        self._operations = {}
+
+    def _operation_stats(self, operation):
+        stats = self._operations.get(operation)
+        if stats is None:
+            stats = self._operations[operation] = _OperationStats()
+        return stats
+
+    def record_call(self, operation, name, kind, seconds, bytes_sent=0,
+                    bytes_received=0, error=False):
+        with self._lock:
+            calls = self._operation_stats(operation or UNATTRIBUTED).calls
+            stats = calls.get(name)
+            if stats is None:
+                stats = calls[name] = _CallStats(kind)
+            stats.count += 1
+            stats.errors += 1 if error else 0
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.latency.observe(seconds * 1000.0)
+
+    def record_run(self, operation, seconds):
+        with self._lock:
+            stats = self._operation_stats(operation)
+            stats.runs += 1
+            stats.duration.observe(seconds * 1000.0)
+
+    def operation(self, name):
+        """
+        Context manager: SOAP calls of this thread inside it are attributed to
+        name, unless an enclosing operation is already open
+        """
+        return _Operation(self, name)
+
+    def snapshot(self):
+        """
+        {'buckets_ms', 'operations': {operation: {'runs', 'duration',
+         'round_trips', 'property_reads', 'round_trips_per_run',
+         'bytes_sent', 'bytes_received', 'calls': {call name: {'kind',
+         'count', 'errors', 'bytes_sent', 'bytes_received', 'latency'}}}}}
+        """
+        with self._lock:
+            operations = dict((name, stats.snapshot())
+                              for (name, stats) in self._operations.items())
+        return {'buckets_ms': list(LATENCY_BUCKETS_MS), 'operations': operations}
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+
+class _Operation(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self._started = None
+
+    def __enter__(self):
+        _operation_stack().append(self.name)
+        self._started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stack = _operation_stack()
+        stack.pop()
+        if not stack:
+            self.metrics.record_run(self.name, time.time() - self._started)
+        return False
+
+
+def _type_name(mo):
+    return getattr(type(mo), '_wsdlName', None) or type(mo).__name__
+
+
+class _StubCall(object):
+    """ bytes of the round trip in flight on this thread """
+    def __init__(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+def _stub_chain(stub):
+    # a SessionOrientedStub forwards to the SoapStubAdapter in soapStub
+    stubs = []
+    while stub is not None and not any(stub is s for s in stubs):
+        stubs.append(stub)
+        stub = getattr(stub, 'soapStub', None)
+    return stubs
+
+
+def _timed_call(metrics, name, kind, fn, *args, **kwargs):
+    if getattr(_local, 'call', None) is not None:
+        # a property read issues its RetrieveContents through InvokeMethod,
+        # it is one round trip
+        return fn(*args, **kwargs)
+    call = _local.call = _StubCall()
+    started = time.time()
+    error = False
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        error = True
+        raise
+    finally:
+        _local.call = None
+        metrics.record_call(current_operation(), name, kind, time.time() - started,
+                            call.bytes_sent, call.bytes_received, error)
+
+
+def _count_received(read):
+    @functools.wraps(read)
+    def wrapper(*args, **kwargs):
+        data = read(*args, **kwargs)
+        call = getattr(_local, 'call', None)
+        if call is not None and data:
+            call.bytes_received += len(data)
+        return data
+    return wrapper
+
+
+def instrument_stub(stub, metrics):
+    """
+    Record every round trip of stub (e.g. si._stub) into metrics.
+    Returns metrics; uninstrument_stub undoes it.
+    """
+    for s in _stub_chain(stub):
+        if '_soap_metrics' in vars(s):
+            continue
+        patched = {}
+
+        def invoke_method(mo, info, *args, **kwargs):
+            name = "%s.%s" % (_type_name(mo), getattr(info, 'wsdlName', None) or info.name)
+            return _timed_call(metrics, name, 'method', invoke_method.orig,
+                               mo, info, *args, **kwargs)
+
+        def invoke_accessor(mo, info, *args, **kwargs):
+            name = "%s.%s" % (_type_name(mo), info.name)
+            return _timed_call(metrics, name, 'property', invoke_accessor.orig,
+                               mo, info, *args, **kwargs)
+
+        def serialize_request(*args, **kwargs):
+            request = serialize_request.orig(*args, **kwargs)
+            call = getattr(_local, 'call', None)
+            if call is not None and request:
+                call.bytes_sent += len(request)
+            return request
+
+        def get_connection(*args, **kwargs):
+            conn = get_connection.orig(*args, **kwargs)
+            if not getattr(conn, '_soap_metrics', False):
+                getresponse = conn.getresponse
+
+                def counted_getresponse(*a, **kw):
+                    response = getresponse(*a, **kw)
+                    response.read = _count_received(response.read)
+                    return response
+                conn.getresponse = counted_getresponse
+                conn._soap_metrics = True
+            return conn
+
+        for (attr, wrapper) in (('InvokeMethod', invoke_method),
+                                ('InvokeAccessor', invoke_accessor),
+                                ('SerializeRequest', serialize_request),
+                                ('GetConnection', get_connection)):
+            orig = getattr(s, attr, None)
+            if orig is None:
+                continue
+            wrapper.orig = orig
+            patched[attr] = orig
+            setattr(s, attr, wrapper)
+        s._soap_metrics = (metrics, patched)
+    return metrics
+
+
+def uninstrument_stub(stub):
+    for s in _stub_chain(stub):
+        state = vars(s).pop('_soap_metrics', None)
+        if state is None:
+            continue
+        for attr in state[1]:
+            # drop the instance attribute, the class method shows through again
+            vars(s).pop(attr, None)
+
+
+def _operation_wrapper(metrics, name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with metrics.operation(name):
+            return fn(*args, **kwargs)
+    wrapper._soap_metrics_orig = fn
+    return wrapper
+
+
+def instrument_object(obj, metrics, prefix=None, names=None, exclude=()):
+    """
+    Open an operation named "<prefix>.<method>" around the public methods of
+    obj (default prefix: its class name). Only obj is changed, not its class.
+    """
+    prefix = prefix or type(obj).__name__
+    for name in names or dir(type(obj)):
+        if (name.startswith('_') or name in exclude or name in vars(obj)
+                or not inspect.isfunction(getattr(type(obj), name, None))):
+            continue
+        setattr(obj, name, _operation_wrapper(metrics, "%s.%s" % (prefix, name),
+                                              getattr(obj, name)))
+    return obj
+
+
+def uninstrument(obj):
+    """
+    Undo instrument_object on obj
+    """
+    for (name, value) in list(vars(obj).items()):
+        if getattr(value, '_soap_metrics_orig', None) is not None:
+            delattr(obj, name)
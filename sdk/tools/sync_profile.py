@@ -0,0 +1,317 @@
+# -*- coding:utf-8 -*-
+"""
+Opt-in phase profiling of inventory syncs.
+
+sync_utils marks its phases per object type: collect (container view and
+RetrieveContents, i.e. the remote call plus pyVmomi deserialization), parse
+(parse_*_properties, with the VM device/NIC parsing also timed on its own as
+parse.devices) and link (hosts -> vms, dc/cluster -> resources). Outside of
+profiling() the marks are no-ops.
+
+    with sync_profile.profiling(si, report_dir='/var/log/sync', cprofile=True) as profile:
+        sync_utils.get_vc_all_properties(si)
+    profile.report()
+
+When si is given, the time spent waiting for vCenter responses is measured
+too, so every phase reports remote_seconds (waiting for the response
+headers) and local_seconds (the rest: serialization, reading and
+deserializing the body, Python work). Round trips issued from parse (lazy
+attribute reads) show up in its round_trips.
+
+Each run writes sync-<time>-<pid>.json (and .prof with cprofile) to
+report_dir.
+"""
+from __future__ import absolute_import, division
+
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+REPORT_VERSION = 1
+DEFAULT_HOTSPOTS = 30
+
+_local = threading.local()
+
+
+class _NoopPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_PHASE = _NoopPhase()
+
+
+def active_profile():
+    return getattr(_local, 'profile', None)
+
+
+def phase(obj_type, name):
+    """
+    Context manager timing phase name of obj_type in the active profile
+    """
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return _NOOP_PHASE
+    return _Phase(profile, obj_type, name)
+
+
+def count(obj_type, obj_contents):
+    """
+    Count the objects and properties of a RetrieveContents result
+    """
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.count(obj_type, obj_contents)
+
+
+class _PhaseStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.remote_seconds = 0.0
+        self.round_trips = 0
+
+    def to_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds,
+                'remote_seconds': self.remote_seconds,
+                'local_seconds': max(0.0, self.seconds - self.remote_seconds),
+                'round_trips': self.round_trips}
+
+
+class _Phase(object):
+    def __init__(self, profile, obj_type, name):
+        self.profile = profile
+        self.stats = profile._phase_stats(obj_type, name)
+        self._started = None
+
+    def __enter__(self):
+        self.profile._open.append(self.stats)
+        self._started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stats.seconds += time.time() - self._started
+        self.stats.calls += 1
+        self.profile._open.remove(self.stats)
+        return False
+
+
+class SyncProfile(object):
+    """
+    Phase timings and object/property counts of one sync run
+    """
+    def __init__(self, name='sync'):
+        self.name = name
+        self.started = None
+        self.ended = None
+        # obj type -> phase name -> _PhaseStats
+        self._phases = {}
+        # obj type -> [objects, properties]
+        self._counts = {}
+        # phases open on the profiling thread, innermost last
+        self._open = []
+        self.round_trips = 0
+        self.remote_seconds = 0.0
+        self.cprofile_path = None
+        self.hotspots = None
+        self.error = None
+
+    def _phase_stats(self, obj_type, name):
+        phases = self._phases.setdefault(obj_type, {})
+        stats = phases.get(name)
+        if stats is None:
+            stats = phases[name] = _PhaseStats()
+        return stats
+
+    def count(self, obj_type, obj_contents):
+        counts = self._counts.setdefault(obj_type, [0, 0])
+        for obj in obj_contents or []:
+            counts[0] += 1
+            counts[1] += len(obj.propSet or [])
+
+    def add_remote(self, seconds):
+        """ one response waited for, charged to every open phase """
+        self.round_trips += 1
+        self.remote_seconds += seconds
+        for stats in self._open:
+            stats.round_trips += 1
+            stats.remote_seconds += seconds
+
+    def report(self):
+        """
+        {'version', 'name', 'started', 'seconds', 'round_trips', 'remote_seconds',
+         'unaccounted_seconds', 'types': {obj type: {'objects', 'properties',
+         'phases': {phase: {'calls', 'seconds', 'remote_seconds', 'local_seconds',
+         'round_trips'}}}}, 'cprofile', 'hotspots', 'error'}
+        """
+        seconds = ((self.ended or time.time()) - self.started) if self.started else 0.0
+        types = {}
+        accounted = 0.0
+        for obj_type in set(self._phases) | set(self._counts):
+            phases = dict((name, stats.to_dict())
+                          for (name, stats) in self._phases.get(obj_type, {}).items())
+            # nested phases (parse.devices) are already part of their parent
+            accounted += sum(p['seconds'] for (name, p) in phases.items() if '.' not in name)
+            (n_objects, n_properties) = self._counts.get(obj_type, (0, 0))
+            types[obj_type] = {'objects': n_objects, 'properties': n_properties,
+                               'phases': phases}
+        return {'version': REPORT_VERSION, 'name': self.name, 'started': self.started,
+                'seconds': seconds, 'round_trips': self.round_trips,
+                'remote_seconds': self.remote_seconds,
+                'unaccounted_seconds': max(0.0, seconds - accounted),
+                'types': types, 'cprofile': self.cprofile_path,
+                'hotspots': self.hotspots, 'error': self.error}
+
+
+def _hotspots(profiler, limit=DEFAULT_HOTSPOTS):
+    import pstats
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (func, (cc, nc, tottime, cumtime, _)) in stats.stats.items():
+        rows.append({'function': "%s:%d(%s)" % func, 'calls': nc,
+                     'tottime': tottime, 'cumtime': cumtime})
+    rows.sort(key=lambda r: r['tottime'], reverse=True)
+    return rows[:limit]
+
+
+def _wrap_connection(conn):
+    if getattr(conn, '_sync_profile', False):
+        return conn
+    getresponse = conn.getresponse
+
+    def timed_getresponse(*args, **kwargs):
+        profile = getattr(_local, 'profile', None)
+        if profile is None:
+            return getresponse(*args, **kwargs)
+        started = time.time()
+        try:
+            return getresponse(*args, **kwargs)
+        finally:
+            profile.add_remote(time.time() - started)
+    conn.getresponse = timed_getresponse
+    conn._sync_profile = True
+    return conn
+
+
+def _soap_stub(si):
+    stub = si._stub
+    # a SessionOrientedStub forwards to the SoapStubAdapter in soapStub
+    while getattr(stub, 'soapStub', None) is not None:
+        stub = stub.soapStub
+    return stub
+
+
+class ProfilingRun(object):
+    """
+    Context manager profiling the syncs run on this thread inside it.
+    @ parameters:
+    @@ si: service instance whose response wait time is measured, optional
+    @@ report_dir: directory the json report (and cProfile dump) of the run go to
+    @@ cprofile: also run cProfile, its top functions go to the report
+    """
+    def __init__(self, si=None, report_dir=None, cprofile=False, name='sync'):
+        self.si = si
+        self.report_dir = report_dir
+        self.cprofile = cprofile
+        self.profile = SyncProfile(name)
+        self.report_path = None
+        self._profiler = None
+        self._stub = None
+        self._saved = None
+
+    def _hook_stub(self):
+        stub = _soap_stub(self.si)
+        get_connection = getattr(stub, 'GetConnection', None)
+        if get_connection is None:
+            return
+        self._stub = stub
+        self._saved = vars(stub).get('GetConnection')
+
+        def profiled_get_connection(*args, **kwargs):
+            return _wrap_connection(get_connection(*args, **kwargs))
+        stub.GetConnection = profiled_get_connection
+
+    def _unhook_stub(self):
+        if self._stub is None:
+            return
+        if self._saved is None:
+            vars(self._stub).pop('GetConnection', None)
+        else:
+            self._stub.GetConnection = self._saved
+        self._stub = None
+
+    def __enter__(self):
+        if active_profile() is not None:
+            raise Exception("A sync profile is already active on this thread!")
+        if self.si is not None:
+            self._hook_stub()
+        _local.profile = self.profile
+        self.profile.started = time.time()
+        if self.cprofile:
+            # only profiled runs pay for the import
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self.profile
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._profiler is not None:
+            self._profiler.disable()
+        self.profile.ended = time.time()
+        _local.profile = None
+        self._unhook_stub()
+        if exc_type is not None:
+            self.profile.error = "%s: %s" % (exc_type.__name__, exc)
+        if self._profiler is not None:
+            self.profile.hotspots = _hotspots(self._profiler)
+        if self.report_dir:
+            try:
+                self.write(self.report_dir)
+            except Exception as ex:
+                # the sync result matters more than its report
+                LOG.exception(ex)
+        return False
+
+    def write(self, report_dir):
+        if not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+        base = os.path.join(report_dir, "%s-%s-%d" % (
+            self.profile.name, time.strftime('%Y%m%d-%H%M%S', time.localtime(self.profile.started)),
+            os.getpid()))
+        if self._profiler is not None:
+            self.profile.cprofile_path = base + '.prof'
+            self._profiler.dump_stats(self.profile.cprofile_path)
+        self.report_path = base + '.json'
+        with open(self.report_path, 'w') as f:
+            json.dump(self.profile.report(), f, indent=2, sort_keys=True)
+        return self.report_path
+
+
+def profiling(si=None, report_dir=None, cprofile=False, name='sync'):
+    """
+    with profiling(si, report_dir) as profile: ..., see ProfilingRun
+    """
+    return ProfilingRun(si, report_dir, cprofile, name)
+
+
+def profile_sync(si, sync_flat=None, report_dir=None, cprofile=False):
+    """
+    Run sync_utils.get_vc_properties(si, sync_flat) under profiling
+    @ return: ((dcs, template_vms), report dict)
+    """
+    # sync_utils imports this module
+    from . import sync_utils
+    if sync_flat is None:
+        sync_flat = sync_utils.SYNC_FLAT_ALL
+    with profiling(si, report_dir, cprofile) as profile:
+        result = sync_utils.get_vc_properties(si, sync_flat)
+    return (result, profile.report())
@@ -0,0 +1,319 @@
+# -*- coding:utf-8 -*-
+"""
+Multi-rate inventory sync.
+
+Every object type's path set is split into tiers, and each tier has its own
+refresh interval. Volatile properties (power state, quickStats, guest IP,
+datastore free space) are re-collected often, while static properties
+(hardware, LUN layout, folders) are collected rarely. Raw tier results are
+merged per object and parsed with the sync_utils parsers, so the inventory
+looks exactly like the one built by sync_utils.get_vc_properties.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from .lazy import vim
+
+from . import pchm
+from . import sync_utils
+
+
+LOG = logging.getLogger(__name__)
+
+VOLATILE_INTERVAL = 30
+STATIC_INTERVAL = 3600
+
+_HOST_VOLATILE = ['runtime.connectionState',
+                  'runtime.powerState',
+                  'summary.quickStats.overallMemoryUsage',
+                  'summary.quickStats.overallCpuUsage',
+                  'vm']
+_VM_VOLATILE = ['summary.runtime.host',
+                'summary.runtime.powerState',
+                'summary.storage.committed',
+                'summary.quickStats.overallCpuUsage',
+                'summary.quickStats.guestMemoryUsage',
+                'summary.quickStats.hostMemoryUsage',
+                'guest.guestState',
+                'guest.hostName',
+                'guest.ipAddress',
+                'guest.net',
+                'guest.toolsStatus',
+                'guest.toolsRunningStatus']
+_DATASTORE_VOLATILE = ['overallStatus',
+                       'summary.freeSpace',
+                       'summary.accessible']
+
+# object type: (managed object type name in vim, default path set, dict parser)
+# the vim types are looked up by name when used, see get_vim_type
+OBJ_TYPES = {
+    'datacenter': ('Datacenter', sync_utils._DATACENTER, sync_utils.parse_dc_dicts),
+    'cluster': ('ClusterComputeResource', sync_utils._CLUSTER, sync_utils.parse_cluster_dicts),
+    'datastore': ('Datastore', sync_utils._DATASTORE, sync_utils.parse_ds_dicts),
+    'network': ('Network', sync_utils._NETWORK, sync_utils.parse_pg_dicts),
+    'host': ('HostSystem', sync_utils._HOST, sync_utils.parse_host_dicts),
+    'vm': ('VirtualMachine', sync_utils._VM, sync_utils.parse_vm_dicts),
+}
+# parsed from more than the collected properties (the datacenter parser lists
+# the vm/host folders), re-parsed after every refresh
+_REPARSED_TYPES = ('datacenter',)
+
+
+def get_vim_type(obj_type):
+    return getattr(vim, OBJ_TYPES[obj_type][0])
+
+
+def _same_value(a, b):
+    """
+    Compare raw property values, data objects by their properties
+    """
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(_same_value(x, y) for (x, y) in zip(a, b))
+    if hasattr(a, '_moId'):
+        return a._moId == b._moId
+    if hasattr(a, '_GetPropertyList'):
+        return all(_same_value(getattr(a, p.name), getattr(b, p.name))
+                   for p in a._GetPropertyList())
+    return a == b
+
+
+class SyncTier(object):
+    """ A named subset of an object type's path set with its own interval
+    """
+    def __init__(self, name, interval, path_set):
+        self.name = name
+        self.interval = interval
+        self.path_set = list(path_set)
+
+
+def split_tiers(path_set, volatile, volatile_interval=VOLATILE_INTERVAL,
+                static_interval=STATIC_INTERVAL):
+    """
+    Split path_set into a 'volatile' and a 'static' tier
+    """
+    tiers = [SyncTier('volatile', volatile_interval,
+                      [p for p in path_set if p in volatile]),
+             SyncTier('static', static_interval,
+                      [p for p in path_set if p not in volatile])]
+    return [t for t in tiers if t.path_set]
+
+
+def default_tiers():
+    return {
+        'datacenter': [SyncTier('static', STATIC_INTERVAL, sync_utils._DATACENTER)],
+        'cluster': [SyncTier('static', STATIC_INTERVAL, sync_utils._CLUSTER)],
+        'network': [SyncTier('static', STATIC_INTERVAL, sync_utils._NETWORK)],
+        'datastore': split_tiers(sync_utils._DATASTORE, _DATASTORE_VOLATILE),
+        'host': split_tiers(sync_utils._HOST, _HOST_VOLATILE),
+        'vm': split_tiers(sync_utils._VM, _VM_VOLATILE),
+    }
+
+
+class SyncScheduler(object):
+    """
+    Refresh each tier on its own cadence and keep one merged inventory.
+
+    An object only shows up in the inventory once every tier of its type has
+    been collected for it. Objects first seen by a fast tier get their slow
+    tiers collected right away through a ListView over just those objects.
+    """
+    def __init__(self, si, tiers=None):
+        self.si = si
+        self.tiers = tiers or default_tiers()
+        for obj_type in self.tiers:
+            if obj_type not in OBJ_TYPES:
+                raise Exception("Unsupported sync object type: %s" % obj_type)
+        self._lock = threading.RLock()
+        # obj_type -> moid -> {path: raw value}
+        self._raw = dict((t, {}) for t in self.tiers)
+        # obj_type -> moid -> set(tier name)
+        self._seen = dict((t, {}) for t in self.tiers)
+        # obj_type -> moid -> managed object ref
+        self._refs = dict((t, {}) for t in self.tiers)
+        # obj_type -> moid -> parsed properties
+        self._parsed = dict((t, {}) for t in self.tiers)
+        self._dirty = dict((t, set()) for t in self.tiers)
+        # obj_type -> moid -> number of merges that changed the object
+        self._changes = dict((t, {}) for t in self.tiers)
+        # obj_type -> tier name -> last refresh timestamp
+        self._last_refresh = dict((t, {}) for t in self.tiers)
+
+    def _get_tier(self, obj_type, tier_name):
+        for tier in self.tiers[obj_type]:
+            if tier.name == tier_name:
+                return tier
+        raise Exception("Not found sync tier: %s/%s" % (obj_type, tier_name))
+
+    def due_tiers(self, now=None):
+        """
+        Return [(obj_type, tier_name)] whose interval has elapsed
+        """
+        now = now or time.time()
+        due = []
+        for obj_type, tiers in self.tiers.items():
+            for tier in tiers:
+                last = self._last_refresh[obj_type].get(tier.name)
+                if last is None or now - last >= tier.interval:
+                    due.append((obj_type, tier.name))
+        return due
+
+    def refresh(self, now=None, force=False):
+        """
+        Refresh every due tier (or every tier if force), return what ran
+        """
+        if force:
+            todo = [(t, tier.name) for t in self.tiers for tier in self.tiers[t]]
+        else:
+            todo = self.due_tiers(now)
+        for (obj_type, tier_name) in todo:
+            self.refresh_tier(obj_type, tier_name)
+        return todo
+
+    def refresh_tier(self, obj_type, tier_name):
+        tier = self._get_tier(obj_type, tier_name)
+        vim_type = get_vim_type(obj_type)
+        started = time.time()
+        view_ref = pchm.get_container_view(self.si, [vim_type])
+        try:
+            obj_contents = pchm.collect_properties(self.si, view_ref, vim_type,
+                                                   tier.path_set)
+        finally:
+            pchm.destroy_container_view(view_ref)
+
+        with self._lock:
+            present = self._merge(obj_type, tier, obj_contents)
+            # a container view returns every object, so anything missing is gone
+            for moid in list(self._raw[obj_type]):
+                if moid not in present:
+                    self._forget(obj_type, moid)
+            self._last_refresh[obj_type][tier.name] = started
+            n_tiers = len(self.tiers[obj_type])
+            new_refs = []
+            # before every tier has run once, the initial refreshes fill the gaps
+            if len(self._last_refresh[obj_type]) == n_tiers:
+                new_refs = [self._refs[obj_type][moid] for moid in present
+                            if len(self._seen[obj_type][moid]) < n_tiers]
+        if new_refs:
+            self._fill_tiers(obj_type, new_refs)
+        LOG.debug("sync tier %s/%s refreshed %d objects in %.3fs"
+                  % (obj_type, tier.name, len(present), time.time() - started))
+
+    def _fill_tiers(self, obj_type, obj_refs):
+        """
+        Collect the missing tiers of newly discovered objects only
+        """
+        vim_type = get_vim_type(obj_type)
+        list_ref = pchm.get_list_view(self.si, obj_refs)
+        try:
+            for tier in self.tiers[obj_type]:
+                obj_contents = pchm.collect_properties(self.si, list_ref, vim_type,
+                                                       tier.path_set)
+                with self._lock:
+                    self._merge(obj_type, tier, obj_contents)
+        finally:
+            pchm.destroy_container_view(list_ref)
+
+    def _merge(self, obj_type, tier, obj_contents):
+        present = set()
+        raw_objs = self._raw[obj_type]
+        for obj in obj_contents:
+            moid = obj.obj._moId
+            present.add(moid)
+            raw = raw_objs.setdefault(moid, {'moid': moid})
+            # unset properties are not returned, drop stale values of this tier
+            old = dict((path, raw.pop(path)) for path in tier.path_set if path in raw)
+            for prop in obj.propSet:
+                raw[prop.name] = prop.val
+            seen = self._seen[obj_type].setdefault(moid, set())
+            changed = (obj_type in _REPARSED_TYPES or tier.name not in seen
+                       or set(old) != set(p for p in tier.path_set if p in raw)
+                       or not all(_same_value(v, raw[p]) for (p, v) in old.items()))
+            seen.add(tier.name)
+            self._refs[obj_type][moid] = obj.obj
+            if changed:
+                self._dirty[obj_type].add(moid)
+                self._changes[obj_type][moid] = self._changes[obj_type].get(moid, 0) + 1
+        return present
+
+    def _forget(self, obj_type, moid):
+        self._raw[obj_type].pop(moid, None)
+        self._seen[obj_type].pop(moid, None)
+        self._refs[obj_type].pop(moid, None)
+        self._parsed[obj_type].pop(moid, None)
+        self._dirty[obj_type].discard(moid)
+        self._changes[obj_type].pop(moid, None)
+
+    def inventory(self):
+        """
+        Return {obj_type: {moid: properties}} for fully collected objects.
+        Only objects changed since the last call are re-parsed.
+        """
+        for obj_type in self.tiers:
+            parser = OBJ_TYPES[obj_type][2]
+            n_tiers = len(self.tiers[obj_type])
+            with self._lock:
+                dirty = [m for m in self._dirty[obj_type]
+                         if len(self._seen[obj_type].get(m, ())) == n_tiers]
+                raws = [dict(self._raw[obj_type][m]) for m in dirty]
+                changes = [self._changes[obj_type].get(m) for m in dirty]
+            if not dirty:
+                continue
+            # the datacenter parser reads the folders from vCenter
+            parsed = parser(raws, 'moid')
+            with self._lock:
+                for (moid, n_changes) in zip(dirty, changes):
+                    if moid not in self._raw[obj_type] or moid not in parsed:
+                        continue
+                    self._parsed[obj_type][moid] = parsed[moid]
+                    # changed again while parsing: stays dirty
+                    if self._changes[obj_type].get(moid) == n_changes:
+                        self._dirty[obj_type].discard(moid)
+        with self._lock:
+            return dict((t, dict(v)) for t, v in self._parsed.items())
+
+    def staleness(self, now=None):
+        """
+        Return {obj_type: {tier_name: seconds since refresh or None}}
+        """
+        now = now or time.time()
+        stale = {}
+        with self._lock:
+            for obj_type, tiers in self.tiers.items():
+                stale[obj_type] = {}
+                for tier in tiers:
+                    last = self._last_refresh[obj_type].get(tier.name)
+                    stale[obj_type][tier.name] = None if last is None else now - last
+        return stale
+
+    def get_vc_properties(self):
+        """
+        Same (dcs, templates) shape as sync_utils.get_vc_properties(sync_flat=0)
+        """
+        inv = self.inventory()
+        copies = dict((t, dict((m, dict(o)) for m, o in objs.items()))
+                      for t, objs in inv.items())
+        dcs = list(copies.get('datacenter', {}).values())
+        hosts = copies.get('host', {})
+        vms = copies.get('vm', {})
+        for hk, hv in hosts.items():
+            hv['vms'] = [vms[moid] for moid in hv.get('vm', []) if moid in vms]
+        sync_utils.link_dc_resources(dcs, copies.get('cluster', {}), hosts,
+                                     copies.get('datastore', {}), copies.get('network', {}))
+        templates = [vmv for vmv in vms.values() if vmv.get('config.template')]
+        return (dcs, templates)
+
+    def run(self, stop_event, tick=1):
+        """
+        Refresh due tiers until stop_event is set
+        """
+        while not stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as ex:
+                LOG.exception(ex)
+            stop_event.wait(tick)
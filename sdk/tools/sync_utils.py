@@ -1,12 +1,13 @@
 # -*- coding:utf-8 -*-
 
-from pyVmomi import vim
-from past.utils import old_div
-from urllib.request import unquote
+from urllib.parse import unquote
+
+from .lazy import vim
 
 from . import utils
 from . import pchm
 from . import constants
+from . import sync_profile
 
 
 _DATACENTER = ['name',
@@ -72,6 +73,9 @@ _VM = ['name',
        'summary.runtime.host',           # esxi host
        'summary.runtime.powerState',     # vm.run_status
        'summary.storage.committed',      # diskGB / 1024**3
+       'summary.quickStats.overallCpuUsage',
+       'summary.quickStats.guestMemoryUsage',
+       'summary.quickStats.hostMemoryUsage',
        'config.template',
        'config.hardware.device',
        'config.hardware.numCoresPerSocket',
@@ -99,142 +103,149 @@ _VM = ['name',
 #  2: dc:tempalte
 #     dc:vmfolder
 #     dc:cluster:[host, datastore, portgroup]
-def get_vc_properties(si, sync_flat=0):
-    dcs = get_dc_properties(si)
-    clusters = get_cluster_properties(si, key='moid')
-    dss = get_ds_properties(si, key='moid')
-    pgs = get_pg_properties(si, key='moid')
-    hosts = get_host_properties(si, key='moid')
-    vms = get_vm_properties(si, key='moid')
-
-    template_vms = []
-    for vmk, vmv in vms.items():
-        if vmv.get('config.template'):
-            template_vms.append(vmv)
-    for hk, hv in hosts.items():
-        hv['vms'] = [vms[moid] for moid in hv['vm'] if moid in vms]
-    for ck, cv in clusters.items():
-        cv['hosts'] = [hosts[moid] for moid in cv['host'] if moid in hosts]
-        cv['dss'] = [dss[moid] for moid in cv['datastore'] if moid in dss]
-        cv['pgs'] = [pgs[moid] for moid in cv['network'] if moid in pgs]
-    for dc in dcs:
-        dc['hosts'] = []
-        dc['clusters'] = []
-        for c_moid in dc['hosts']:
-            if c_moid.startswith('domain-c'):
-                dc['clusters'].append(clusters[c_moid])
-            else:
-                dc['hosts'].append(hosts[c_moid])
-    return (dcs, template_vms)
+SYNC_FLAT_ALL = 0
+SYNC_FLAT_DC = 1
+SYNC_FLAT_RES = 2
 
 
-def get_vc_all_properties(si):
+def get_vc_properties(si, sync_flat=SYNC_FLAT_ALL):
+    """
+    Collect the vCenter inventory tree, only as deep as sync_flat asks for.
+    Level 1 and 2 never run the full VM collection, templates are fetched
+    by get_template_properties instead.
+    """
+    if sync_flat not in (SYNC_FLAT_ALL, SYNC_FLAT_DC, SYNC_FLAT_RES):
+        raise Exception("Invalid sync_flat: %s" % sync_flat)
+
     dcs = get_dc_properties(si)
+    if sync_flat == SYNC_FLAT_DC:
+        return (dcs, get_template_properties(si))
+
     clusters = get_cluster_properties(si, key='moid')
     dss = get_ds_properties(si, key='moid')
     pgs = get_pg_properties(si, key='moid')
     hosts = get_host_properties(si, key='moid')
-    vms = get_vm_properties(si, key='moid')
+    if sync_flat == SYNC_FLAT_RES:
+        template_vms = get_template_properties(si)
+    else:
+        vms = get_vm_properties(si, key='moid')
+        with sync_profile.phase('host', 'link'):
+            template_vms = [vmv for vmv in vms.values() if vmv.get('config.template')]
+            for hk, hv in hosts.items():
+                hv['vms'] = [vms[moid] for moid in hv['vm'] if moid in vms]
+    with sync_profile.phase('cluster', 'link'):
+        link_dc_resources(dcs, clusters, hosts, dss, pgs)
+    return (dcs, template_vms)
+
 
-    for hk, hv in hosts.items():
-        hv['vms'] = [vms[moid] for moid in hv['vm'] if moid in vms]
+def link_dc_resources(dcs, clusters, hosts, dss, pgs):
+    """
+    Link dc -> cluster -> [host, datastore, portgroup] by moid
+    """
     for ck, cv in clusters.items():
         cv['hosts'] = [hosts[moid] for moid in cv['host'] if moid in hosts]
         cv['dss'] = [dss[moid] for moid in cv['datastore'] if moid in dss]
         cv['pgs'] = [pgs[moid] for moid in cv['network'] if moid in pgs]
     for dc in dcs:
         dc['clusters'] = [clusters[moid] for moid in dc['cluster'] if moid in clusters]
-        # dc['hosts'] = [hosts[moid] for moid in dc['host'] if moid in hosts]
-        # dc['templates'] = [vms[moid] for moid in dc['vm'] if moid in vms and vms[moid]['config.template']]
-    templates = []
-    for vmk, vmv in vms.items():
-        if vmv.get('config.template'):
-            templates.append(vmv)
-    return (dcs, templates)
+        dc['hosts'] = [hosts[moid] for moid in dc['host'] if moid in hosts]
+    return dcs
+
+
+def get_vc_all_properties(si):
+    return get_vc_properties(si, sync_flat=SYNC_FLAT_ALL)
 
 
 def get_vc_template_properties(si):
-    vms = get_vm_properties(si, key='moid')
-    template_vms = []
-    for vmk, vmv in vms.items():
-        if vmv.get('config.template'):
-            template_vms.append(vmv)
-    return template_vms
+    return get_template_properties(si)
 
 
 def get_vc_res_properties(si):
-    dcs = get_dc_properties(si)
-    clusters = get_cluster_properties(si, key='moid')
-    dss = get_ds_properties(si, key='moid')
-    pgs = get_pg_properties(si, key='moid')
-    hosts = get_host_properties(si, key='moid')
-
-    for ck, cv in clusters.items():
-        cv['hosts'] = [hosts[moid] for moid in cv['host'] if moid in hosts]
-        cv['dss'] = [dss[moid] for moid in cv['datastore'] if moid in dss]
-        cv['pgs'] = [pgs[moid] for moid in cv['network'] if moid in pgs]
-    for dc in dcs:
-        dc['hosts'] = []
-        dc['clusters'] = []
-        for c_moid in dc['hosts']:
-            if c_moid.startswith('domain-c'):
-                dc['clusters'].append(clusters[c_moid])
-            else:
-                dc['hosts'].append(hosts[c_moid])
+    (dcs, template_vms) = get_vc_properties(si, sync_flat=SYNC_FLAT_RES)
     return dcs
 
 
+def _collect(si, obj_type, vim_type, path_set, container=None):
+    """
+    RetrieveContents of path_set for every vim_type below container
+    """
+    with sync_profile.phase(obj_type, 'collect'):
+        view_ref = pchm.get_container_view(si, [vim_type], container)
+        obj_refs = pchm.collect_properties(si, view_ref, vim_type, path_set)
+        pchm.destroy_container_view(view_ref)
+    sync_profile.count(obj_type, obj_refs)
+    return obj_refs
+
+
 def get_dc_properties(si, container=None, include_mors=False, key=None):
-    view_ref = pchm.get_container_view(si, [vim.Datacenter], container)
-    dc_refs = pchm.collect_properties(si, view_ref, vim.Datacenter, _DATACENTER)
-    pchm.destroy_container_view(view_ref)
-    dc_properties = parse_dc_properties(dc_refs, key)
+    dc_refs = _collect(si, 'datacenter', vim.Datacenter, _DATACENTER, container)
+    with sync_profile.phase('datacenter', 'parse'):
+        dc_properties = parse_dc_properties(dc_refs, key)
     return dc_properties
 
 
 def get_cluster_properties(si, container=None, include_mors=False, key=None):
-    view_ref = pchm.get_container_view(si, [vim.ClusterComputeResource], container)
-    cluster_refs = pchm.collect_properties(si, view_ref, vim.ClusterComputeResource, _CLUSTER)
-    pchm.destroy_container_view(view_ref)
-    cluster_properties = parse_cluster_properties(cluster_refs, key)
+    cluster_refs = _collect(si, 'cluster', vim.ClusterComputeResource, _CLUSTER, container)
+    with sync_profile.phase('cluster', 'parse'):
+        cluster_properties = parse_cluster_properties(cluster_refs, key)
     return cluster_properties
 
 
 def get_ds_properties(si, container=None, include_mors=False, key=None):
-    view_ref = pchm.get_container_view(si, [vim.Datastore], container)
-    ds_refs = pchm.collect_properties(si, view_ref, vim.Datastore, _DATASTORE)
-    pchm.destroy_container_view(view_ref)
-    ds_properties = parse_ds_properties(ds_refs, key)
+    ds_refs = _collect(si, 'datastore', vim.Datastore, _DATASTORE, container)
+    with sync_profile.phase('datastore', 'parse'):
+        ds_properties = parse_ds_properties(ds_refs, key)
     return ds_properties
 
 
 def get_pg_properties(si, container=None, include_mors=False, key=None):
-    view_ref = pchm.get_container_view(si, [vim.Network], container)
-    pg_refs = pchm.collect_properties(si, view_ref, vim.Network, _NETWORK)
-    pchm.destroy_container_view(view_ref)
-    pg_properties = parse_pg_properties(pg_refs, key)
+    pg_refs = _collect(si, 'network', vim.Network, _NETWORK, container)
+    with sync_profile.phase('network', 'parse'):
+        pg_properties = parse_pg_properties(pg_refs, key)
     return pg_properties
 
 
 def get_host_properties(si, container=None, include_mors=False, key=None):
-    view_ref = pchm.get_container_view(si, [vim.HostSystem], container)
-    host_refs = pchm.collect_properties(si, view_ref, vim.HostSystem, _HOST)
-    pchm.destroy_container_view(view_ref)
-    host_properties = parse_host_properties(host_refs, key)
+    host_refs = _collect(si, 'host', vim.HostSystem, _HOST, container)
+    with sync_profile.phase('host', 'parse'):
+        host_properties = parse_host_properties(host_refs, key)
     return host_properties
 
 
 def get_vm_properties(si, container=None, include_mors=False, key=None):
-    view_ref = pchm.get_container_view(si, [vim.VirtualMachine], container)
-    vm_refs = pchm.collect_properties(si, view_ref, vim.VirtualMachine, _VM)
-    pchm.destroy_container_view(view_ref)
-    vm_properties = parse_vm_properties(vm_refs, key)
+    vm_refs = _collect(si, 'vm', vim.VirtualMachine, _VM, container)
+    with sync_profile.phase('vm', 'parse'):
+        vm_properties = parse_vm_properties(vm_refs, key)
     return vm_properties
 
 
+def get_template_properties(si, container=None, key=None):
+    """
+    Collect _VM properties for templates only.
+    The first pass reads config.template alone, so the heavy _VM path set
+    is never retrieved for ordinary virtual machines. The profile counts
+    that pass as 'template_flag', every vm's one property.
+    """
+    flag_refs = _collect(si, 'template_flag', vim.VirtualMachine, ['config.template'], container)
+    template_objs = [o.obj for o in flag_refs
+                     if any(p.val for p in o.propSet if p.name == 'config.template')]
+    if not template_objs:
+        return {} if key else []
+    with sync_profile.phase('template', 'collect'):
+        list_ref = pchm.get_list_view(si, template_objs)
+        vm_refs = pchm.collect_properties(si, list_ref, vim.VirtualMachine, _VM)
+        pchm.destroy_container_view(list_ref)
+    sync_profile.count('template', vm_refs)
+    with sync_profile.phase('template', 'parse'):
+        return parse_vm_properties(vm_refs, key)
+
+
 # Parse DataCenter properties
 def parse_dc_properties(dc_refs, key=None):
-    dcs = pchm.parse_properties(dc_refs)
+    return parse_dc_dicts(pchm.parse_properties(dc_refs), key)
+
+
+def parse_dc_dicts(dcs, key=None):
     for dc in dcs:
         dc['vmfolder'] = retrieve_folder_tree(dc['vmFolder'])
         frv_objs = retrieve_obj_by_folder(dc['vmFolder'])
@@ -247,7 +258,10 @@ def parse_dc_properties(dc_refs, key=None):
 
 # Parse Cluster properties
 def parse_cluster_properties(cluster_refs, key=None):
-    clusters = pchm.parse_properties(cluster_refs)
+    return parse_cluster_dicts(pchm.parse_properties(cluster_refs), key)
+
+
+def parse_cluster_dicts(clusters, key=None):
     for c in clusters:
         for k in c:
             if isinstance(c[k], list):
@@ -259,7 +273,10 @@ def parse_cluster_properties(cluster_refs, key=None):
 
 # Parse Host properties
 def parse_host_properties(host_refs, key=None):
-    hosts = pchm.parse_properties(host_refs)
+    return parse_host_dicts(pchm.parse_properties(host_refs), key)
+
+
+def parse_host_dicts(hosts, key=None):
     for h in hosts:
         for k in h:
             if isinstance(h[k], list):
@@ -301,7 +318,10 @@ def parse_host_properties(host_refs, key=None):
 
 # Parse Portgroup properties
 def parse_pg_properties(pg_refs, key=None):
-    pgs = pchm.parse_properties(pg_refs)
+    return parse_pg_dicts(pchm.parse_properties(pg_refs), key)
+
+
+def parse_pg_dicts(pgs, key=None):
     for pg in pgs:
         for k in pg:
             if isinstance(pg[k], list):
@@ -313,19 +333,27 @@ def parse_pg_properties(pg_refs, key=None):
 
 # Parse DataStore properties
 def parse_ds_properties(ds_refs, key=None):
-    return pchm.parse_properties(ds_refs, key=key)
+    return parse_ds_dicts(pchm.parse_properties(ds_refs), key)
+
+
+def parse_ds_dicts(dss, key=None):
+    return dict([(o[key], o) for o in dss if key in o]) if key else dss
 
 
 # Parse VM properties
 def parse_vm_properties(vm_refs, key=None):
-    vms = pchm.parse_properties(vm_refs)
+    return parse_vm_dicts(pchm.parse_properties(vm_refs), key)
+
+
+def parse_vm_dicts(vms, key=None):
     for vm in vms:
         if not vm.get('summary.config.uuid'):
             continue
-        (vm_disks, vm_nics) = get_vm_device_info(vm.pop('config.hardware.device', []))
-        vm['disk'] = vm_disks
-        vm_nets = get_vm_nic_info(vm_nics, vm.pop('guest.net', []))
-        vm['network'] = vm_nets
+        with sync_profile.phase('vm', 'parse.devices'):
+            (vm_disks, vm_nics) = get_vm_device_info(vm.pop('config.hardware.device', []))
+            vm['disk'] = vm_disks
+            vm_nets = get_vm_nic_info(vm_nics, vm.pop('guest.net', []))
+            vm['network'] = vm_nets
         try:
             vm['summary.runtime.host'] = vm['summary.runtime.host'].name
         except:
@@ -416,7 +444,7 @@ def get_vm_disk_info(disk_device, scsi_ctls_type):
     """
     disk_info = {}
     disk_info['label'] = disk_device.deviceInfo.label
-    scsi_z1 = old_div((disk_device.key - 2000), 16)
+    scsi_z1 = (disk_device.key - 2000) // 16
     scsi_z2 = (disk_device.key - 2000) % 16
     # unitNumber 7 reserved for scsi controller
     scsi_z2 += 1 if scsi_z2 >= 7 else 0
@@ -429,6 +457,8 @@ def get_vm_disk_info(disk_device, scsi_ctls_type):
     disk_info['ds_name'] = disk_device.backing.datastore.name
     disk_info['ds_moid'] = disk_device.backing.datastore._moId
     disk_info['key'] = disk_device.key
+    disk_info['controller_key'] = disk_device.controllerKey
+    disk_info['unit_number'] = disk_device.unitNumber
     if isinstance(disk_device.backing,
                   vim.vm.device.VirtualDisk.RawDiskMappingVer1BackingInfo):
         is_raw_disk = True
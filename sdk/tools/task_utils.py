@@ -2,7 +2,7 @@
 
 from __future__ import absolute_import
 
-from pyVmomi import vmodl
+from .lazy import vmodl
 
 import logging
 
@@ -14,5 +14,6 @@ def reconfig_vm_task(vm_moref, config_spec):
         task_moref = vm_moref.ReconfigVM_Task(spec=config_spec)
     except vmodl.MethodFault as error:
         LOG.exception("Caught vmodl fault : " + error.msg)
+        raise
     return task_moref
 
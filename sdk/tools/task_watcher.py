@@ -0,0 +1,109 @@
+# -*- coding:utf-8 -*-
+"""
+Task completion callbacks.
+
+Work that has to happen when a task ends (give back a placement reservation,
+commit or release disk slots) used to run only when somebody polled the task
+state. TaskWatcher keeps one property collector filter per watched task and
+a single thread waiting in WaitForUpdatesEx, and calls the task's callback
+once it reaches success or error, whether or not the task is ever polled.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from .lazy import vim, vmodl
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_WAIT = 30
+_PATH_SET = ['info.state', 'info.error']
+
+
+class TaskWatcher(object):
+    """
+    watch(task, callback): callback(state, error) runs on the watcher thread
+    once the task is 'success' or 'error', so it must be quick
+    """
+    def __init__(self, si, max_wait=DEFAULT_MAX_WAIT):
+        self.si = si
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._collector = None
+        # filter moid -> (filter, task moid, callback)
+        self._watched = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def watch(self, task, callback):
+        with self._lock:
+            if self._stop.is_set():
+                raise Exception("Task watcher is stopped!")
+            if self._collector is None:
+                self._collector = self.si.content.propertyCollector.CreatePropertyCollector()
+            obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False)
+            property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
+                                                                       pathSet=_PATH_SET)
+            filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec],
+                                                                   propSet=[property_spec])
+            task_filter = self._collector.CreateFilter(filter_spec, partialUpdates=False)
+            self._watched[task_filter._moId] = (task_filter, task._moId, callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def pending(self):
+        with self._lock:
+            return len(self._watched)
+
+    def stop(self):
+        with self._lock:
+            self._stop.set()
+            collector = self._collector
+        if collector is not None:
+            # wakes up the watcher thread
+            collector.CancelWaitForUpdates()
+        if self._thread is not None:
+            self._thread.join()
+        if collector is not None:
+            collector.Destroy()
+
+    def _run(self):
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.max_wait)
+        version = ''
+        while not self._stop.is_set():
+            try:
+                update = self._collector.WaitForUpdatesEx(version, options)
+            except vmodl.fault.RequestCanceled:
+                continue
+            except Exception as ex:
+                LOG.exception(ex)
+                self._stop.wait(self.max_wait)
+                continue
+            if update is None:
+                continue
+            version = update.version
+            for filter_update in update.filterSet:
+                for obj_update in filter_update.objectSet:
+                    self._apply(filter_update.filter, obj_update)
+
+    def _apply(self, task_filter, obj_update):
+        values = dict((change.name, change.val) for change in obj_update.changeSet)
+        state = values.get('info.state')
+        if state not in ('success', 'error'):
+            return
+        with self._lock:
+            watched = self._watched.pop(task_filter._moId, None)
+        if watched is None:
+            return
+        try:
+            task_filter.DestroyPropertyFilter()
+        except Exception as ex:
+            LOG.warning("destroy task filter failed: %s" % ex)
+        try:
+            watched[2](state, values.get('info.error'))
+        except Exception as ex:
+            LOG.exception("task %s callback failed: %s" % (watched[1], ex))
@@ -0,0 +1,141 @@
+# -*- coding:utf-8 -*-
+"""
+Template artifact cache for clone spec construction.
+
+Building a VmCloneSpec reads the template's guest type, NICs, disks and SCSI
+controllers, and builds the sysprep identity from scratch. TemplateCache
+keeps those per (template moid, config.changeVersion), so a clone only costs
+one changeVersion lookup (none when the caller already knows the version)
+and works on private copies of the cached devices.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from .lazy import vim, VmomiSupport
+
+from . import pchm, utils, vmops
+
+
+LOG = logging.getLogger(__name__)
+
+_TEMPLATE_PATH_SET = ['datastore',
+                      'config.changeVersion',
+                      'config.guestId',
+                      'config.hardware.device',
+                      'config.hardware.numCPU',
+                      'config.hardware.numCoresPerSocket',
+                      'config.hardware.memoryMB']
+
+
+def copy_data_object(value):
+    """
+    Deep copy of a vim data object, managed object refs are shared
+    """
+    if isinstance(value, VmomiSupport.DataObject):
+        copied = value.__class__()
+        for prop in value._GetPropertyList():
+            setattr(copied, prop.name, copy_data_object(getattr(value, prop.name)))
+        return copied
+    if isinstance(value, list):
+        return value.__class__(copy_data_object(v) for v in value)
+    return value
+
+
+class TemplateInfo(object):
+    """
+    Decoded template state, never handed out without copying
+    """
+    def __init__(self, moid, change_version, guest_id, devices, datastores=None,
+                 num_cpu=None, num_cores=None, memory_mb=None):
+        self.moid = moid
+        self.change_version = change_version
+        self.datastore_moids = [ds._moId for ds in datastores or []]
+        self.guest_id = guest_id
+        self.sys_type = utils.get_os_type(guest_id)
+        # the template's cpu/memory, instant clones inherit them
+        self.num_cpu = num_cpu
+        self.num_cores = num_cores
+        self.memory_mb = memory_mb
+        self._nics = [dev for dev in devices
+                      if isinstance(dev, vim.vm.device.VirtualEthernetCard)]
+        self._disks = [dev for dev in devices
+                       if isinstance(dev, vim.vm.device.VirtualDisk)]
+        self._scsi_controllers = [dev for dev in devices
+                                  if isinstance(dev, vim.vm.device.VirtualSCSIController)]
+        # identity skeleton, hostname and domain are filled in per clone
+        self._identity = vmops.sysprep_customization(hostname='localhost',
+                                                     sys_type=self.sys_type)
+
+    def nic_devs(self):
+        return [copy_data_object(dev) for dev in self._nics]
+
+    def disk_devs(self):
+        return [copy_data_object(dev) for dev in self._disks]
+
+    def scsi_controller_devs(self):
+        return [copy_data_object(dev) for dev in self._scsi_controllers]
+
+    def make_identity(self, hostname, domain=None):
+        """
+        Same result as vmops.sysprep_customization(hostname, domain, sys_type)
+        """
+        identity = copy_data_object(self._identity)
+        fixedname = vim.vm.customization.FixedName(name=hostname)
+        if isinstance(identity, vim.vm.customization.LinuxPrep):
+            identity.hostName = fixedname
+            identity.domain = domain
+        elif isinstance(identity, vim.vm.customization.Sysprep):
+            identity.userData.fullName = hostname
+            identity.userData.orgName = hostname
+            identity.userData.computerName = fixedname
+        return identity
+
+
+class TemplateCache(object):
+    """
+    TemplateInfo per template moid, rebuilt when config.changeVersion moves
+    """
+    def __init__(self, si):
+        self.si = si
+        self._lock = threading.Lock()
+        self._infos = {}
+
+    def get(self, template_moref, change_version=None):
+        """
+        Return the TemplateInfo of template_moref.
+        @ parameters:
+        @@ change_version: known config.changeVersion (e.g. from the inventory
+                           sync), saves the version lookup
+        """
+        moid = template_moref._moId
+        if change_version is None:
+            props = pchm.get_object_properties(self.si, template_moref,
+                                               ['config.changeVersion'])
+            change_version = props.get('config.changeVersion')
+        with self._lock:
+            info = self._infos.get(moid)
+        if info is not None and info.change_version == change_version:
+            return info
+
+        props = pchm.get_object_properties(self.si, template_moref, _TEMPLATE_PATH_SET)
+        if 'config.hardware.device' not in props:
+            raise Exception("Not found template config: %s" % moid)
+        info = TemplateInfo(moid, props.get('config.changeVersion'),
+                            props.get('config.guestId'), props['config.hardware.device'],
+                            props.get('datastore'),
+                            num_cpu=props.get('config.hardware.numCPU'),
+                            num_cores=props.get('config.hardware.numCoresPerSocket'),
+                            memory_mb=props.get('config.hardware.memoryMB'))
+        LOG.debug("template %s cached at changeVersion %s" % (moid, info.change_version))
+        with self._lock:
+            self._infos[moid] = info
+        return info
+
+    def invalidate(self, moid=None):
+        with self._lock:
+            if moid is None:
+                self._infos.clear()
+            else:
+                self._infos.pop(moid, None)
@@ -0,0 +1,351 @@
+# -*- coding:utf-8 -*-
+"""
+Template replicas on designated datastores.
+
+A full clone onto a datastore other than the template's copies the template
+disks across datastores, which is the slowest provisioning path. The replica
+manager keeps template copies of registered master templates on chosen
+datastores. The master's config.changeVersion is stamped into the replica's
+extraConfig, so stale replicas are detected (and rebuilt) when the master
+changes, also across restarts.
+
+A rebuild clones the master next to the old replica and routes new clones to
+it at once; the old replica is destroyed once the clones that resolved to it
+have released it (see resolve/release). An old replica that cannot be
+destroyed yet is retried on the next ensure, and the new one keeps its
+build name until the replica name is free again.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from .lazy import vim
+
+from . import pchm, utils
+from .template_cache import TemplateCache
+
+
+LOG = logging.getLogger(__name__)
+
+REPLICA_NAME_FORMAT = '%(template)s-replica-%(datastore)s'
+SOURCE_MOID_KEY = 'templateReplica.sourceMoid'
+SOURCE_VERSION_KEY = 'templateReplica.sourceVersion'
+BUILD_NAME_SUFFIX = '-updating'
+# seconds a rebuild waits for the clones of the old replica before it
+# leaves the old replica to the next ensure
+DEFAULT_DRAIN_TIMEOUT = 600
+
+
+def clear_stamps(config_spec):
+    """
+    Drop the replica stamps a clone would inherit from its replica
+    """
+    # an empty value removes the key
+    config_spec.extraConfig.extend([vim.option.OptionValue(key=SOURCE_MOID_KEY, value=''),
+                                    vim.option.OptionValue(key=SOURCE_VERSION_KEY, value='')])
+    return config_spec
+
+
+class _Replica(object):
+    def __init__(self, master_moid, ds_moref, name, folder=None, pool=None):
+        self.master_moid = master_moid
+        self.ds_moref = ds_moref
+        self.name = name
+        self.folder = folder
+        self.pool = pool
+        self.moref = None
+        # inventory name of moref, the build name until it could be renamed
+        self.moref_name = None
+        self.version = None
+        self.building = False
+        # [(moref, name)] of replaced replicas not destroyed yet
+        self.retired = []
+        self.lock = threading.Lock()
+
+
+class TemplateReplicaManager(object):
+    """
+    Keep replicas of master templates on designated datastores and route
+    clones to the replica local to the target datastore.
+    @ parameters:
+    @@ template_cache: shared template_cache.TemplateCache, used for versions
+    @@ auto_build: build or refresh a missing/stale replica in the background
+                   when a clone asks for it
+    """
+    def __init__(self, si, template_cache=None, auto_build=True,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT):
+        self.si = si
+        self.template_cache = template_cache or TemplateCache(si)
+        self.auto_build = auto_build
+        self.drain_timeout = drain_timeout
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        # (master moid, datastore moid) -> _Replica
+        self._replicas = {}
+        self._masters = {}
+        # replica moid -> clones that resolved to it and did not release it
+        self._users = {}
+
+    def register(self, master_moref, datastore_morefs, folder=None, pool=None):
+        """
+        Designate datastores that get a replica of master_moref.
+        folder: where replicas are created, default the master's folder
+        pool: resource pool, needed by vCenter only for non-template masters
+        """
+        props = pchm.get_object_properties(self.si, master_moref, ['name', 'parent'])
+        master_name = props['name']
+        folder = folder or props.get('parent')
+        with self._lock:
+            self._masters[master_moref._moId] = master_moref
+            for ds_moref in datastore_morefs:
+                ds_name = pchm.get_object_properties(self.si, ds_moref, ['name'])['name']
+                name = REPLICA_NAME_FORMAT % {'template': master_name, 'datastore': ds_name}
+                key = (master_moref._moId, ds_moref._moId)
+                if key not in self._replicas:
+                    self._replicas[key] = _Replica(master_moref._moId, ds_moref, name,
+                                                   folder, pool)
+
+    def discover(self):
+        """
+        Pick up replicas that already exist in the inventory, in one collection
+        """
+        with self._lock:
+            by_name = dict((r.name, r) for r in self._replicas.values())
+        if not by_name:
+            return 0
+        found = 0
+        for vm in utils.find_vms(self.si, names=list(by_name), path_set=['config.extraConfig']):
+            replica = by_name[vm['name']]
+            stamps = dict((opt.key, opt.value) for opt in vm.get('config.extraConfig') or [])
+            if stamps.get(SOURCE_MOID_KEY) != replica.master_moid:
+                LOG.warning("VM %s is not a replica of %s, ignored" % (vm['name'], replica.master_moid))
+                continue
+            with self._lock:
+                replica.moref = vm['obj']
+                replica.moref_name = vm['name']
+                replica.version = stamps.get(SOURCE_VERSION_KEY)
+            found += 1
+        return found
+
+    def replicas(self):
+        """
+        Return [{'name', 'master_moid', 'ds_moid', 'moid', 'version'}]
+        """
+        with self._lock:
+            return [{'name': r.name, 'master_moid': r.master_moid, 'ds_moid': r.ds_moref._moId,
+                     'moid': r.moref._moId if r.moref else None, 'version': r.version}
+                    for r in self._replicas.values()]
+
+    def resolve(self, master_moref, datastore_moref, change_version=None):
+        """
+        Return the template to clone from for datastore_moref: the fresh
+        replica on that datastore if there is one, the master otherwise.
+        A returned replica is not destroyed before release(template) is called.
+        """
+        if datastore_moref is None:
+            return master_moref
+        with self._lock:
+            replica = self._replicas.get((master_moref._moId, datastore_moref._moId))
+        if replica is None:
+            return master_moref
+        master_info = self.template_cache.get(master_moref, change_version)
+        if datastore_moref._moId in master_info.datastore_moids:
+            return master_moref
+        with self._lock:
+            replica_moref = replica.moref
+            if replica_moref is not None and replica.version == str(master_info.change_version):
+                self._users[replica_moref._moId] = self._users.get(replica_moref._moId, 0) + 1
+            else:
+                replica_moref = None
+                build = self.auto_build and not replica.building
+                if build:
+                    replica.building = True
+        if replica_moref is not None:
+            LOG.debug("clone of %s routed to replica %s" % (master_moref._moId, replica.name))
+            return replica_moref
+        if build:
+            thread = threading.Thread(target=self._ensure_logged, args=(replica, master_moref))
+            thread.daemon = True
+            thread.start()
+        return master_moref
+
+    def release(self, template_moref):
+        """
+        The clone from template_moref (as returned by resolve) is done
+        """
+        with self._lock:
+            moid = template_moref._moId
+            if moid not in self._users:
+                return
+            self._users[moid] -= 1
+            if self._users[moid] <= 0:
+                del self._users[moid]
+                self._released.notify_all()
+
+    def ensure_replica(self, master_moref, datastore_moref):
+        """
+        Build or refresh the replica of master_moref on datastore_moref, wait
+        for it and return it
+        """
+        with self._lock:
+            replica = self._replicas.get((master_moref._moId, datastore_moref._moId))
+        if replica is None:
+            raise Exception("Datastore %s is not registered for template %s"
+                            % (datastore_moref._moId, master_moref._moId))
+        return self._ensure(replica, master_moref)
+
+    def refresh(self):
+        """
+        Rebuild every replica whose master changeVersion moved, return the
+        names of the rebuilt replicas
+        """
+        with self._lock:
+            todo = [(r, self._masters[r.master_moid]) for r in self._replicas.values()]
+        refreshed = []
+        for (replica, master_moref) in todo:
+            old_version = replica.version
+            try:
+                self._ensure(replica, master_moref)
+            except Exception as ex:
+                LOG.exception(ex)
+                continue
+            if replica.version != old_version:
+                refreshed.append(replica.name)
+        return refreshed
+
+    def run(self, stop_event, interval=300):
+        """
+        Refresh replicas every interval seconds until stop_event is set
+        """
+        self.discover()
+        while not stop_event.is_set():
+            self.refresh()
+            stop_event.wait(interval)
+
+    def _ensure_logged(self, replica, master_moref):
+        # resolve set building before starting this thread
+        try:
+            self._ensure(replica, master_moref)
+        except Exception as ex:
+            LOG.exception(ex)
+        finally:
+            self._set_building(replica, False)
+
+    def _set_building(self, replica, building):
+        with self._lock:
+            replica.building = building
+
+    def _ensure(self, replica, master_moref):
+        with replica.lock:
+            version = str(self.template_cache.get(master_moref).change_version)
+            if replica.moref is not None and replica.version == version:
+                if replica.retired or replica.moref_name != replica.name:
+                    self._cleanup(replica, 0)
+                return replica.moref
+            self._set_building(replica, True)
+            try:
+                self._build(replica, master_moref, version)
+            finally:
+                self._set_building(replica, False)
+            return replica.moref
+
+    def _build(self, replica, master_moref, version):
+        """
+        Clone the master next to the current replica, route clones to the new
+        one, then retire the old one
+        """
+        if not self._free_names(replica):
+            # both names are taken by replicas that are still in use
+            self._cleanup(replica, 0)
+        names = self._free_names(replica)
+        if not names:
+            raise Exception("Old template replicas of %s are not destroyed yet!" % replica.name)
+        tmp_name = names[0]
+        self._remove_abandoned(replica, tmp_name)
+        LOG.info("building template replica %s at version %s" % (tmp_name, version))
+
+        clone_spec = vim.vm.CloneSpec()
+        clone_spec.template = True
+        clone_spec.powerOn = False
+        clone_spec.location = vim.vm.RelocateSpec()
+        clone_spec.location.datastore = replica.ds_moref
+        clone_spec.location.pool = replica.pool
+        clone_spec.config = vim.vm.ConfigSpec()
+        clone_spec.config.extraConfig = [
+            vim.option.OptionValue(key=SOURCE_MOID_KEY, value=replica.master_moid),
+            vim.option.OptionValue(key=SOURCE_VERSION_KEY, value=version)]
+        task = master_moref.Clone(name=tmp_name, folder=replica.folder, spec=clone_spec)
+        (state, result) = utils.wait_for_task(task)
+        if state != 0:
+            raise Exception("Create template replica %s failed: %s" % (tmp_name, result))
+        new_moref = result
+
+        # new clones go to the new replica from here on
+        with self._lock:
+            if replica.moref is not None:
+                replica.retired.append((replica.moref, replica.moref_name))
+            replica.moref = new_moref
+            replica.moref_name = tmp_name
+            replica.version = version
+        self._cleanup(replica, self.drain_timeout)
+        return new_moref
+
+    def _free_names(self, replica):
+        """ names a new replica can be built under, the replica name first """
+        with self._lock:
+            taken = set([replica.moref_name] + [name for (_, name) in replica.retired])
+        return [name for name in (replica.name, replica.name + BUILD_NAME_SUFFIX)
+                if name not in taken]
+
+    def _remove_abandoned(self, replica, name):
+        """
+        Destroy a replica of this master left under name by an interrupted
+        build, so the clone does not fail with DuplicateName
+        """
+        for vm in utils.find_vms(self.si, names=[name], path_set=['config.extraConfig']):
+            stamps = dict((opt.key, opt.value) for opt in vm.get('config.extraConfig') or [])
+            if stamps.get(SOURCE_MOID_KEY) != replica.master_moid:
+                raise Exception("VM %s is in the way of template replica %s!"
+                                % (name, replica.name))
+            LOG.info("destroying abandoned template replica %s (%s)" % (name, vm['moid']))
+            (state, result) = utils.wait_for_task(vm['obj'].Destroy_Task())
+            if state != 0:
+                raise Exception("Destroy abandoned template replica %s failed: %s"
+                                % (name, result))
+
+    def _wait_released(self, moref, timeout):
+        deadline = time.time() + timeout
+        with self._lock:
+            while self._users.get(moref._moId):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._released.wait(remaining)
+        return True
+
+    def _cleanup(self, replica, timeout):
+        """
+        Destroy the retired replicas once their clones released them (waiting
+        up to timeout seconds), then give the current one the replica name
+        """
+        for (old_moref, old_name) in list(replica.retired):
+            if not self._wait_released(old_moref, timeout):
+                LOG.info("old template replica %s is still in use" % old_name)
+                continue
+            (state, result) = utils.wait_for_task(old_moref.Destroy_Task())
+            if state != 0:
+                LOG.warning("Destroy old template replica %s failed: %s" % (old_name, result))
+                continue
+            self.template_cache.invalidate(old_moref._moId)
+            with self._lock:
+                replica.retired.remove((old_moref, old_name))
+        if replica.moref_name != replica.name and replica.name in self._free_names(replica):
+            (state, result) = utils.wait_for_task(
+                replica.moref.Rename_Task(newName=replica.name))
+            if state != 0:
+                LOG.warning("Rename template replica %s failed: %s" % (replica.moref_name, result))
+            else:
+                with self._lock:
+                    replica.moref_name = replica.name
@@ -0,0 +1,337 @@
+# -*- coding:utf-8 -*-
+"""
+Ring buffer history for host and VM quickStats.
+
+Each sync overwrites summary.quickStats in place. RingBufferStore keeps the
+last N samples of a fixed set of fields for every entity in a single flat
+float32 buffer, laid out as [slot][field][sample]. Rollups (avg/p95/max over
+the last samples) are vectorized over all entities with NumPy when it is
+installed, and fall back to plain Python on array('f') otherwise.
+
+With a path the buffer is memory-mapped and the slot index is kept in a
+JSON side file, so history survives restarts.
+"""
+from __future__ import absolute_import, division
+
+import array
+import json
+import math
+import mmap
+import os
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+HOST_FIELDS = ['summary.quickStats.overallCpuUsage',
+               'summary.quickStats.overallMemoryUsage']
+VM_FIELDS = ['summary.quickStats.overallCpuUsage',
+             'summary.quickStats.guestMemoryUsage',
+             'summary.quickStats.hostMemoryUsage']
+
+DEFAULT_CAPACITY = 120
+DEFAULT_MAX_HOSTS = 1024
+DEFAULT_MAX_VMS = 20000
+ROLLUPS = ('avg', 'p95', 'max')
+
+_NAN = float('nan')
+_ITEM_SIZE = 4
+
+
+class RingBufferStore(object):
+    """
+    Fixed size sample history for up to max_entities entities.
+
+    @ parameters:
+    @@ fields: property names recorded for every entity
+    @@ capacity: samples kept per entity and field
+    @@ max_entities: entity slots allocated up front
+    @@ path: memory-mapped backing file, the slot index goes to path + '.idx'
+    @@ use_numpy: force (True) or disable (False) the NumPy backend
+    """
+    def __init__(self, fields, capacity=DEFAULT_CAPACITY, max_entities=DEFAULT_MAX_VMS,
+                 path=None, use_numpy=None):
+        if use_numpy and numpy is None:
+            raise Exception("NumPy is not installed!")
+        self.fields = list(fields)
+        self.capacity = capacity
+        self.max_entities = max_entities
+        self.path = path
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        self._field_index = dict((f, i) for i, f in enumerate(self.fields))
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._free = []
+        self._next_slot = 0
+        self._mmap = None
+        self._file = None
+        self._load_index()
+        self._data = self._alloc()
+        self._heads = array.array('l', self._heads_init or [0] * max_entities)
+        self._counts = array.array('l', self._counts_init or [0] * max_entities)
+
+    def _size(self):
+        return self.max_entities * len(self.fields) * self.capacity
+
+    def _load_index(self):
+        self._heads_init = None
+        self._counts_init = None
+        if not self.path or not os.path.exists(self._index_path()):
+            return
+        with open(self._index_path()) as f:
+            index = json.load(f)
+        if (index['fields'] != self.fields or index['capacity'] != self.capacity
+                or index['max_entities'] != self.max_entities):
+            raise Exception("History file %s does not match the store layout!" % self.path)
+        self._slots = index['slots']
+        self._free = index['free']
+        self._next_slot = index['next_slot']
+        self._heads_init = index['heads']
+        self._counts_init = index['counts']
+
+    def _index_path(self):
+        return self.path + '.idx'
+
+    def _alloc(self):
+        size = self._size()
+        if not self.path:
+            if self.use_numpy:
+                data = numpy.empty(size, dtype=numpy.float32)
+                data.fill(_NAN)
+                return data.reshape(self.max_entities, len(self.fields), self.capacity)
+            return array.array('f', [_NAN]) * size
+
+        nbytes = size * _ITEM_SIZE
+        is_new = not os.path.exists(self.path) or os.path.getsize(self.path) != nbytes
+        if is_new:
+            self._slots, self._free, self._next_slot = {}, [], 0
+            self._heads_init = self._counts_init = None
+        if self.use_numpy:
+            data = numpy.memmap(self.path, dtype=numpy.float32,
+                                mode='w+' if is_new else 'r+',
+                                shape=(self.max_entities, len(self.fields), self.capacity))
+            if is_new:
+                data.fill(_NAN)
+            return data
+        self._file = open(self.path, 'w+b' if is_new else 'r+b')
+        if is_new:
+            self._file.truncate(nbytes)
+        self._mmap = mmap.mmap(self._file.fileno(), nbytes)
+        data = memoryview(self._mmap).cast('f')
+        if is_new:
+            for i in range(size):
+                data[i] = _NAN
+        return data
+
+    def _slot(self, moid, create=True):
+        slot = self._slots.get(moid)
+        if slot is None and create:
+            if self._free:
+                slot = self._free.pop()
+            elif self._next_slot < self.max_entities:
+                slot = self._next_slot
+                self._next_slot += 1
+            else:
+                raise Exception("History store is full (%d entities)!" % self.max_entities)
+            self._slots[moid] = slot
+            self._heads[slot] = 0
+            self._counts[slot] = 0
+        return slot
+
+    def _set(self, slot, field, pos, value):
+        if self.use_numpy:
+            self._data[slot, field, pos] = value
+        else:
+            self._data[(slot * len(self.fields) + field) * self.capacity + pos] = value
+
+    def _get(self, slot, field, pos):
+        if self.use_numpy:
+            return float(self._data[slot, field, pos])
+        return self._data[(slot * len(self.fields) + field) * self.capacity + pos]
+
+    def record(self, moid, values):
+        """
+        Append one sample, values: {field: number}, missing fields are NaN
+        """
+        with self._lock:
+            self._record(moid, values)
+
+    def record_many(self, objs):
+        """
+        Append one sample per entity, objs: {moid: properties} as returned by
+        sync_utils.get_host_properties / get_vm_properties with key='moid'
+        """
+        with self._lock:
+            for moid, props in objs.items():
+                self._record(moid, props)
+
+    def _record(self, moid, values):
+        slot = self._slot(moid)
+        pos = self._heads[slot]
+        for field, i in self._field_index.items():
+            value = values.get(field)
+            self._set(slot, i, pos, _NAN if value is None else float(value))
+        self._heads[slot] = (pos + 1) % self.capacity
+        self._counts[slot] = min(self.capacity, self._counts[slot] + 1)
+
+    def remove(self, moid):
+        with self._lock:
+            self._remove(moid)
+
+    def _remove(self, moid):
+        slot = self._slots.pop(moid, None)
+        if slot is not None:
+            self._counts[slot] = 0
+            self._free.append(slot)
+
+    def retain(self, moids):
+        """
+        Drop every entity that is not in moids (e.g. deleted VMs)
+        """
+        keep = set(moids)
+        with self._lock:
+            for moid in [m for m in self._slots if m not in keep]:
+                self._remove(moid)
+
+    def series(self, moid, field):
+        """
+        Return the kept samples of one entity field, oldest first
+        """
+        with self._lock:
+            slot = self._slot(moid, create=False)
+            if slot is None:
+                return []
+            i = self._field_index[field]
+            count = self._counts[slot]
+            head = self._heads[slot]
+            return [self._get(slot, i, (head - count + n) % self.capacity)
+                    for n in range(count)]
+
+    def rollup(self, field, window=None, moids=None):
+        """
+        Return {moid: {'avg': x, 'p95': x, 'max': x}} over the last window
+        samples of field, for moids (default: every entity)
+        """
+        window = min(window or self.capacity, self.capacity)
+        with self._lock:
+            if moids is None:
+                moids = list(self._slots)
+            moids = [m for m in moids if m in self._slots]
+            if not moids:
+                return {}
+            slots = [self._slots[m] for m in moids]
+            if self.use_numpy:
+                stats = self._rollup_numpy(self._field_index[field], window, slots)
+            else:
+                stats = self._rollup_python(self._field_index[field], window, slots)
+        return dict(zip(moids, stats))
+
+    def _rollup_numpy(self, field, window, slots):
+        slots = numpy.asarray(slots)
+        heads = numpy.asarray([self._heads[s] for s in slots])
+        counts = numpy.asarray([self._counts[s] for s in slots])
+        back = numpy.arange(1, window + 1)
+        positions = (heads[:, None] - back[None, :]) % self.capacity
+        values = numpy.asarray(self._data[slots[:, None], field, positions], dtype=numpy.float64)
+        values[back[None, :] > counts[:, None]] = numpy.nan
+        # NaN sorts last, so the valid samples are the first n of each row
+        values.sort(axis=1)
+        n_valid = (~numpy.isnan(values)).sum(axis=1)
+        has_data = n_valid > 0
+        rows = numpy.arange(len(slots))
+        p95_idx = numpy.maximum(numpy.ceil(0.95 * n_valid).astype(int) - 1, 0)
+        last_idx = numpy.maximum(n_valid - 1, 0)
+        sums = numpy.where(numpy.isnan(values), 0.0, values).sum(axis=1)
+        avg = numpy.where(has_data, sums / numpy.maximum(n_valid, 1), numpy.nan)
+        p95 = numpy.where(has_data, values[rows, p95_idx], numpy.nan)
+        vmax = numpy.where(has_data, values[rows, last_idx], numpy.nan)
+        return [{'avg': _none_if_nan(a), 'p95': _none_if_nan(p), 'max': _none_if_nan(m)}
+                for (a, p, m) in zip(avg.tolist(), p95.tolist(), vmax.tolist())]
+
+    def _rollup_python(self, field, window, slots):
+        stats = []
+        for slot in slots:
+            count = min(self._counts[slot], window)
+            head = self._heads[slot]
+            values = [self._get(slot, field, (head - n) % self.capacity)
+                      for n in range(1, count + 1)]
+            values = sorted(v for v in values if not math.isnan(v))
+            if not values:
+                stats.append({'avg': None, 'p95': None, 'max': None})
+                continue
+            p95_idx = max(int(math.ceil(0.95 * len(values))) - 1, 0)
+            stats.append({'avg': sum(values) / len(values),
+                          'p95': values[p95_idx],
+                          'max': values[-1]})
+        return stats
+
+    def flush(self):
+        """
+        Write the buffer and the slot index of a persistent store to disk
+        """
+        if not self.path:
+            return
+        with self._lock:
+            if self.use_numpy:
+                self._data.flush()
+            else:
+                self._mmap.flush()
+            index = {'fields': self.fields,
+                     'capacity': self.capacity,
+                     'max_entities': self.max_entities,
+                     'slots': self._slots,
+                     'free': self._free,
+                     'next_slot': self._next_slot,
+                     'heads': self._heads.tolist(),
+                     'counts': self._counts.tolist()}
+            tmp_path = self._index_path() + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp_path, self._index_path())
+
+    def close(self):
+        self.flush()
+        if self._mmap is not None:
+            self._data.release()
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+
+class QuickStatsHistory(object):
+    """
+    quickStats history for hosts and VMs, fed by the inventory sync
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY, max_hosts=DEFAULT_MAX_HOSTS,
+                 max_vms=DEFAULT_MAX_VMS, path=None, use_numpy=None):
+        host_path = path + '.hosts' if path else None
+        vm_path = path + '.vms' if path else None
+        self.hosts = RingBufferStore(HOST_FIELDS, capacity, max_hosts, host_path, use_numpy)
+        self.vms = RingBufferStore(VM_FIELDS, capacity, max_vms, vm_path, use_numpy)
+
+    def record(self, hosts=None, vms=None):
+        """
+        hosts/vms: {moid: properties} from one sync run, entities that are no
+        longer in the inventory are dropped
+        """
+        if hosts is not None:
+            self.hosts.retain(hosts)
+            self.hosts.record_many(hosts)
+        if vms is not None:
+            self.vms.retain(vms)
+            self.vms.record_many(vms)
+
+    def flush(self):
+        self.hosts.flush()
+        self.vms.flush()
+
+    def close(self):
+        self.hosts.close()
+        self.vms.close()
+
+
+def _none_if_nan(value):
+    return None if math.isnan(value) else value
@@ -0,0 +1,387 @@
+# -*- coding:utf-8 -*-
+"""
+Span tracing for provisioning workflows.
+
+A span is a timed, named step with attributes (vm, task, host, datastore)
+and a parent, e.g. clone_vm > spec > vmops.make_custom_spec. Spans opened on
+a thread become children of the span already open there. Finished traces
+go to a file sink when the root span ends. The sink writes one JSON span per
+line, or one OTLP/JSON ExportTraceServiceRequest per trace, which an
+OpenTelemetry collector's file receiver or otel-desktop-viewer can read:
+
+    tracing.configure('/var/log/vmware-sdk/traces.jsonl', fmt='otlp')
+
+Tracing is off until configured. While off, span()/traced() only check
+a flag and current_span() returns a span that ignores everything.
+
+A task outlives the call that submitted it, so the spans of later calls
+about it (polling its state, waiting for it) would start unrelated traces.
+record_task(key) remembers the span that submitted a task, link_task(key)
+adds a link to it on the current span.
+"""
+from __future__ import absolute_import
+
+import collections
+import functools
+import json
+import random
+import threading
+import time
+
+
+FORMAT_JSON = 'json'
+FORMAT_OTLP = 'otlp'
+DEFAULT_SERVICE_NAME = 'vmware-sdk'
+# submitting spans remembered for record_task/link_task
+MAX_RECORDED_TASKS = 10000
+
+_OTLP_STATUS_OK = 1
+_OTLP_STATUS_ERROR = 2
+_OTLP_KIND_INTERNAL = 1
+
+_local = threading.local()
+_random = random.SystemRandom()
+
+
+def _span_stack():
+    stack = getattr(_local, 'spans', None)
+    if stack is None:
+        stack = _local.spans = []
+    return stack
+
+
+def _attr_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class _NoopSpan(object):
+    """ stands in for a span while tracing is off """
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def phase(self, name, **attributes):
+        return self
+
+    def add_link(self, trace_id, span_id, **attributes):
+        pass
+
+    def end(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span(object):
+    def __init__(self, tracer, name, parent=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent else '%032x' % _random.getrandbits(128)
+        self.span_id = '%016x' % _random.getrandbits(64)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = {}
+        self.set_attributes(**(attributes or {}))
+        self.links = []
+        self.start = time.time()
+        self.end_time = None
+        self.error = None
+        self._phase = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = _attr_value(value)
+
+    def set_attributes(self, **attributes):
+        for (key, value) in attributes.items():
+            self.set_attribute(key, value)
+
+    def add_link(self, trace_id, span_id, **attributes):
+        """
+        Link this span to a span of another trace, e.g. the one that submitted
+        the task this span polls
+        """
+        self.links.append({'trace_id': trace_id, 'span_id': span_id,
+                           'attributes': dict((key, _attr_value(value))
+                                              for (key, value) in attributes.items())})
+
+    def phase(self, name, **attributes):
+        """
+        End the previous phase of this span and start the child span name,
+        the last phase ends with the span
+        """
+        if self._phase is not None:
+            self._phase.end()
+        self._phase = self.tracer.start_span(name, parent=self, **attributes)
+        return self._phase
+
+    def end(self, error=None):
+        if self.end_time is not None:
+            return
+        if self._phase is not None:
+            self._phase.end(error)
+            self._phase = None
+        self.end_time = time.time()
+        if error is not None:
+            self.error = error
+        self.tracer._finish(self)
+
+    @property
+    def duration(self):
+        return (self.end_time or time.time()) - self.start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end("%s: %s" % (exc_type.__name__, exc) if exc_type else None)
+        return False
+
+    def to_dict(self):
+        return {'trace_id': self.trace_id, 'span_id': self.span_id,
+                'parent_id': self.parent_id, 'name': self.name,
+                'start': self.start, 'end': self.end_time,
+                'duration_ms': self.duration * 1000.0,
+                'attributes': self.attributes, 'links': self.links,
+                'status': 'error' if self.error else 'ok', 'error': self.error}
+
+
+class JsonFileSink(object):
+    """ one JSON span per line """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _write(self, lines):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                for line in lines:
+                    f.write(line + '\n')
+
+    def export(self, spans):
+        self._write([json.dumps(span.to_dict(), sort_keys=True) for span in spans])
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': '' if value is None else value}
+
+
+def _otlp_attributes(attributes):
+    return [{'key': key, 'value': _otlp_value(value)}
+            for (key, value) in sorted(attributes.items())]
+
+
+class OtlpFileSink(JsonFileSink):
+    """ one OTLP/JSON ExportTraceServiceRequest per line """
+    def __init__(self, path, service_name=DEFAULT_SERVICE_NAME):
+        JsonFileSink.__init__(self, path)
+        self.service_name = service_name
+
+    def _otlp_span(self, span):
+        otlp_span = {'traceId': span.trace_id, 'spanId': span.span_id,
+                     'name': span.name, 'kind': _OTLP_KIND_INTERNAL,
+                     'startTimeUnixNano': str(int(span.start * 1e9)),
+                     'endTimeUnixNano': str(int(span.end_time * 1e9)),
+                     'attributes': _otlp_attributes(span.attributes),
+                     'status': {'code': _OTLP_STATUS_ERROR if span.error else _OTLP_STATUS_OK}}
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        if span.links:
+            otlp_span['links'] = [{'traceId': link['trace_id'], 'spanId': link['span_id'],
+                                   'attributes': _otlp_attributes(link['attributes'])}
+                                  for link in span.links]
+        if span.error:
+            otlp_span['status']['message'] = span.error
+        return otlp_span
+
+    def export(self, spans):
+        request = {'resourceSpans': [{
+            'resource': {'attributes': _otlp_attributes({'service.name': self.service_name})},
+            'scopeSpans': [{'scope': {'name': __name__},
+                            'spans': [self._otlp_span(span) for span in spans]}]}]}
+        self._write([json.dumps(request, sort_keys=True)])
+
+
+class Tracer(object):
+    """
+    @ parameters:
+    @@ sink: JsonFileSink/OtlpFileSink or anything with export(spans),
+             None turns tracing off
+    """
+    def __init__(self, sink=None):
+        self.sink = sink
+        self._lock = threading.Lock()
+        # trace id -> finished spans of a trace whose root is still open
+        self._traces = {}
+        # task key -> (trace id, span id) of the span that submitted it
+        self._tasks = collections.OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.sink is not None
+
+    def current_span(self):
+        stack = _span_stack()
+        return stack[-1] if stack else NOOP_SPAN
+
+    def start_span(self, name, parent=None, **attributes):
+        """
+        Start a span, a child of parent or of the span open on this thread
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        stack = _span_stack()
+        if parent is None and stack:
+            parent = stack[-1]
+        span = Span(self, name, parent, attributes)
+        if span.parent_id is None:
+            with self._lock:
+                self._traces[span.trace_id] = []
+        stack.append(span)
+        return span
+
+    def span(self, name, **attributes):
+        """
+        Context manager of a child span of the span open on this thread
+        """
+        return self.start_span(name, **attributes)
+
+    def _finish(self, span):
+        stack = _span_stack()
+        if span in stack:
+            stack.remove(span)
+        with self._lock:
+            spans = self._traces.get(span.trace_id)
+            if span.parent_id is None:
+                spans = self._traces.pop(span.trace_id, [])
+                spans.append(span)
+            elif spans is not None:
+                spans.append(span)
+                return
+            else:
+                # the root already ended, e.g. a child left running on a worker
+                spans = [span]
+        sink = self.sink
+        if sink is None:
+            return
+        try:
+            sink.export(spans)
+        except Exception:
+            # tracing must never break the traced operation
+            pass
+
+    def record_task(self, task_key):
+        """
+        Remember the current span as the one that submitted task_key
+        """
+        span = self.current_span()
+        if span is NOOP_SPAN or not task_key:
+            return
+        with self._lock:
+            self._tasks.pop(task_key, None)
+            self._tasks[task_key] = (span.trace_id, span.span_id)
+            while len(self._tasks) > MAX_RECORDED_TASKS:
+                self._tasks.popitem(last=False)
+
+    def link_task(self, task_key):
+        """
+        Link the current span to the span that submitted task_key, when that
+        one belongs to another trace
+        """
+        span = self.current_span()
+        if span is NOOP_SPAN or not task_key:
+            return
+        with self._lock:
+            submitted = self._tasks.get(task_key)
+        if submitted is not None and submitted[0] != span.trace_id:
+            span.add_link(submitted[0], submitted[1], task=task_key)
+
+    def bind(self, fn):
+        """
+        Wrap fn so its spans are children of the span open on the calling
+        thread, for functions submitted to a thread pool
+        """
+        parent = self.current_span()
+        if parent is NOOP_SPAN:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            saved = getattr(_local, 'spans', None)
+            _local.spans = [parent]
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _local.spans = saved
+        return wrapper
+
+
+TRACER = Tracer()
+
+
+def configure(path=None, fmt=FORMAT_JSON, service_name=DEFAULT_SERVICE_NAME):
+    """
+    Export traces to path as json span lines or otlp requests, None turns
+    tracing off
+    """
+    if path is None:
+        TRACER.sink = None
+    elif fmt == FORMAT_OTLP:
+        TRACER.sink = OtlpFileSink(path, service_name)
+    elif fmt == FORMAT_JSON:
+        TRACER.sink = JsonFileSink(path)
+    else:
+        raise Exception("Unsupported trace format: %s" % fmt)
+    return TRACER
+
+
+def span(name, **attributes):
+    return TRACER.span(name, **attributes)
+
+
+def current_span():
+    return TRACER.current_span()
+
+
+def bind(fn):
+    return TRACER.bind(fn)
+
+
+def record_task(task_key):
+    TRACER.record_task(task_key)
+
+
+def link_task(task_key):
+    TRACER.link_task(task_key)
+
+
+def traced(name=None):
+    """
+    Decorator: run the function in a span, named after it by default
+    """
+    def decorator(fn):
+        span_name = name or getattr(fn, '__qualname__', fn.__name__)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return fn(*args, **kwargs)
+            with TRACER.start_span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
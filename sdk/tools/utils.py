@@ -5,9 +5,11 @@
 """
 from __future__ import absolute_import
 import time
-from pyVmomi import vim
+from .lazy import vim
 
 from . import constants
+from . import pchm
+from . import tracing
 
 
 def get_objs(content, vimfolder, vimtype):
@@ -79,18 +81,26 @@ def get_obj(content, vimtype, name, moid):
     return obj
 
 
+@tracing.traced('wait_for_task')
 def wait_for_task(task):
     """
     wait for a vCenter task to finish.
     """
+    span = tracing.current_span()
+    span.set_attribute('task', getattr(task, '_moId', None))
+    # the task key is its moid
+    tracing.link_task(getattr(task, '_moId', None))
     try:
         while True:
             if task.info.state == 'success':
+                span.set_attribute('state', 'success')
                 return (0, task.info.result)
             elif task.info.state == 'error':
+                span.set_attribute('state', 'error')
                 return (1, task.info.result)
             time.sleep(1)
     except Exception as ex:
+        span.set_attribute('state', 'unknown')
         return (-1, "无法获取任务结果")
 
 
@@ -264,6 +274,37 @@ def get_vm_moref(content, name=None, uuid=None, moid=None):
     return vm_obj
 
 
+def find_vms(si, names=None, uuids=None, moids=None, path_set=None,
+             container=None):
+    """
+    Return VMs matching any of names/uuids/moids with one property collection
+    @ parameters:
+    @@ si: vim.ServiceInstance
+    @@ names: vm names (list)
+    @@ uuids: vm bios uuids, summary.config.uuid (list)
+    @@ moids: vm moids (list)
+    @@ path_set: extra properties to collect (list)
+    @@ container: vim.Folder/vim.Datacenter to search in, default rootFolder
+    @ return: [{'obj': vim.VirtualMachine, 'moid': .., 'name': .., 'summary.config.uuid': .., ...}]
+    """
+    names = set(names or [])
+    uuids = set(uuids or [])
+    moids = set(moids or [])
+    props = ['name', 'summary.config.uuid'] + [p for p in (path_set or [])
+                                               if p not in ('name', 'summary.config.uuid')]
+    view_ref = pchm.get_container_view(si, [vim.VirtualMachine], container)
+    try:
+        vm_refs = pchm.collect_properties(si, view_ref, vim.VirtualMachine, props)
+    finally:
+        pchm.destroy_container_view(view_ref)
+    vms = []
+    for vm in pchm.parse_properties(vm_refs, include_mors=True):
+        if vm['moid'] in moids or vm.get('name') in names \
+                or vm.get('summary.config.uuid') in uuids:
+            vms.append(vm)
+    return vms
+
+
 def get_portgroup_moref(content, name=None, moid=None):
     """
     Return a portgroup object by name, if name is None return None
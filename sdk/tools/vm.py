@@ -9,9 +9,9 @@ from __future__ import absolute_import, division
 
 import logging
 
-from urllib.request import unquote
-from past.utils import old_div
-from pyVmomi import vim
+from urllib.parse import unquote
+
+from .lazy import vim
 
 from . import constants, utils
 
@@ -244,7 +244,7 @@ def get_vm_net_info(net_device):
 
 
 def get_vdev_node(disk_device_key):
-    scsi_z1 = old_div((disk_device_key - 2000), 16)
+    scsi_z1 = (disk_device_key - 2000) // 16
     scsi_z2 = (disk_device_key - 2000) % 16
     # unitNumber 7 reserved for scsi controller
     scsi_z2 += 1 if scsi_z2 >= 7 else 0
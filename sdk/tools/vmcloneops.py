@@ -4,7 +4,7 @@
 """
 from __future__ import absolute_import, division
 
-from pyVmomi import vim
+from .lazy import vim
 from . import vmops
 
 
@@ -10,10 +10,10 @@ from __future__ import absolute_import, division
 import re
 import six
 import logging
-from builtins import str
-from pyVmomi import vim
+from .lazy import vim
 
-from . import constants, utils
+from . import constants, tracing, utils
+from .slot_allocator import SlotAllocator, format_vdev_node, parse_vdev_node
 
 
 LOG = logging.getLogger(__name__)
@@ -139,15 +139,16 @@ def sysprep_customization(hostname, domain='localhost.domain', workgroup='WORKGR
 
 
 # v1
-def vm_add_vmdk_disk(vm_moref, ds_moref, disk, sharing=False):
+def vm_add_vmdk_disk(vm_moref, ds_moref, disk, sharing=False, slots=None):
     """ add vmdk disk for vm
+    slots: slot_allocator.SlotAllocator of the vm, saves reading the device list
     """
     config_spec = vim.vm.ConfigSpec()
     disk_spec = vim.vm.device.VirtualDeviceSpec()
 
     # check or create disk controller dev
     (c_bus_number, d_unit_number) = disk['vdev_node'].split(':')
-    scsi_controllers = get_vm_scsi_controller_dev(vm_moref)
+    scsi_controllers = _scsi_controllers(vm_moref, slots)
     (controller, controller_spec) = _check_or_add_controller(scsi_controllers, int(c_bus_number))
     # create disk dev
     disk_spec.operation = "add"
@@ -183,29 +184,73 @@ def vm_add_vmdk_disk(vm_moref, ds_moref, disk, sharing=False):
     return config_spec
 
 
-def vm_remove_vmdk_disk(vm_moref, disk_file_path):
+def _indexed_disk_devs(vm_moref, disk_paths, backing_index, slots):
+    """
+    Disk devices to remove, built from the backing index instead of the vm's
+    device list. None when the vm's index entries are not known to be read
+    at slots.change_version (the remove destroys the vmdk, a stale key could
+    name another disk), a disk is not indexed or a scsi controller would be
+    left without disks (the controller itself is only in the device list).
+    """
+    if backing_index is None or slots is None or slots.change_version is None:
+        return None
+    if backing_index.change_version(vm_moref._moId) != slots.change_version:
+        return None
+    vm_disks = backing_index.vm_disks(vm_moref._moId)
+    by_file = dict((d['file_name'], d) for d in vm_disks)
+    removed = [by_file.get(path) for path in disk_paths]
+    if None in removed:
+        return None
+    removed_keys = set(d['key'] for d in removed)
+    for controller_key in set(d['controller_key'] for d in removed):
+        if all(d['key'] in removed_keys for d in vm_disks if d['controller_key'] == controller_key):
+            return None
+    devs = []
+    for disk in removed:
+        dev = vim.vm.device.VirtualDisk(key=disk['key'], controllerKey=disk['controller_key'],
+                                        unitNumber=disk['unit_number'])
+        if disk['is_raw']:
+            dev.backing = vim.vm.device.VirtualDisk.RawDiskMappingVer1BackingInfo()
+        else:
+            dev.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo()
+        dev.backing.fileName = disk['file_name']
+        devs.append(dev)
+    return devs
+
+
+def vm_remove_vmdk_disk(vm_moref, disk_file_path, backing_index=None, slots=None):
     """ remove disk device from vm
+    backing_index: backing_index.BackingIndex, saves reading the device list
+    slots: slot_allocator.SlotAllocator of the vm, saves reading the controllers
     """
     config_spec = vim.vm.ConfigSpec()
+    indexed_devs = _indexed_disk_devs(vm_moref, [disk_file_path], backing_index, slots)
+    if indexed_devs is not None:
+        vm_remove_virtual_device(config_spec, indexed_devs[0], file_operation="destroy")
+        return config_spec
     disk_devs = get_vm_disk_dev(vm_moref)
     for dev in disk_devs:
         if dev.backing.fileName == disk_file_path:
             vm_remove_virtual_device(config_spec, dev, file_operation="destroy")
-            controller_unit_number = dev.controllerKey - 1000
-            vm_remove_scsi_controller(vm_moref, config_spec, controller_unit_number)
+            if slots is not None:
+                bus_number = slots.bus_number(dev.controllerKey)
+            else:
+                bus_number = dev.controllerKey - 1000
+            vm_remove_scsi_controller(vm_moref, config_spec, bus_number, slots)
             break
     return config_spec
 
 
 # v2
-def create_attach_disks_config_spec(vm_moref, disks):
+def create_attach_disks_config_spec(vm_moref, disks, slots=None):
     """ create attach disks config spec
         diskMode: https://github.com/vmware/pyvmomi/blob/master/docs/vim/vm/device/VirtualDiskOption/DiskMode.rst
         - persistent: Changes are immediately and permanently written to the virtual disk.
         - independent_persistent: Same as persistent, but not affected by snapshots.
+        slots: slot_allocator.SlotAllocator of the vm, saves reading the device list
     """
     config_spec = vim.vm.ConfigSpec()
-    scsi_controllers = get_vm_scsi_controller_dev(vm_moref)
+    scsi_controllers = _scsi_controllers(vm_moref, slots)
 
     for disk in disks:
         (c_bus_number, d_unit_number) = disk['vdev_node'].split(':')
@@ -254,12 +299,20 @@ def create_attach_disks_config_spec(vm_moref, disks):
     return config_spec
 
 
-def create_remove_disks_config_spec(vm_moref, disks):
+def create_remove_disks_config_spec(vm_moref, disks, backing_index=None, slots=None):
     """ create remove disks config spec
+    backing_index: backing_index.BackingIndex, saves reading the device list
+    slots: slot_allocator.SlotAllocator of the vm, saves reading the controllers
     """
     config_spec = vim.vm.ConfigSpec()
+    indexed_devs = _indexed_disk_devs(vm_moref, [disk['disk_path'] for disk in disks],
+                                      backing_index, slots)
+    if indexed_devs is not None:
+        for dev in indexed_devs:
+            vm_remove_virtual_device(config_spec, dev, file_operation="destroy")
+        return config_spec
     disk_devs = get_vm_disk_dev(vm_moref)
-    scsi_controller_devs = get_vm_scsi_controller_dev(vm_moref)
+    scsi_controller_devs = _scsi_controllers(vm_moref, slots)
     controller_dev_dict = {}
 
     for disk in disks:
@@ -267,7 +320,10 @@ def create_remove_disks_config_spec(vm_moref, disks):
         for dev in disk_devs:
             if dev.backing.fileName == disk_file_path:
                 vm_remove_virtual_device(config_spec, dev, file_operation="destroy")
-                c_unit_number = dev.controllerKey - 1000
+                if slots is not None:
+                    c_unit_number = slots.bus_number(dev.controllerKey)
+                else:
+                    c_unit_number = dev.controllerKey - 1000
                 # 记录从此控制器上移除的磁盘设备数
                 if controller_dev_dict.get(c_unit_number):
                     controller_dev_dict[c_unit_number] += 1
@@ -276,7 +332,7 @@ def create_remove_disks_config_spec(vm_moref, disks):
                 # 当此控制器上现有的磁盘设备数等于移除的磁盘设备数时，移除此scsi控制器
                 for dev in scsi_controller_devs:
                     if dev.busNumber == c_unit_number:
-                        if len(dev.device) == controller_dev_dict.get(c_unit_number):
+                        if _n_controller_disks(dev, slots) == controller_dev_dict.get(c_unit_number):
                             vm_remove_virtual_device(config_spec, dev)
                         break
                 break
@@ -287,17 +343,31 @@ def create_remove_disks_config_spec(vm_moref, disks):
     return config_spec
 
 
-def vm_remove_scsi_controller(vm_moref, config_spec, bus_number):
+def vm_remove_scsi_controller(vm_moref, config_spec, bus_number, slots=None):
     """ remove scsi controller device from vm
     """
-    scsi_controller_devs = get_vm_scsi_controller_dev(vm_moref)
+    scsi_controller_devs = _scsi_controllers(vm_moref, slots)
     for dev in scsi_controller_devs:
         if dev.busNumber == bus_number:
-            if len(dev.device) == 1:
+            if _n_controller_disks(dev, slots) == 1:
                 vm_remove_virtual_device(config_spec, dev)
             break
 
 
+def _scsi_controllers(vm_moref, slots=None):
+    if slots is not None:
+        return slots.scsi_controllers()
+    return get_vm_scsi_controller_dev(vm_moref)
+
+
+def _n_controller_disks(controller, slots=None):
+    # the cached controller's device list is as old as the allocator, its
+    # slots are kept current
+    if slots is not None:
+        return slots.n_disks(controller.busNumber)
+    return len(controller.device)
+
+
 def vm_remove_virtual_device(config_spec, dev, file_operation=None):
     """ remove virtual device from vm
     """
@@ -327,7 +397,7 @@ def _config_vm_disk(scsi_controllers, devs, disks):
         devs.append(None)
     controller_spec_list = []
     disk_spec_list = []
-    allocated_vdev_node = []
+    slots = SlotAllocator([(dev.controllerKey - 1000, dev.unitNumber) for dev in devs if dev])
     for (dev, disk) in zip(devs, disks):
         disk_spec = vim.vm.device.VirtualDeviceSpec()
         disk_spec_list.append(disk_spec)
@@ -348,9 +418,10 @@ def _config_vm_disk(scsi_controllers, devs, disks):
                 disk_spec.device.backing.fileName = "[%s]" % disk.get('ds_name', '')
                 # set scsi vdev node
                 available_vdev_node = disk.get('vdev_node')
-                if not available_vdev_node:
-                    available_vdev_node = _get_available_vdev_node(devs, allocated_vdev_node)
-                    allocated_vdev_node.append(available_vdev_node)
+                if available_vdev_node:
+                    slots.commit(parse_vdev_node(available_vdev_node))
+                else:
+                    available_vdev_node = format_vdev_node(slots.reserve())
                 (c_bus_number, d_unit_number) = available_vdev_node.split(':')
                 (controller, controller_spec) = _check_or_add_controller(scsi_controllers, int(c_bus_number))
                 controller_spec_list += [controller_spec] if controller_spec else []
@@ -386,14 +457,6 @@ def _set_disk_type(disk_spec, disk_type):
         LOG.warning('Specifies the wrong disk format, so use the source disk format: disk_type=%s' % disk_type)
 
 
-def _get_available_vdev_node(devs, allocated_vdev_node):
-    all_vdev_node = ["%d:%d" % (a, b) for a in range(4) for b in range(16) if b != 7]
-    used_vdev_node = ["%d:%d" % (dev.controllerKey-1000, dev.unitNumber) for dev in devs if dev]
-    available_vdev_node = [n for n in all_vdev_node if n not in used_vdev_node and n not in allocated_vdev_node]
-    if len(available_vdev_node) < 1:
-        raise Exception("No SCSI controllers are available !")
-    return available_vdev_node[0]
-
 #
 # def _get_or_add_controller(scsi_controllers, bus_number, scsi_type=None):
 #     f_controller = None
@@ -673,14 +736,156 @@ def vmdk_share_disk_extra_config(config_spec, vdev_node):
     return config_spec
 
 
+CLONE_MODE_FULL = 'full'
+CLONE_MODE_LINKED = 'linked'
+CLONE_MODE_INSTANT = 'instant'
+CLONE_MODES = (CLONE_MODE_FULL, CLONE_MODE_LINKED, CLONE_MODE_INSTANT)
+LINKED_CLONE_SNAPSHOT = 'linked-clone-base'
+
+
+def find_snapshot(snapshot_list, name):
+    """ find a snapshot by name in a snapshot tree
+    @ parameters:
+    @@ snapshot_list: vim.vm.SnapshotTree[]
+    """
+    for tree in snapshot_list or []:
+        if tree.name == name:
+            return tree.snapshot
+        snapshot = find_snapshot(tree.childSnapshotList, name)
+        if snapshot:
+            return snapshot
+    return None
+
+
+@tracing.traced('vmops.get_linked_clone_snapshot')
+def get_linked_clone_snapshot(vm_moref, name=LINKED_CLONE_SNAPSHOT):
+    """ return the snapshot linked clones are based on, create it if missing
+    """
+    snapshot_info = vm_moref.snapshot
+    if snapshot_info:
+        snapshot = find_snapshot(snapshot_info.rootSnapshotList, name)
+        if snapshot:
+            return snapshot
+    if vm_moref.config.template:
+        # snapshots cannot be taken of a template
+        if snapshot_info and snapshot_info.currentSnapshot:
+            return snapshot_info.currentSnapshot
+        raise Exception("Template %s has no snapshot for linked clones !" % vm_moref.name)
+    LOG.info("Create linked clone snapshot %s of %s" % (name, vm_moref.name))
+    task = vm_moref.CreateSnapshot_Task(name=name, description='base of linked clones',
+                                        memory=False, quiesce=False)
+    (state, result) = utils.wait_for_task(task)
+    if state != 0:
+        raise Exception("Create linked clone snapshot failed: %s" % result)
+    return result
+
+
+_CUSTOMIZATION_EVENTS = ['CustomizationStartedEvent', 'CustomizationSucceeded',
+                         'CustomizationFailed', 'CustomizationLinuxIdentityFailed',
+                         'CustomizationNetworkSetupFailed', 'CustomizationSysprepFailed',
+                         'CustomizationUnknownFailure']
+
+
+@tracing.traced('vmops.get_customization_state')
+def get_customization_state(content, vm_moref):
+    """ guest customization state of a cloned vm from its latest customization
+    event: None (no event yet), 'running', 'success' or 'error'
+    """
+    span = tracing.current_span()
+    event_filter = vim.event.EventFilterSpec(
+        entity=vim.event.EventFilterSpec.ByEntity(entity=vm_moref, recursion='self'),
+        eventTypeId=_CUSTOMIZATION_EVENTS)
+    events = content.eventManager.QueryEvents(event_filter) or []
+    state = None
+    if events:
+        event = max(events, key=lambda e: e.key)
+        if isinstance(event, vim.event.CustomizationSucceeded):
+            state = 'success'
+        elif isinstance(event, vim.event.CustomizationFailed):
+            state = 'error'
+        else:
+            state = 'running'
+    span.set_attribute('state', state)
+    return state
+
+
+def guestinfo_options(vm_uuid, vm_net, hostname, domain=None, dnslist=None):
+    """ guest customization handed to an instant clone through guestinfo,
+    to be applied by a script in the guest
+    """
+    options = {'guestinfo.hostname': hostname}
+    if vm_uuid:
+        options['guestinfo.uuid'] = vm_uuid
+    if domain:
+        options['guestinfo.domain'] = domain
+    if dnslist:
+        options['guestinfo.dns'] = ','.join(dnslist)
+    for i, net in enumerate(vm_net):
+        if net and net.get('ip'):
+            options['guestinfo.nic%d.ip' % i] = net['ip']
+            options['guestinfo.nic%d.netmask' % i] = net.get('netmask') or ''
+            options['guestinfo.nic%d.gateway' % i] = net.get('gateway') or ''
+        elif net:
+            options['guestinfo.nic%d.ip' % i] = 'dhcp'
+    config = []
+    for k, v in options.items():
+        opt = vim.option.OptionValue()
+        opt.key = k
+        opt.value = v
+        config.append(opt)
+    return config
+
+
+class VmInstantCloneSpec(object):
+    """
+    make instant clone spec, the clone forks from a running parent vm:
+    cpu, memory and disks come from the parent, NICs may be re-homed and
+    the guest customization goes to guestinfo
+    """
+
+    def __init__(self, vm_name, parent_moref, vm_uuid, vm_net, vm_disk, res_pool_moref,
+                 datastore_moref, destfolder, hostname, domain=None, dnslist=None,
+                 template_info=None):
+        self.template_info = template_info
+        if template_info:
+            dev_nics = template_info.nic_devs()
+            dev_disks = template_info.disk_devs()
+        else:
+            dev_nics = get_vm_nic_adapter_dev(parent_moref)
+            dev_disks = get_vm_disk_dev(parent_moref)
+        if len([disk for disk in vm_disk if disk]) > len(dev_disks):
+            raise Exception("Instant clone can not add disks !")
+        if any(vm_disk):
+            LOG.warning('Instant clone keeps the disks of the parent vm, disk changes are ignored.')
+        if len(vm_net) > len(dev_nics):
+            raise Exception("Instant clone can not add NICs !")
+
+        relocate_spec = vim.vm.RelocateSpec()
+        relocate_spec.pool = res_pool_moref
+        relocate_spec.datastore = datastore_moref
+        relocate_spec.folder = destfolder
+        nic_specs = [nic_spec for nic_spec in _config_vm_nic(dev_nics, list(vm_net))
+                     if nic_spec.operation == 'edit']
+        relocate_spec.deviceChange.extend(nic_specs)
+
+        self.clone_spec = vim.vm.InstantCloneSpec()
+        self.clone_spec.name = vm_name
+        self.clone_spec.location = relocate_spec
+        self.clone_spec.config = guestinfo_options(vm_uuid, vm_net, hostname, domain, dnslist)
+
+
 class VmCloneSpec():
     """
     make clone spec
     """
 
-    def __init__(self, template_moref, sys_type, vm_uuid, vm_net, vm_disk, num_cpu, num_core, memoryMB, res_pool_moref, esxi_moref, datastore_moref, poweron, hostname, domain=None, dnslist=None, is_template=False):
+    def __init__(self, template_moref, sys_type, vm_uuid, vm_net, vm_disk, num_cpu, num_core, memoryMB, res_pool_moref, esxi_moref, datastore_moref, poweron, hostname, domain=None, dnslist=None, is_template=False, template_info=None, clone_mode=CLONE_MODE_FULL, snapshot=None):
         """ init clone spec
+        template_info: template_cache.TemplateInfo, template devices and identity are taken from it
+        clone_mode: full or linked, a linked clone shares the disks of snapshot
         """
+        self.template_info = template_info
+        self.clone_mode = clone_mode
         self.clone_spec = vim.vm.CloneSpec()
         self.clone_spec.powerOn = poweron
         self.clone_spec.template = is_template
@@ -691,12 +896,22 @@ class VmCloneSpec():
                                                        num_cpu,
                                                        num_core,
                                                        memoryMB)
+        if clone_mode == CLONE_MODE_LINKED:
+            LOG.info('Linked clone keeps the base disks, edits of template disks are ignored.')
+            # child disks are created on top of the snapshot, the base disks can not be edited
+            self.clone_spec.config.deviceChange = [
+                dc for dc in self.clone_spec.config.deviceChange
+                if not (isinstance(dc.device, vim.vm.device.VirtualDisk) and dc.operation == 'edit')]
+            self.clone_spec.snapshot = snapshot
         self.clone_spec.location = self.make_relocate_spec(res_pool_moref,
                                                            esxi_moref,
                                                            datastore_moref)
+        if clone_mode == CLONE_MODE_LINKED:
+            self.clone_spec.location.diskMoveType = 'createNewChildDiskBacking'
         self.clone_spec.customization = self.make_custom_spec(sys_type, vm_net, hostname,
                                                               domain, dnslist)
 
+    @tracing.traced('vmops.make_config_spec')
     def make_config_spec(self, template_moref, vm_uuid, vm_net, vm_disk, num_cpu=1, num_core=1, memoryMB=512):
         """
         vim.vm.ConfigSpec(numCPUs=1, memoryMB=mem)
@@ -713,9 +928,14 @@ class VmCloneSpec():
 
         # update device config
         dev_changes = []
-        dev_nics = get_vm_nic_adapter_dev(template_moref)
-        dev_disks = get_vm_disk_dev(template_moref)
-        scsi_controllers = get_vm_scsi_controller_dev(template_moref)
+        if self.template_info:
+            dev_nics = self.template_info.nic_devs()
+            dev_disks = self.template_info.disk_devs()
+            scsi_controllers = self.template_info.scsi_controller_devs()
+        else:
+            dev_nics = get_vm_nic_adapter_dev(template_moref)
+            dev_disks = get_vm_disk_dev(template_moref)
+            scsi_controllers = get_vm_scsi_controller_dev(template_moref)
 
         nic_spec_list = _config_vm_nic(dev_nics, vm_net)
         dev_changes += nic_spec_list
@@ -725,6 +945,7 @@ class VmCloneSpec():
         config_spec.deviceChange.extend(dev_changes)
         return config_spec
 
+    @tracing.traced('vmops.make_relocate_spec')
     def make_relocate_spec(self, res_pool_moref, esxi_moref, datastore_moref):
         """
         Create relocate spec.
@@ -757,6 +978,7 @@ class VmCloneSpec():
                 relocate_spec.disk.append(disk_locator)
         return relocate_spec
 
+    @tracing.traced('vmops.make_custom_spec')
     def make_custom_spec(self, sys_type, vm_net, hostname, domain, dnslist):
         """
         Creating vm custom spec
@@ -764,7 +986,10 @@ class VmCloneSpec():
         custom_spec = vim.vm.customization.Specification()
 
         # Make sysprep (hostname/domain/timezone/workgroup) customization
-        sysprep_custom = sysprep_customization(hostname=hostname, domain=domain, sys_type=sys_type)
+        if self.template_info:
+            sysprep_custom = self.template_info.make_identity(hostname, domain)
+        else:
+            sysprep_custom = sysprep_customization(hostname=hostname, domain=domain, sys_type=sys_type)
         custom_spec.identity = sysprep_custom
 
         # Make network customization
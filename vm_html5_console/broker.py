@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Long-running HTML5 console broker.
+
+generate_html5_console logs in, scans every VM by name and writes a page to
+disk for each console. The broker keeps a few logged in sessions and a
+name -> moid index, acquires the webmks ticket directly on the VM and renders
+the console page from an in-memory template, served over a threaded HTTP
+server:
+
+    /console/<vm name>      console page
+    /url/<vm name>          {"url": "wss://..."}
+    /console/<asset>        wmks.min.js, css, ... from the console directory
+    /prefetch?vm=a&vm=b     keep tickets of these vms ready (ticket cache)
+
+Everything but the assets hands out or spends tickets, so it needs the
+broker token, as `Authorization: Bearer <token>` or `?token=<token>`. The
+broker listens on localhost unless told otherwise.
+"""
+from __future__ import print_function
+
+import binascii
+import hmac
+import itertools
+import json
+import logging
+import mimetypes
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs
+
+from pyVim.connect import SmartConnectNoSSL, Disconnect
+from pyVmomi import vim, vmodl
+
+from tools import cli
+from ticket_cache import TicketCache
+
+
+LOG = logging.getLogger(__name__)
+
+CONSOLE_DIR = os.path.join(os.path.split(os.path.realpath(__file__))[0], 'console')
+DEFAULT_POOL_SIZE = 4
+# the name index is reloaded after this many seconds, or on a miss
+DEFAULT_INDEX_TTL = 300
+# misses do not reload the index more often than this
+MIN_RELOAD_INTERVAL = 5
+DEFAULT_BIND = '127.0.0.1'
+TOKEN_ENV = 'CONSOLE_BROKER_TOKEN'
+
+CONSOLE_PAGE_TEMPLATE = """<!DOCTYPE html PUBLIC"-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+  <head>
+    <meta http-equiv="content-type" content="text/html; charset=utf-8" /> <title>%(title)s</title>
+  </head>
+  <body> <link rel="stylesheet" type="text/css" href="%(assets)scss/wmks-all.css" />
+    <script type="text/javascript" src="%(assets)sjquery.js"></script>
+    <script type="text/javascript" src="%(assets)sjquery-ui.min.js"></script>
+    <script type="text/javascript" src="%(assets)swmks.min.js" type="text/javascript"></script>
+    <div id="wmksContainer" style="position:absolute;width:100%%;height:100%%"></div>
+    <script>
+      var wmks = WMKS.createWMKS("wmksContainer",{}).register(WMKS.CONST.Events.CONNECTION_STATE_CHANGE, function(event, data){
+              if (data.state == WMKS.CONST.ConnectionState.CONNECTED) {
+                console.log("connection state change : connected");
+              }
+            });
+      wmks.connect("%(url)s");
+    </script >
+  </body>
+</html>
+"""
+
+
+def _escape(text):
+    return (text.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+def render_console_page(wmks_url, title='Console', assets=''):
+    """
+    Console page for wmks_url, assets: prefix of the wmks/jquery/css files
+    """
+    return CONSOLE_PAGE_TEMPLATE % {'url': _escape(wmks_url), 'title': _escape(title),
+                                    'assets': assets}
+
+
+def ticket_url(ticket):
+    """ vim.VirtualMachineTicket -> wss url """
+    return "wss://%s:%s/ticket/%s" % (ticket.host, ticket.port, ticket.ticket)
+
+
+class SessionPool(object):
+    """
+    A few logged in sessions handed out round robin, re-logged in when one
+    is found not authenticated.
+    """
+    def __init__(self, host, user, password, port=443, size=DEFAULT_POOL_SIZE):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = int(port)
+        self._lock = threading.Lock()
+        self._sis = [None] * size
+        self._next = itertools.cycle(range(size))
+
+    def _connect(self):
+        return SmartConnectNoSSL(host=self.host, user=self.user, pwd=self.password,
+                                 port=self.port)
+
+    def get(self):
+        """
+        Return (slot, service instance)
+        """
+        with self._lock:
+            slot = next(self._next)
+            si = self._sis[slot]
+        if si is None:
+            si = self.reconnect(slot, None)
+        return (slot, si)
+
+    def reconnect(self, slot, stale_si):
+        with self._lock:
+            si = self._sis[slot]
+            if si is not None and si is not stale_si:
+                # already replaced by another thread
+                return si
+        si = self._connect()
+        with self._lock:
+            self._sis[slot] = si
+        return si
+
+    def close(self):
+        with self._lock:
+            sis = [si for si in self._sis if si is not None]
+            self._sis = [None] * len(self._sis)
+        for si in sis:
+            try:
+                Disconnect(si)
+            except Exception as ex:
+                LOG.warning("disconnect failed: %s" % ex)
+
+
+class ConsoleBroker(object):
+    """
+    VM name -> webmks ticket url / console page
+    ticket_cache: optional ticket_cache.TicketCache over acquire_ticket,
+                  console urls are then served from prefetched tickets
+    """
+    def __init__(self, pool, index_ttl=DEFAULT_INDEX_TTL):
+        self.pool = pool
+        self.index_ttl = index_ttl
+        self.ticket_cache = None
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._moids = {}
+        self._loaded_at = None
+
+    def load_index(self, si=None, max_age=None):
+        """
+        Reload name -> moid in one property collection, unless it was
+        loaded less than max_age seconds ago (e.g. by a concurrent request)
+        """
+        with self._index_lock:
+            with self._lock:
+                loaded_at = self._loaded_at
+            if max_age is not None and loaded_at is not None and time.time() - loaded_at < max_age:
+                return len(self._moids)
+            if si is None:
+                si = self.pool.get()[1]
+            content = si.content
+            view = content.viewManager.CreateContainerView(content.rootFolder,
+                                                           [vim.VirtualMachine], True)
+            try:
+                traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+                    name='traverseEntities', path='view', skip=False, type=vim.view.ContainerView)
+                obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+                    obj=view, skip=True, selectSet=[traversal_spec])
+                property_spec = vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.VirtualMachine, pathSet=['name'])
+                filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+                    objectSet=[obj_spec], propSet=[property_spec])
+                obj_contents = content.propertyCollector.RetrieveContents([filter_spec])
+            finally:
+                view.Destroy()
+            moids = {}
+            for obj in obj_contents:
+                for prop in obj.propSet:
+                    moids[prop.val] = obj.obj._moId
+            with self._lock:
+                self._moids = moids
+                self._loaded_at = time.time()
+            LOG.debug("console index loaded %d vms" % len(moids))
+            return len(moids)
+
+    def find_moid(self, vm_name, si=None):
+        with self._lock:
+            age = None if self._loaded_at is None else time.time() - self._loaded_at
+            moid = self._moids.get(vm_name)
+        if age is None or age >= self.index_ttl or (moid is None and age >= MIN_RELOAD_INTERVAL):
+            self.load_index(si, max_age=MIN_RELOAD_INTERVAL)
+            with self._lock:
+                moid = self._moids.get(vm_name)
+        return moid
+
+    def acquire_ticket(self, vm_name):
+        """
+        Return the vim.VirtualMachineTicket of a fresh webmks ticket
+        """
+        (slot, si) = self.pool.get()
+        moid = self.find_moid(vm_name, si)
+        if moid is None:
+            raise KeyError(vm_name)
+        for attempt in (1, 2):
+            vm_ref = vim.VirtualMachine(moid, si._stub)
+            try:
+                return vm_ref.AcquireTicket("webmks")
+            except vim.fault.NotAuthenticated:
+                if attempt == 2:
+                    raise
+                si = self.pool.reconnect(slot, si)
+            except vmodl.fault.ManagedObjectNotFound:
+                # the vm was re-registered, refresh the index once
+                if attempt == 2:
+                    raise KeyError(vm_name)
+                self.load_index(si)
+                with self._lock:
+                    moid = self._moids.get(vm_name)
+                if moid is None:
+                    raise KeyError(vm_name)
+
+    def console_url(self, vm_name):
+        if self.ticket_cache is not None:
+            return ticket_url(self.ticket_cache.take(vm_name))
+        return ticket_url(self.acquire_ticket(vm_name))
+
+    def console_page(self, vm_name, assets=''):
+        return render_console_page(self.console_url(vm_name), vm_name, assets)
+
+
+class _Assets(object):
+    """
+    Console directory files, read once
+    """
+    def __init__(self, base_dir=CONSOLE_DIR):
+        self.base_dir = os.path.realpath(base_dir)
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def get(self, rel_path):
+        with self._lock:
+            if rel_path in self._files:
+                return self._files[rel_path]
+        path = os.path.realpath(os.path.join(self.base_dir, rel_path))
+        if not path.startswith(self.base_dir + os.sep) or not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        asset = (data, mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        with self._lock:
+            self._files[rel_path] = asset
+        return asset
+
+
+def make_handler(broker, assets, token):
+    token = token.encode('utf-8')
+
+    class ConsoleHandler(BaseHTTPRequestHandler):
+        def _send(self, code, body, content_type):
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if code == 200 and content_type.startswith('text/html'):
+                # a page holds a one-time ticket
+                self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _authorized(self, query):
+            auth = self.headers.get('Authorization') or ''
+            if auth.startswith('Bearer '):
+                given = auth[len('Bearer '):].strip()
+            else:
+                given = (parse_qs(query).get('token') or [''])[0]
+            return hmac.compare_digest(given.encode('utf-8'), token)
+
+        def do_GET(self):
+            (path, _, query) = self.path.partition('?')
+            path = unquote(path)
+            try:
+                if path.startswith('/console/'):
+                    asset = assets.get(path[len('/console/'):])
+                    if asset is not None:
+                        self._send(200, asset[0], asset[1])
+                        return
+                if not self._authorized(query):
+                    self._send(403, 'forbidden', 'text/plain')
+                    return
+                if path == '/prefetch':
+                    vm_names = parse_qs(query).get('vm', [])
+                    if broker.ticket_cache is not None:
+                        broker.ticket_cache.prefetch(vm_names)
+                    self._send(200, json.dumps({'vms': len(vm_names)}), 'application/json')
+                    return
+                if path.startswith('/url/'):
+                    url = broker.console_url(path[len('/url/'):])
+                    self._send(200, json.dumps({'url': url}), 'application/json')
+                    return
+                if path.startswith('/console/'):
+                    self._send(200, broker.console_page(path[len('/console/'):]),
+                               'text/html; charset=utf-8')
+                    return
+                self._send(404, 'not found', 'text/plain')
+            except KeyError:
+                self._send(404, 'vm not found', 'text/plain')
+            except Exception as ex:
+                # the fault text is for the log, not for the client
+                LOG.exception(ex)
+                self._send(502, 'ticket failed', 'text/plain')
+
+        def log_message(self, fmt, *args):
+            LOG.debug("%s - %s" % (self.address_string(), fmt % args))
+
+    return ConsoleHandler
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def new_token():
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+def serve(broker, token, bind=DEFAULT_BIND, port=8080, assets_dir=CONSOLE_DIR):
+    """
+    Serve broker until interrupted, token: required for ticket requests
+    """
+    if not token:
+        raise Exception("The console broker needs a token!")
+    server = ThreadedHTTPServer((bind, port), make_handler(broker, _Assets(assets_dir), token))
+    LOG.info("console broker listening on %s:%d" % (bind, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = cli.build_arg_parser()
+    parser.add_argument('--bind', default=DEFAULT_BIND, help='Address to listen on')
+    parser.add_argument('--token', default=os.environ.get(TOKEN_ENV),
+                        help='Token ticket requests must carry (default: $%s, '
+                             'or a new one printed at start)' % TOKEN_ENV)
+    parser.add_argument('--listen-port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--sessions', type=int, default=DEFAULT_POOL_SIZE,
+                        help='vCenter sessions kept open')
+    parser.add_argument('--prefetch-depth', type=int, default=1,
+                        help='Unused tickets kept per likely VM, 0 disables prefetching')
+    args = cli.prompt_for_password(parser.parse_args())
+    logging.basicConfig(level=logging.INFO)
+    token = args.token
+    if not token:
+        token = new_token()
+        print("console broker token: %s" % token)
+
+    pool = SessionPool(args.host, args.user, args.password, args.port, args.sessions)
+    broker = ConsoleBroker(pool)
+    broker.load_index()
+    if args.prefetch_depth > 0:
+        broker.ticket_cache = TicketCache(broker.acquire_ticket, depth=args.prefetch_depth).start()
+    try:
+        serve(broker, token, args.bind, args.listen_port)
+    finally:
+        if broker.ticket_cache is not None:
+            broker.ticket_cache.stop()
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Batch console bundle generation.
+
+Writes the console pages of many VMs (given by name, a name list file, a
+folder or a cluster) from one vCenter session, acquiring the webmks tickets
+concurrently, next to a single copy of the console assets and an index page:
+
+    python console_bundle.py -s vc -u user --cluster cluster1 --output-dir out
+
+Tickets are short lived, open the pages soon after generating them.
+"""
+from __future__ import print_function
+
+import atexit
+import logging
+import os
+import re
+import shutil
+import sys
+import time
+from concurrent import futures
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+from pyVim.connect import SmartConnectNoSSL, Disconnect
+from pyVmomi import vim, vmodl
+
+from tools import cli
+from broker import CONSOLE_DIR, render_console_page, ticket_url
+
+
+LOG = logging.getLogger(__name__)
+
+ASSET_FILES = ['wmks.min.js', 'jquery.js', 'jquery-ui.min.js']
+ASSET_DIRS = ['css', 'img']
+INDEX_FILE = 'index.html'
+
+INDEX_TEMPLATE = """<!DOCTYPE html>
+<html>
+  <head>
+    <meta http-equiv="content-type" content="text/html; charset=utf-8" /> <title>Consoles</title>
+  </head>
+  <body>
+    <p>%(count)d consoles generated %(generated)s</p>
+    <ul>
+%(items)s
+    </ul>
+  </body>
+</html>
+"""
+
+
+def _escape(text):
+    return (text.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+def page_file_name(vm_name):
+    return re.sub(r'[\\/:*?"<>|]', '_', vm_name) + '.html'
+
+
+def page_file_names(vms):
+    """
+    {name: page file name} of vms ({name: vm ref}). Names that end up as the
+    same file (a/b and a_b, A and a on a case-insensitive file system, or
+    the index page) get the vm's moid appended.
+    """
+    by_file = {}
+    for name in vms:
+        by_file.setdefault(page_file_name(name).lower(), []).append(name)
+    files = {}
+    for (file_key, names) in by_file.items():
+        for name in names:
+            if len(names) == 1 and file_key != INDEX_FILE:
+                files[name] = page_file_name(name)
+            else:
+                files[name] = page_file_name("%s-%s" % (name, vms[name]._moId))
+    return files
+
+
+def _collect_names(si, container):
+    """
+    {name: vm ref} of the VMs below container, in one property collection
+    """
+    content = si.content
+    view = content.viewManager.CreateContainerView(container, [vim.VirtualMachine], True)
+    try:
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseEntities', path='view', skip=False, type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=view, skip=True, selectSet=[traversal_spec])
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.VirtualMachine, pathSet=['name', 'config.template'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[obj_spec], propSet=[property_spec])
+        obj_contents = content.propertyCollector.RetrieveContents([filter_spec])
+    finally:
+        view.Destroy()
+    vms = {}
+    for obj in obj_contents:
+        props = dict((prop.name, prop.val) for prop in obj.propSet)
+        # templates have no console
+        if props.get('name') and not props.get('config.template'):
+            vms[props['name']] = obj.obj
+    return vms
+
+
+def _find_cluster(si, name):
+    content = si.content
+    view = content.viewManager.CreateContainerView(content.rootFolder,
+                                                   [vim.ClusterComputeResource], True)
+    try:
+        for cluster in view.view:
+            if cluster.name == name:
+                return cluster
+    finally:
+        view.Destroy()
+    return None
+
+
+def select_vms(si, args):
+    """
+    {name: vm ref} of the VMs picked by --vm/--vm-list/--folder/--cluster
+    """
+    content = si.content
+    names = list(args.vm)
+    if args.vm_list:
+        with open(args.vm_list) as f:
+            names.extend(line.strip() for line in f if line.strip())
+
+    selected = {}
+    if args.folder:
+        folder = content.searchIndex.FindByInventoryPath(args.folder)
+        if folder is None:
+            raise Exception("Not found folder: %s" % args.folder)
+        selected.update(_collect_names(si, folder))
+    if args.cluster:
+        cluster = _find_cluster(si, args.cluster)
+        if cluster is None:
+            raise Exception("Not found cluster: %s" % args.cluster)
+        selected.update(_collect_names(si, cluster))
+    if names:
+        all_vms = _collect_names(si, content.rootFolder)
+        for name in names:
+            if name in all_vms:
+                selected[name] = all_vms[name]
+            else:
+                LOG.warning("Not found vm: %s" % name)
+    return selected
+
+
+def copy_assets(output_dir, console_dir=CONSOLE_DIR):
+    """
+    One shared copy of the console assets, unchanged files are not rewritten
+    """
+    def copy(src, dst):
+        if (os.path.exists(dst) and os.path.getsize(dst) == os.path.getsize(src)
+                and os.path.getmtime(dst) >= os.path.getmtime(src)):
+            return
+        shutil.copy2(src, dst)
+
+    for name in ASSET_FILES:
+        copy(os.path.join(console_dir, name), os.path.join(output_dir, name))
+    for dir_name in ASSET_DIRS:
+        src_dir = os.path.join(console_dir, dir_name)
+        dst_dir = os.path.join(output_dir, dir_name)
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir)
+        for name in os.listdir(src_dir):
+            copy(os.path.join(src_dir, name), os.path.join(dst_dir, name))
+
+
+def write_bundle(vms, output_dir, workers=16):
+    """
+    Acquire the tickets of vms ({name: vm ref}) concurrently, write one page
+    per vm and the index page.
+    @ return: ({name: page file name}, {name: error message})
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    copy_assets(output_dir)
+
+    file_names = page_file_names(vms)
+    pages = {}
+    errors = {}
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = dict((executor.submit(vm_ref.AcquireTicket, "webmks"), name)
+                    for (name, vm_ref) in vms.items())
+        for job in futures.as_completed(jobs):
+            name = jobs[job]
+            try:
+                ticket = job.result()
+            except Exception as ex:
+                errors[name] = str(ex)
+                LOG.warning("Acquire ticket of %s failed: %s" % (name, ex))
+                continue
+            file_name = file_names[name]
+            with open(os.path.join(output_dir, file_name), 'w') as f:
+                f.write(render_console_page(ticket_url(ticket), name))
+            pages[name] = file_name
+
+    items = '\n'.join('      <li><a href="%s">%s</a></li>' % (quote(pages[name]), _escape(name))
+                      for name in sorted(pages))
+    with open(os.path.join(output_dir, INDEX_FILE), 'w') as f:
+        f.write(INDEX_TEMPLATE % {'count': len(pages), 'items': items,
+                                  'generated': time.strftime('%Y-%m-%d %H:%M:%S')})
+    return (pages, errors)
+
+
+def main():
+    parser = cli.add_batch_arguments(cli.build_arg_parser())
+    args = cli.prompt_for_password(parser.parse_args())
+    logging.basicConfig(level=logging.INFO)
+    if not (args.vm or args.vm_list or args.folder or args.cluster):
+        parser.error('one of --vm, --vm-list, --folder or --cluster is required')
+
+    try:
+        si = SmartConnectNoSSL(host=args.host, user=args.user, pwd=args.password,
+                               port=int(args.port))
+    except Exception as e:
+        print('Could not connect to vCenter host')
+        print(repr(e))
+        sys.exit(1)
+    atexit.register(Disconnect, si)
+
+    started = time.time()
+    vms = select_vms(si, args)
+    (pages, errors) = write_bundle(vms, args.output_dir, args.workers)
+    print("%d consoles written to %s in %.1fs, %d failed"
+          % (len(pages), os.path.join(args.output_dir, INDEX_FILE),
+             time.time() - started, len(errors)))
+    for name in sorted(errors):
+        print("  %s: %s" % (name, errors[name]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+WebMKS ticket prefetch cache.
+
+A webmks ticket is single use and only valid for a short while, so the
+console open used to wait for AcquireTicket. TicketCache keeps a few unused
+tickets for the VMs a user is likely to open next (recently opened VMs and
+the VMs of the current view, see prefetch), drops them before they expire
+and refills them in the background, so take() usually returns at once.
+"""
+import collections
+import logging
+import threading
+import time
+from concurrent import futures
+
+
+LOG = logging.getLogger(__name__)
+
+# seconds a webmks ticket is assumed usable after it was acquired
+DEFAULT_TICKET_TTL = 30
+# tickets closer than this to their expiry are never handed out
+DEFAULT_EXPIRY_MARGIN = 5
+# unused tickets kept per likely vm
+DEFAULT_DEPTH = 1
+DEFAULT_MAX_VMS = 200
+# a vm not opened or prefetched for this long is no longer kept warm
+DEFAULT_LIKELY_TTL = 600
+DEFAULT_WORKERS = 4
+# a failed prefetch is retried after RETRY_BACKOFF * 2 ** (failures - 1)
+# seconds, at most MAX_RETRY_BACKOFF; the vm is no longer kept warm after
+# MAX_FAILURES failures in a row
+RETRY_BACKOFF = 1
+MAX_RETRY_BACKOFF = 60
+MAX_FAILURES = 5
+
+
+class TicketCache(object):
+    """
+    @ parameters:
+    @@ acquire: callable(vm_name) -> vim.VirtualMachineTicket,
+                e.g. ConsoleBroker.acquire_ticket
+    """
+    def __init__(self, acquire, ttl=DEFAULT_TICKET_TTL, margin=DEFAULT_EXPIRY_MARGIN,
+                 depth=DEFAULT_DEPTH, max_vms=DEFAULT_MAX_VMS, likely_ttl=DEFAULT_LIKELY_TTL,
+                 workers=DEFAULT_WORKERS):
+        self.acquire = acquire
+        self.ttl = ttl
+        self.margin = margin
+        self.depth = depth
+        self.max_vms = max_vms
+        self.likely_ttl = likely_ttl
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # vm name -> deque of (expires_at, ticket), oldest first
+        self._tickets = {}
+        # vm name -> last time it was opened or prefetched, least recent first
+        self._likely = collections.OrderedDict()
+        # vm name -> acquisitions in flight
+        self._pending = collections.Counter()
+        # vm name -> (failures in a row, no prefetch before)
+        self._failures = {}
+        self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self._thread = None
+        self._stopped = False
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=False)
+
+    def _touch(self, vm_name, now):
+        self._likely.pop(vm_name, None)
+        self._likely[vm_name] = now
+        while len(self._likely) > self.max_vms:
+            (old_name, _) = self._likely.popitem(last=False)
+            self._forget(old_name)
+
+    def _forget(self, vm_name):
+        self._likely.pop(vm_name, None)
+        self._tickets.pop(vm_name, None)
+        self._failures.pop(vm_name, None)
+
+    def prefetch(self, vm_names):
+        """
+        Keep tickets ready for vm_names, e.g. the vms of the current view
+        """
+        now = time.time()
+        with self._lock:
+            for vm_name in vm_names:
+                self._touch(vm_name, now)
+            self._wakeup.notify_all()
+
+    def take(self, vm_name):
+        """
+        Return an unused ticket of vm_name, acquired now if none is ready
+        """
+        now = time.time()
+        ticket = None
+        with self._lock:
+            self._touch(vm_name, now)
+            tickets = self._tickets.get(vm_name)
+            while tickets:
+                (expires_at, cached) = tickets.popleft()
+                if expires_at - self.margin > now:
+                    ticket = cached
+                    break
+            if ticket is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._wakeup.notify_all()
+        if ticket is None:
+            ticket = self.acquire(vm_name)
+        return ticket
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'vms': len(self._likely),
+                    'tickets': sum(len(t) for t in self._tickets.values())}
+
+    def _fill(self, vm_name):
+        try:
+            ticket = self.acquire(vm_name)
+        except Exception as ex:
+            LOG.warning("prefetch ticket of %s failed: %s" % (vm_name, ex))
+            ticket = None
+        with self._lock:
+            self._pending[vm_name] -= 1
+            if self._pending[vm_name] <= 0:
+                del self._pending[vm_name]
+            if ticket is not None:
+                self._failures.pop(vm_name, None)
+                if vm_name in self._likely:
+                    self._tickets.setdefault(vm_name, collections.deque()).append(
+                        (time.time() + self.ttl, ticket))
+            elif vm_name in self._likely:
+                failures = self._failures.get(vm_name, (0, None))[0] + 1
+                if failures >= MAX_FAILURES:
+                    LOG.warning("not prefetching tickets of %s after %d failures"
+                                % (vm_name, failures))
+                    self._forget(vm_name)
+                else:
+                    backoff = min(MAX_RETRY_BACKOFF, RETRY_BACKOFF * 2 ** (failures - 1))
+                    self._failures[vm_name] = (failures, time.time() + backoff)
+            self._wakeup.notify_all()
+
+    def _refill(self, now):
+        """
+        Drop expiring tickets and idle vms, return (vms to fill, next time
+        a ticket expires or a failed vm may be retried)
+        """
+        todo = []
+        next_wakeup = None
+        for vm_name in list(self._likely):
+            if now - self._likely[vm_name] > self.likely_ttl:
+                self._forget(vm_name)
+                continue
+            tickets = self._tickets.get(vm_name)
+            while tickets and tickets[0][0] - self.margin <= now:
+                tickets.popleft()
+            wakeups = [tickets[0][0] - self.margin] if tickets else []
+            retry_at = self._failures.get(vm_name, (0, None))[1]
+            if retry_at is not None and retry_at > now:
+                wakeups.append(retry_at)
+            else:
+                n_ready = len(tickets or ()) + self._pending[vm_name]
+                for _ in range(self.depth - n_ready):
+                    self._pending[vm_name] += 1
+                    todo.append(vm_name)
+            for wakeup in wakeups:
+                next_wakeup = wakeup if next_wakeup is None else min(next_wakeup, wakeup)
+        return (todo, next_wakeup)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._stopped:
+                    return
+                now = time.time()
+                (todo, next_wakeup) = self._refill(now)
+                if not todo:
+                    timeout = self.likely_ttl if next_wakeup is None else max(0.1, next_wakeup - now)
+                    self._wakeup.wait(timeout)
+                    continue
+            for vm_name in todo:
+                self._executor.submit(self._fill, vm_name)
@@ -66,6 +66,50 @@ def build_arg_parser():
     return parser
 
 
+def add_batch_arguments(parser):
+    """
+    Adds the VM selection and output arguments of the batch console mode
+
+    --vm name (repeatable)
+    --vm-list file_with_one_vm_name_per_line
+    --folder inventory/path/of/a/folder
+    --cluster cluster_name
+    --output-dir directory
+    --workers concurrent_ticket_requests
+
+    """
+    parser.add_argument('--vm',
+                        action='append',
+                        default=[],
+                        help='VM name, may be given several times')
+
+    parser.add_argument('--vm-list',
+                        action='store',
+                        help='File with one VM name per line')
+
+    parser.add_argument('--folder',
+                        action='store',
+                        help='Inventory path of a folder, e.g. DC1/vm/project, '
+                             'all VMs below it')
+
+    parser.add_argument('--cluster',
+                        action='store',
+                        help='Cluster name, all VMs of the cluster')
+
+    parser.add_argument('--output-dir',
+                        default='consoles',
+                        action='store',
+                        help='Directory the console pages and assets are written to')
+
+    parser.add_argument('--workers',
+                        type=int,
+                        default=16,
+                        action='store',
+                        help='Tickets acquired at once')
+
+    return parser
+
+
 def prompt_for_password(args):
     """
     if no password is specified on the command line, prompt for it
@@ -22,8 +22,12 @@ SHOULD include dedicated exception logging.
 
 """
 
-#from oslo_log import log as logging
-#
+from oslo_log import log as logging
+
+from i18n import _, _LE
+
+LOG = logging.getLogger(__name__)
+
 #import webob.exc
 #from webob import util as woutil
 #
@@ -554,9 +558,9 @@ class Invalid(NovaException):
 #    code = 412
 #
 #
-#class NotFound(NovaException):
-#    msg_fmt = _("Resource could not be found.")
-#    code = 404
+class NotFound(NovaException):
+    msg_fmt = _("Resource could not be found.")
+    code = 404
 #
 #
 #class AgentBuildNotFound(NotFound):
@@ -606,12 +610,12 @@ class Invalid(NovaException):
 #    msg_fmt = _("Snapshot %(snapshot_id)s could not be found.")
 #
 #
-#class DiskNotFound(NotFound):
-#    msg_fmt = _("No disk at %(location)s")
+class DiskNotFound(NotFound):
+    msg_fmt = _("No disk at %(location)s")
 #
 #
-#class VolumeDriverNotFound(NotFound):
-#    msg_fmt = _("Could not find a handler for %(driver_type)s volume.")
+class VolumeDriverNotFound(NotFound):
+    msg_fmt = _("Could not find a handler for %(driver_type)s volume.")
 #
 #
 #class InvalidImageRef(Invalid):
@@ -1268,8 +1272,8 @@ class FileNotFound(NotFound):
 #    msg_fmt = _("%(path)s is not on local storage: %(reason)s")
 #
 #
-#class StorageError(NovaException):
-#    msg_fmt = _("Storage error: %(reason)s")
+class StorageError(NovaException):
+    msg_fmt = _("Storage error: %(reason)s")
 #
 #
 #class MigrationError(NovaException):
@@ -1347,8 +1351,8 @@ class FileNotFound(NotFound):
 #    msg_fmt = _("Insufficient free memory on compute node to start %(uuid)s.")
 #
 #
-#class NoValidHost(NovaException):
-#    msg_fmt = _("No valid host was found. %(reason)s")
+class NoValidHost(NovaException):
+    msg_fmt = _("No valid host was found. %(reason)s")
 #
 #
 #class MaxRetriesExceeded(NoValidHost):
@@ -2189,3 +2193,11 @@ class NoValidCluster(NovaException):
     msg_fmt = _("No valid host was found. %(reason)s")
 
 
+class NoValidDatacenter(NovaException):
+    msg_fmt = _("No valid datacenter was found.")
+
+
+class NoValidDatastore(NovaException):
+    msg_fmt = _("No valid datastore was found.")
+
+
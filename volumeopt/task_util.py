@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import time
 
+from pyVmomi import vim, vmodl
 
 from i18n import _, _LE, _LW
 from oslo_log import log as logging
@@ -9,28 +11,43 @@ from oslo_log import log as logging
 
 LOG = logging.getLogger(__name__)
 
+TASK_POLL_INTERVAL = 0.1
+TASK_POLL_MAX_INTERVAL = 1.0
+
 
 def wait_for_task(task):
     """Wait for a vCenter task to finish.
+    Short tasks return quickly, long ones are polled at most once a second.
     """
+    interval = TASK_POLL_INTERVAL
     while True:
-        if task.info.state == 'success':
-            return (True, task.info)
-        elif task.info.state == 'error':
-            return (False, task.info)
+        info = task.info
+        if info.state == 'success':
+            return (True, info)
+        elif info.state == 'error':
+            return (False, info)
+        time.sleep(interval)
+        interval = min(interval * 2, TASK_POLL_MAX_INTERVAL)
 
 
 def create_inventory_folder(folder_ref, new_folder_name):
+    vmfolder = None
     try:
         vmfolder = folder_ref.CreateFolder(new_folder_name)
     except vim.fault.DuplicateName:
-        LOG.error('Another object in the same folder has the target name.')
+        # created concurrently, use the existing one
+        LOG.warning('Another object in the same folder has the target name.')
+        for child in folder_ref.childEntity:
+            if isinstance(child, vim.Folder) and child.name == new_folder_name:
+                vmfolder = child
+                break
     except vim.fault.InvalidName:
         LOG.error(_LE('The new folder name (%s) is not a valid entity name.'), new_folder_name)
     return vmfolder
 
 
-def create_vm_task(folder_ref, resource_pool, host_ref, create_spec):
+def create_vm_task(folder_ref, resource_pool, host_ref, create_spec,
+                   raise_on_error=False):
     """For create vm methods."""
     LOG.debug("Creating vm with spec: %s.", create_spec)
     task = folder_ref.CreateVM_Task(config=create_spec,
@@ -41,7 +58,11 @@ def create_vm_task(folder_ref, resource_pool, host_ref, create_spec):
     if task_state:
         LOG.info("Successfully created volume vm_ref: %s.", vm_ref)
     else:
-        LOG.info("Created vm error !")
+        msg = task_info.error.msg if task_info.error else 'unknown error'
+        LOG.error(_LE("Created vm %(name)s error: %(msg)s"),
+                  {'name': create_spec.name, 'msg': msg})
+        if raise_on_error:
+            raise Exception(msg)
     return vm_ref
 
 def destroy_vm_task(vm_ref):
@@ -56,3 +77,8 @@ def reconfigure_vm(vm_ref, config_spec):
     """Reconfigure a VM according to the config spec."""
     reconfig_task =vm_ref.ReconfigVM_Task(spec=config_spec)
     return wait_for_task(reconfig_task)
+
+def relocate_vm(vm_ref, relocate_spec):
+    """Relocate a VM according to the relocate spec."""
+    relocate_task = vm_ref.RelocateVM_Task(spec=relocate_spec)
+    return wait_for_task(relocate_task)
@@ -5,7 +5,7 @@
 """
 from __future__ import absolute_import
 
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 
 import constants
 
@@ -264,6 +264,61 @@ def get_vm_moref(content, name=None, uuid=None, moid=None):
     return vm_obj
 
 
+def _retrieve_vm_contents(content, obj_specs, path_set):
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.VirtualMachine, pathSet=path_set)
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=obj_specs, propSet=[property_spec])
+    return content.propertyCollector.RetrieveContents([filter_spec])
+
+
+def get_vm_properties(content, moids=None, path_set=None):
+    """
+    Return the properties of many VMs in one property collector pass
+    @ parameters:
+    @@ content: vim.ServiceInstanceContent
+    @@ moids: VM moids (list), None collects every VM
+    @@ path_set: property paths, e.g. ['name', 'config.hardware.device']
+    @ return: {moid: {'obj': vm ref, <path>: value}}, unknown moids are missing
+    """
+    path_set = path_set or ['name']
+    if moids is None:
+        container = content.viewManager.CreateContainerView(content.rootFolder,
+                                                            [vim.VirtualMachine],
+                                                            True)
+        try:
+            traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+                name='traverseEntities', path='view', skip=False,
+                type=vim.view.ContainerView)
+            obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+                obj=container, skip=True, selectSet=[traversal_spec])
+            obj_contents = _retrieve_vm_contents(content, [obj_spec], path_set)
+        finally:
+            container.Destroy()
+    else:
+        stub = content.propertyCollector._stub
+        vm_refs = dict((moid, vim.VirtualMachine(moid, stub)) for moid in set(moids))
+        while True:
+            obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=vm_ref, skip=False)
+                         for vm_ref in vm_refs.values()]
+            if not obj_specs:
+                return {}
+            try:
+                obj_contents = _retrieve_vm_contents(content, obj_specs, path_set)
+                break
+            except vmodl.fault.ManagedObjectNotFound as ex:
+                # a deleted (or mistyped) VM fails the whole call, drop it and retry
+                if ex.obj is None or vm_refs.pop(ex.obj._moId, None) is None:
+                    raise
+
+    vms = {}
+    for obj_content in obj_contents:
+        props = {'obj': obj_content.obj}
+        for prop in obj_content.propSet:
+            props[prop.name] = prop.val
+        vms[obj_content.obj._moId] = props
+    return vms
+
 def get_portgroup_moref(content, name=None, moid=None):
     """
     Return a portgroup object by name, if name is None return None
@@ -17,8 +17,10 @@ VmdkInfo = collections.namedtuple('VmdkInfo', ['path', 'adapter_type',
                                                'device'])
 
 
-def get_vmdk_info(vm_ref, uuid=None):
-    """Returns information for the primary VMDK attached to the given VM."""
+def get_vmdk_info(vm_ref, uuid=None, devices=None):
+    """Returns information for the primary VMDK attached to the given VM.
+    Pass devices when the hardware devices of vm_ref are already at hand.
+    """
     vmdk_file_path = None
     vmdk_controller_key = None
     disk_type = None
@@ -32,7 +34,9 @@ def get_vmdk_info(vm_ref, uuid=None):
     vmdk_device = None
 
     adapter_type_dict = {}
-    hardware_devices = vm_ref.config.hardware.device
+    hardware_devices = devices
+    if hardware_devices is None:
+        hardware_devices = vm_ref.config.hardware.device
     for device in hardware_devices:
         if device.__class__.__name__ == "vim.vm.device.VirtualDisk":
             if device.backing.__class__.__name__ == "vim.vm.device.VirtualDisk.FlatVer2BackingInfo":
@@ -86,25 +90,26 @@ def _get_device_disk_type(device):
 
 
 def _find_allocated_slots(devices):
-    """Return dictionary which maps controller_key to list of allocated unit
-    numbers for that controller_key.
+    """Return dictionary which maps controller_key to the set of allocated
+    unit numbers for that controller_key.
     """
     taken = {}
     for device in devices:
         if hasattr(device, 'controllerKey') and hasattr(device, 'unitNumber'):
-            unit_numbers = taken.setdefault(device.controllerKey, [])
-            unit_numbers.append(device.unitNumber)
+            taken.setdefault(device.controllerKey, set()).add(device.unitNumber)
         if _is_scsi_controller(device):
             # the SCSI controller sits on its own bus
-            unit_numbers = taken.setdefault(device.key, [])
-            unit_numbers.append(device.scsiCtlrUnitNumber)
+            taken.setdefault(device.key, set()).add(device.scsiCtlrUnitNumber)
     return taken
 
 
 def _find_controller_slot(controller_keys, taken, max_unit_number):
     for controller_key in controller_keys:
+        used = taken.get(controller_key, ())
+        if len(used) >= max_unit_number:
+            continue
         for unit_number in range(max_unit_number):
-            if unit_number not in taken.get(controller_key, []):
+            if unit_number not in used:
                 return controller_key, unit_number
 
 
@@ -132,12 +137,14 @@ def _get_bus_number_for_scsi_controller(devices):
     raise vexc.VMwareDriverException(msg)
 
 
-def allocate_controller_key_and_unit_number(vm_ref, adapter_type):
+def allocate_controller_key_and_unit_number(vm_ref, adapter_type, devices=None):
     """This function inspects the current set of hardware devices and returns
     controller_key and unit_number that can be used for attaching a new virtual
-    disk to adapter with the given adapter_type.
+    disk to adapter with the given adapter_type. Pass devices when the
+    hardware devices of vm_ref are already at hand.
     """
-    devices = vm_ref.config.hardware.device
+    if devices is None:
+        devices = vm_ref.config.hardware.device
 
     taken = _find_allocated_slots(devices)
 
@@ -153,12 +160,13 @@ def allocate_controller_key_and_unit_number(vm_ref, adapter_type):
 
     # create new controller with the specified type and return its spec
     controller_key = -101
+    bus_number = 0
     if adapter_type in constants.SCSI_ADAPTER_TYPES:
         bus_number = _get_bus_number_for_scsi_controller(devices)
 
     controller_spec = spec_util.create_controller_add_spec(adapter_type,
                                                            controller_key=controller_key,
-                                                           bus_number=0)
+                                                           bus_number=bus_number)
     return controller_key, 0, controller_spec
 
 
@@ -7,14 +7,20 @@ Created Time: Thu 29 Mar 2018 03:25:37 PM CST
 File Name   : volumeopt.py
 Description : 
 '''
-from pyVmomi import vim
+import collections
+import threading
+
+from concurrent import futures
+
+from pyVmomi import vim, vmodl
 
 from oslo_log import log as logging
 from oslo_utils import units
 
-from i18n import _, _LE, _LW
+from i18n import _, _LE, _LI, _LW
 
 import constants
+import exception
 import vm_util
 import utils
 import spec_util
@@ -37,14 +43,36 @@ CREATE_PARAM_TEMP_BACKING = 'temp_backing'
 
 CREATE_PARAM_ADAPTER_TYPE = 'adapter_type'
 
+VOLUME_ACTION_ATTACH = 'attach'
+VOLUME_ACTION_DETACH = 'detach'
+# instances reconfigured in parallel by process_volume_requests
+DEFAULT_VOLUME_WORKERS = 16
+_VOLUME_PATH_SET = ['name',
+                    'config.uuid',
+                    'config.hardware.device',
+                    'runtime.powerState']
+# relocations running at once per target datastore during consolidation
+DEFAULT_CONSOLIDATE_PER_DATASTORE = 2
+DEFAULT_CONSOLIDATE_WORKERS = 8
+_DISPLACED_PATH_SET = ['name',
+                       'config.uuid',
+                       'config.hardware.device',
+                       'config.extraConfig']
+VOLUME_DETAILS_PREFIX = 'volume-'
+
 
 class VMwareVmOps(object):
     """Manages vm operations. """
 
-    def __init__(self, content, max_objects=100):
+    def __init__(self, content, max_objects=100, placement=None, folder_index=None):
         self._content = content
         self._max_objects = max_objects
         self._folder_cache = {}
+        # optional shared folder index (sdk.tools.folder_index.FolderIndex)
+        self._folder_index = folder_index
+        # optional placement engine (sdk.tools.placement.PlacementEngine),
+        # picks host and datastore when create_vm is not given them
+        self._placement = placement
 
     def _get_instance_group_folder(self, dc_ref, folders):
         """Get inventory folder for organizing instance.
@@ -54,6 +82,21 @@ class VMwareVmOps(object):
         folders = folders or []
         folder_names = ['Instance'] + folders
 
+        if self._folder_index is not None:
+            return self._folder_index.get_or_create('/'.join(folder_names),
+                                                    parent=dc_ref.vmFolder)
+
+        cache_key = (dc_ref._moId, tuple(folder_names))
+        vmfolder = self._folder_cache.get(cache_key)
+        if vmfolder is not None:
+            try:
+                # one property read, the folder may have been deleted
+                vmfolder.name
+                return vmfolder
+            except vmodl.fault.ManagedObjectNotFound:
+                LOG.info(_LI("Cached folder %s is gone, looking it up again."),
+                         vmfolder._moId)
+                self._folder_cache.pop(cache_key, None)
         vmfolder = dc_ref.vmFolder
         f_ref = None
         for folder_name in folder_names:
@@ -62,6 +105,7 @@ class VMwareVmOps(object):
                 vmfolder = f_ref
             else:
                 vmfolder = task_util.create_inventory_folder(vmfolder, folder_name)
+        self._folder_cache[cache_key] = vmfolder
         return vmfolder
 
     def _get_storage_profile_id(self, instance):
@@ -120,6 +164,34 @@ class VMwareVmOps(object):
         #             "disk_type": "thin", "adapter_type": "lsiLogicsas",
         #             "hw_version": "vmx-11", "description": "This is vm"}
 
+        placement = None
+        if self._placement and not (ds_moid and host_moid):
+            placement = self._placement.place({'num_cpu': instance['vcpus'],
+                                               'memory_mb': instance['memory_mb'],
+                                               'disk_gb': instance['size'],
+                                               'cluster_moid': cluster_moid,
+                                               'host_moid': host_moid,
+                                               'datastore_moid': ds_moid})
+            LOG.debug("Placed vm %(name)s on %(host)s/%(ds)s",
+                      {'name': instance['name'], 'host': placement['host_name'],
+                       'ds': placement['datastore_name']})
+            cluster_moid = cluster_moid or placement['cluster_moid']
+            host_moid = placement['host_moid']
+            ds_moid = placement['datastore_moid']
+        try:
+            vm_ref = self._create_vm(instance, dc_moid, cluster_moid, ds_moid,
+                                     host_moid, folders)
+        except Exception:
+            if placement:
+                self._placement.release(placement)
+            raise
+        if placement and vm_ref is None:
+            # the create task failed, its placement is not used
+            self._placement.release(placement)
+        return vm_ref
+
+    def _create_vm(self, instance, dc_moid, cluster_moid, ds_moid, host_moid,
+                   folders):
         (resource_pool, host_ref, ds_ref,
                 folder_ref) = self._select_ds_for_volume(dc_moid,
                                                          cluster_moid,
@@ -192,33 +264,58 @@ class VMwareVmOps(object):
     def _attach_volume_vmdk(self, instance, volume, adapter_type=None):
         """Attach vmdk volume storage to VM instance."""
         LOG.debug("_attach_volume_vmdk: %s", volume=volume, instance=instance)
-        vm_ref = utils.get_vm_moref(self._content, moid=instance['moid'])
-        volume_ref = utils.get_vm_moref(self._content, moid=volume['moid'])
-        volume_uuid = volume_ref.config.uuid
-
-        # Get details required for adding disk device such as
-        # adapter_type, disk_type
-        vmdk = vm_util.get_vmdk_info(volume_ref)
-        vmdk_path = vmdk.path
-        vmdk_uuid = vmdk.device.backing.uuid
-        adapter_type = adapter_type or vmdk.adapter_type
-
+        (vm, volume_vm) = self._get_volume_request_vms(instance, volume)
+        self._attach_volume_request(vm, volume_vm, vm['config.hardware.device'],
+                                    adapter_type)
+
+    def _get_volume_request_vms(self, instance, volume):
+        """Fetch instance and volume backing in one property collection."""
+        vms = utils.get_vm_properties(self._content,
+                                      [instance['moid'], volume['moid']],
+                                      _VOLUME_PATH_SET)
+        for moid in (instance['moid'], volume['moid']):
+            if moid not in vms:
+                raise exception.InstanceNotFound(instance_id=moid)
+        return (vms[instance['moid']], vms[volume['moid']])
+
+    def _check_disk_hotplug(self, vm, adapter_type):
         # IDE does not support disk hotplug
         if adapter_type == constants.ADAPTER_TYPE_IDE:
-            state = vm_ref.runtime.powerState
+            state = vm.get('runtime.powerState') or ''
             if state.lower() != 'poweredoff':
                 raise exception.Invalid(_('%s does not support disk '
                                           'hotplug.') % adapter_type)
 
-        # Attach the disk to virtual machine instance
-        self._attach_disk_to_vm(vm_ref, adapter_type, vmdk.disk_type,
-                                vmdk_path=vmdk_path,
-                                disk_uuid=vmdk_uuid)
-
-        # Store the uuid of the volume_device
-        self._update_volume_details(vm_ref, volume_uuid, vmdk_uuid)
-
-        LOG.debug("Attached VMDK: %s", vmdk_path, instance=instance)
+    def _attach_volume_request(self, vm, volume_vm, devices, adapter_type=None):
+        """Attach the disk of volume_vm and store the volume details in one
+        reconfigure. vm and volume_vm are utils.get_vm_properties entries.
+        """
+        # Get details required for adding disk device such as
+        # adapter_type, disk_type
+        vmdk = vm_util.get_vmdk_info(volume_vm['obj'],
+                                     devices=volume_vm['config.hardware.device'])
+        if vmdk.device is None:
+            raise exception.DiskNotFound(
+                message=_("Unable to find disk of volume %s.") % volume_vm['name'])
+        vmdk_uuid = vmdk.device.backing.uuid
+        adapter_type = adapter_type or vmdk.adapter_type
+        self._check_disk_hotplug(vm, adapter_type)
+
+        # Attach the disk and store the uuid of the volume_device
+        extra_config = self._volume_details_config(volume_vm['config.uuid'],
+                                                   vmdk_uuid)
+        (state, info) = self._attach_disk_to_vm(vm['obj'], adapter_type,
+                                                vmdk.disk_type,
+                                                vmdk_path=vmdk.path,
+                                                disk_uuid=vmdk_uuid,
+                                                extra_config=extra_config,
+                                                devices=devices)
+        if not state:
+            raise exception.StorageError(
+                reason=_("Attach volume %(volume)s to %(vm)s failed: %(error)s")
+                % {'volume': volume_vm['name'], 'vm': vm['name'],
+                   'error': info.error.msg})
+        LOG.debug("Attached VMDK %s to %s", vmdk.path, vm['name'])
 
 #    def _attach_volume_iscsi(self, connection_info, instance,
 #                             adapter_type=None):
@@ -253,13 +350,20 @@ class VMwareVmOps(object):
                            disk_size=None,
                            linked_clone=False,
                            device_name=None,
-                           disk_io_limits=None):                                                                                                                                                                       
-        """Attach disk to VM by reconfiguration."""
+                           disk_io_limits=None,
+                           extra_config=None,
+                           devices=None):
+        """Attach disk to VM by reconfiguration.
+
+        extra_config: vim.option.OptionValue list written by the same reconfigure
+        devices: hardware devices of vm_ref when already at hand
+        """
         instance_name = vm_ref.name
         (controller_key, unit_number,
          controller_spec) = vm_util.\
                  allocate_controller_key_and_unit_number(vm_ref,
-                                                         adapter_type)
+                                                         adapter_type,
+                                                         devices)
 
         vmdk_attach_config_spec = spec_util.\
                 get_vmdk_attach_config_spec(disk_type, vmdk_path, disk_size,
@@ -268,6 +372,8 @@ class VMwareVmOps(object):
                                             disk_uuid, disk_io_limits)
         if controller_spec:
             vmdk_attach_config_spec.deviceChange.append(controller_spec)
+        if extra_config:
+            vmdk_attach_config_spec.extraConfig = extra_config
 
         LOG.debug("Reconfiguring VM instance %(instance_name)s to attach "
                   "disk %(vmdk_path)s or device %(device_name)s with type "
@@ -275,12 +381,13 @@ class VMwareVmOps(object):
                   {'instance_name': instance_name, 'vmdk_path': vmdk_path,
                    'device_name': device_name, 'disk_type': disk_type})
 
-        task_util.reconfigure_vm(vm_ref, vmdk_attach_config_spec)
+        result = task_util.reconfigure_vm(vm_ref, vmdk_attach_config_spec)
         LOG.debug("Reconfigured VM instance %(instance_name)s to attach "
                   "disk %(vmdk_path)s or device %(device_name)s with type "
                   "%(disk_type)s",
                   {'instance_name': instance_name, 'vmdk_path': vmdk_path,
                    'device_name': device_name, 'disk_type': disk_type})
+        return result
 
 
     def detach_volume(self, driver_type, instance, volume):
@@ -299,41 +406,117 @@ class VMwareVmOps(object):
 
     def _detach_volume_vmdk(self, instance, volume):
         """Detach volume storage to VM instance."""
-        vm_ref = utils.get_vm_moref(self._content, moid=instance['moid'])
-        # Detach Volume from VM
         LOG.debug("_detach_volume_vmdk: %s", volume=volume, instance=instance)
-        volume_ref = utils.get_vm_moref(self._content, moid=volume['moid'])
-        volume_uuid = volume_ref.config.uuid
-
-        import pdb;pdb.set_trace()
+        (vm, volume_vm) = self._get_volume_request_vms(instance, volume)
+        self._detach_volume_request(vm, volume_vm, vm['config.hardware.device'])
 
-        device = self._get_vmdk_backed_disk_device(vm_ref, volume_ref)
-
-        # Get disk uuid
-        disk_uuid = device.backing.uuid
+    def _detach_volume_request(self, vm, volume_vm, devices):
+        """Detach the disk of volume_vm and remove the volume details in one
+        reconfigure. vm and volume_vm are utils.get_vm_properties entries.
+        """
+        original_device = vm_util.get_vmdk_volume_disk(
+            volume_vm['config.hardware.device'])
+        if original_device is None:
+            raise exception.DiskNotFound(
+                message=_("Unable to find disk of volume %s.") % volume_vm['name'])
+        device = vm_util.get_vmdk_backed_disk_device(devices,
+                                                     original_device.backing.uuid)
+        if device is None:
+            raise exception.DiskNotFound(message=_("Unable to find volume disk."))
 
         # Get details required for adding disk device such as
         # adapter_type, disk_type
-        vmdk = vm_util.get_vmdk_info(vm_ref, disk_uuid)
+        vmdk = vm_util.get_vmdk_info(vm['obj'], device.backing.uuid,
+                                     devices=devices)
+        self._check_disk_hotplug(vm, vmdk.adapter_type)
+
+        if original_device.backing.fileName != device.backing.fileName:
+            # displaced by SDRS, consolidation re-attaches the disk
+            self._consolidate_vmdk_volume({'moid': vm['obj']._moId}, vm['obj'],
+                                          device, volume_vm['obj'],
+                                          adapter_type=vmdk.adapter_type,
+                                          disk_type=vmdk.disk_type,
+                                          original_device=original_device)
+            device = vm_util.get_vmdk_backed_disk_device(
+                vm['obj'].config.hardware.device, original_device.backing.uuid)
 
-        # IDE does not support disk hotplug
-        if vmdk.adapter_type == constants.ADAPTER_TYPE_IDE:
-            state = vm_ref.runtime.powerState
-            if state.lower() != 'poweredoff':
-                raise exception.Invalid(_('%s does not support disk '
-                                          'hotplug.') % vmdk.adapter_type)
-
-        self._consolidate_vmdk_volume(instance, vm_ref, device, volume_ref,
-                                      adapter_type=vmdk.adapter_type,
-                                      disk_type=vmdk.disk_type)
-
-        self.detach_disk_from_vm(vm_ref, device)
-                                                                                                                                                                   
         # Remove key-value pair <volume_id, vmdk_uuid> from instance's
         # extra config. Setting value to empty string will remove the key.
-        self._update_volume_details(vm_ref, volume_uuid, "")
-
-        LOG.debug("Detached VMDK: %s", volume_uuid, instance=instance)
+        extra_config = self._volume_details_config(volume_vm['config.uuid'], "")
+        (state, info) = self.detach_disk_from_vm(vm['obj'], device,
+                                                 extra_config=extra_config)
+        if not state:
+            raise exception.StorageError(
+                reason=_("Detach volume %(volume)s from %(vm)s failed: %(error)s")
+                % {'volume': volume_vm['name'], 'vm': vm['name'],
+                   'error': info.error.msg})
+        LOG.debug("Detached VMDK %s from %s", volume_vm['config.uuid'],
+                  vm['name'])
+
+    def process_volume_requests(self, requests,
+                                max_workers=DEFAULT_VOLUME_WORKERS):
+        """Attach and detach many vmdk volumes at once.
+
+        Instances and volume backings are fetched in one property collection.
+        Requests of one instance run in order, one at a time; different
+        instances are reconfigured in parallel, max_workers at a time. Each
+        request is a single reconfigure that also updates the volume details.
+
+        :param requests: list of {'action': 'attach' or 'detach',
+                                  'instance': {'moid': ..},
+                                  'volume': {'moid': ..},
+                                  'adapter_type': optional, attach only}
+        :return: list in requests order of
+                 {'action': .., 'instance': moid, 'volume': moid,
+                  'error': msg or None}
+        """
+        results = [{'action': r.get('action'), 'instance': r['instance']['moid'],
+                    'volume': r['volume']['moid'], 'error': None}
+                   for r in requests]
+        moids = set()
+        for result in results:
+            moids.update((result['instance'], result['volume']))
+        vms = utils.get_vm_properties(self._content, moids, _VOLUME_PATH_SET)
+
+        # instance moid -> [(request, result)] in request order
+        vm_requests = collections.OrderedDict()
+        for (request, result) in zip(requests, results):
+            if result['action'] not in (VOLUME_ACTION_ATTACH, VOLUME_ACTION_DETACH):
+                result['error'] = "Unsupported volume action: %s" % result['action']
+                continue
+            missing = [m for m in (result['instance'], result['volume']) if m not in vms]
+            if missing:
+                result['error'] = "Not found VM: %s" % ', '.join(missing)
+                continue
+            vm_requests.setdefault(result['instance'], []).append((request, result))
+
+        LOG.debug("Processing %(n)d volume requests on %(v)d instances.",
+                  {'n': len(requests), 'v': len(vm_requests)})
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            jobs = [executor.submit(self._process_vm_volume_requests, vms[moid],
+                                    vms, vm_jobs)
+                    for (moid, vm_jobs) in vm_requests.items()]
+            futures.wait(jobs)
+        return results
+
+    def _process_vm_volume_requests(self, vm, vms, jobs):
+        """Run the volume requests of one instance one after another."""
+        devices = vm['config.hardware.device']
+        for (i, (request, result)) in enumerate(jobs):
+            volume_vm = vms[result['volume']]
+            try:
+                if result['action'] == VOLUME_ACTION_ATTACH:
+                    self._attach_volume_request(vm, volume_vm, devices,
+                                                request.get('adapter_type'))
+                else:
+                    self._detach_volume_request(vm, volume_vm, devices)
+            except Exception as ex:
+                LOG.exception(ex)
+                result['error'] = str(ex)
+            if i + 1 < len(jobs):
+                # slots and device keys of the next request come from the
+                # device list after this reconfigure
+                devices = vm['obj'].config.hardware.device
 
 #    def _detach_volume_iscsi(self, connection_info, instance):
 #        """Detach volume storage to VM instance."""
@@ -380,22 +563,30 @@ class VMwareVmOps(object):
         hardware_devices = volume_ref.config.hardware.device
         return vm_util.get_vmdk_volume_disk(hardware_devices)
 
-    def detach_disk_from_vm(self, vm_ref, device, destroy_disk=False):
-        """Detach disk from VM by reconfiguration."""
+    def detach_disk_from_vm(self, vm_ref, device, destroy_disk=False,
+                            extra_config=None):
+        """Detach disk from VM by reconfiguration.
+
+        extra_config: vim.option.OptionValue list written by the same reconfigure
+        """
         instance_name = vm_ref.name
         vmdk_detach_config_spec = spec_util.\
                 get_vmdk_detach_config_spec(device, destroy_disk)
+        if extra_config:
+            vmdk_detach_config_spec.extraConfig = extra_config
         disk_key = device.key
         LOG.debug("Reconfiguring VM instance %(instance_name)s to detach "
                   "disk %(disk_key)s",
                   {'instance_name': instance_name, 'disk_key': disk_key})
-        task_util.reconfigure_vm(vm_ref, vmdk_detach_config_spec)
+        result = task_util.reconfigure_vm(vm_ref, vmdk_detach_config_spec)
         LOG.debug("Reconfigured VM instance %(instance_name)s to detach "
                   "disk %(disk_key)s",
                   {'instance_name': instance_name, 'disk_key': disk_key})
+        return result
 
     def _consolidate_vmdk_volume(self, instance, vm_ref, device, volume_ref,
-                                 adapter_type=None, disk_type=None):
+                                 adapter_type=None, disk_type=None,
+                                 original_device=None):
         """Consolidate volume backing VMDK files if needed.
 
         The volume's VMDK file attached to an instance can be moved by SDRS
@@ -413,9 +604,11 @@ class VMwareVmOps(object):
 
         In the case of a volume boot the we need to ensure that the volume
         is on the datastore of the instance.
-        """
 
-        original_device = self._get_vmdk_base_volume_device(volume_ref)
+        original_device: the volume backing's disk when already at hand
+        """
+        if original_device is None:
+            original_device = self._get_vmdk_base_volume_device(volume_ref)
 
         original_device_path = original_device.backing.fileName
         current_device_path = device.backing.fileName
@@ -445,33 +638,147 @@ class VMwareVmOps(object):
                    'host': host})
         try:
             self._relocate_vmdk_volume(volume_ref, res_pool, datastore, host)
-        except exception.FileNotFound:
+        except vim.fault.FileNotFound:
             # Volume's vmdk was moved; remove the device so that we can
             # relocate the volume.
             LOG.warn(_LW("Virtual disk: %s of volume's backing not found."),
                      original_device_path, exc_info=True)
             LOG.debug("Removing disk device of volume's backing and "
                       "reattempting relocate.")
-            self.detach_disk_from_vm(volume_ref, instance, original_device)
+            self.detach_disk_from_vm(volume_ref, original_device)
             detached = True
             self._relocate_vmdk_volume(volume_ref, res_pool, datastore, host)
 
         # Volume's backing is relocated now; detach the old vmdk if not done
         # already.
         if not detached:
-            self.detach_disk_from_vm(volume_ref, instance, original_device,
+            self.detach_disk_from_vm(volume_ref, original_device,
                                      destroy_disk=True)
 
         # Attach the current volume to the volume_ref
-        self._attach_disk_to_vm(volume_ref, instance,
-                               adapter_type, disk_type,
-                               vmdk_path=current_device_path)
+        self._attach_disk_to_vm(volume_ref, adapter_type, disk_type,
+                                vmdk_path=current_device_path)
 
-    def _update_volume_details(self, vm_ref, volume_uuid, device_uuid):
-        # Store the uuid of the volume_device
-        volume_option = 'volume-%s' % volume_uuid
+    def _relocate_vmdk_volume(self, volume_ref, res_pool, datastore,
+                              host=None):
+        """Relocate the volume's backing to datastore, keeping the disk
+        chain intact.
+        """
+        relocate_spec = spec_util.relocate_vm_spec(datastore, host)
+        relocate_spec.pool = res_pool
+        (state, info) = task_util.relocate_vm(volume_ref, relocate_spec)
+        if not state:
+            if info.error is not None:
+                raise info.error
+            raise Exception("Relocate volume backing %s failed" % volume_ref._moId)
+
+    def find_displaced_volumes(self):
+        """List the attached volumes whose disk was moved away from the
+        volume backing's vmdk (e.g. by SDRS).
+
+        Every VM is read in one property collection; an instance refers to
+        its volumes by the volume-<volume uuid> extraConfig keys written on
+        attach.
+        :return: list of {'instance', 'instance_name', 'volume', 'volume_name',
+                 'volume_uuid', 'original_path', 'current_path', 'datastore',
+                 'adapter_type', 'disk_type'} plus the instance_ref,
+                 volume_ref, device and original_device objects
+        """
+        vms = utils.get_vm_properties(self._content, None, _DISPLACED_PATH_SET)
+        by_uuid = dict((vm.get('config.uuid'), vm) for vm in vms.values()
+                       if vm.get('config.uuid'))
+        displaced = []
+        for vm in vms.values():
+            for opt in vm.get('config.extraConfig') or []:
+                if not opt.key.startswith(VOLUME_DETAILS_PREFIX) or not opt.value:
+                    continue
+                volume_vm = by_uuid.get(opt.key[len(VOLUME_DETAILS_PREFIX):])
+                if volume_vm is None:
+                    continue
+                original_device = vm_util.get_vmdk_volume_disk(
+                    volume_vm.get('config.hardware.device') or [])
+                devices = vm.get('config.hardware.device') or []
+                device = vm_util.get_vmdk_backed_disk_device(devices, opt.value)
+                if original_device is None or device is None:
+                    continue
+                if original_device.backing.fileName == device.backing.fileName:
+                    continue
+                vmdk = vm_util.get_vmdk_info(vm['obj'], opt.value, devices=devices)
+                datastore = device.backing.datastore
+                displaced.append({
+                    'instance': vm['obj']._moId, 'instance_name': vm.get('name'),
+                    'volume': volume_vm['obj']._moId,
+                    'volume_name': volume_vm.get('name'),
+                    'volume_uuid': volume_vm['config.uuid'],
+                    'original_path': original_device.backing.fileName,
+                    'current_path': device.backing.fileName,
+                    'datastore': datastore._moId if datastore else None,
+                    'adapter_type': vmdk.adapter_type,
+                    'disk_type': vmdk.disk_type,
+                    'instance_ref': vm['obj'], 'volume_ref': volume_vm['obj'],
+                    'device': device, 'original_device': original_device})
+        LOG.debug("Found %(n)d displaced volumes on %(v)d VMs.",
+                  {'n': len(displaced), 'v': len(vms)})
+        return displaced
+
+    def consolidate_volumes(self, displaced=None,
+                            max_workers=DEFAULT_CONSOLIDATE_WORKERS,
+                            max_per_datastore=DEFAULT_CONSOLIDATE_PER_DATASTORE):
+        """Consolidate displaced volumes ahead of detach.
+
+        Volumes are consolidated in parallel, at most max_per_datastore
+        relocations into one datastore at a time.
+        :param displaced: find_displaced_volumes() result, found now if None
+        :return: the displaced entries, each with 'error': msg or None
+        """
+        if displaced is None:
+            displaced = self.find_displaced_volumes()
+        ds_slots = dict((d['datastore'], threading.Semaphore(max_per_datastore))
+                        for d in displaced)
+
+        def consolidate(entry):
+            with ds_slots[entry['datastore']]:
+                self._consolidate_vmdk_volume({'moid': entry['instance']},
+                                              entry['instance_ref'],
+                                              entry['device'],
+                                              entry['volume_ref'],
+                                              adapter_type=entry['adapter_type'],
+                                              disk_type=entry['disk_type'],
+                                              original_device=entry['original_device'])
+
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            submitted = dict((executor.submit(consolidate, d), d) for d in displaced)
+            for job in futures.as_completed(submitted):
+                entry = submitted[job]
+                try:
+                    job.result()
+                    entry['error'] = None
+                except Exception as ex:
+                    LOG.error(_LE("Consolidate volume %(volume)s failed: %(msg)s"),
+                              {'volume': entry['volume_name'], 'msg': ex})
+                    entry['error'] = str(ex)
+        return displaced
+
+    def run_volume_consolidation(self, stop_event, interval=600, **kwargs):
+        """Find and consolidate displaced volumes every interval seconds
+        until stop_event is set. kwargs go to consolidate_volumes.
+        """
+        while not stop_event.is_set():
+            try:
+                self.consolidate_volumes(**kwargs)
+            except Exception as ex:
+                LOG.exception(ex)
+            stop_event.wait(interval)
+
+    def _volume_details_config(self, volume_uuid, device_uuid):
+        # Store the uuid of the volume_device, an empty value removes it
+        volume_option = VOLUME_DETAILS_PREFIX + volume_uuid
         extra_opts = {volume_option: device_uuid}
+        return spec_util.get_vm_extra_config_spec(extra_opts).extraConfig
 
-        extra_config_specs = spec_util.get_vm_extra_config_spec(extra_opts)
+    def _update_volume_details(self, vm_ref, volume_uuid, device_uuid):
+        extra_config_specs = vim.vm.ConfigSpec()
+        extra_config_specs.extraConfig = self._volume_details_config(volume_uuid,
+                                                                     device_uuid)
         task_util.reconfigure_vm(vm_ref, extra_config_specs)
 
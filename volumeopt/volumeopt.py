@@ -7,11 +7,14 @@ Created Time: Thu 29 Mar 2018 03:25:37 PM CST
 File Name   : volumeopt.py
 Description : 
 '''
-from pyVmomi import vim
+from concurrent import futures
+
+from pyVmomi import vim, vmodl
 
 from oslo_log import log as logging
 from oslo_utils import units
-from i18n import _, _LE, _LW
+from i18n import _, _LE, _LI, _LW
+import exception
 import utils
 
 import spec_util
@@ -20,14 +23,19 @@ import task_util
 
 LOG = logging.getLogger(__name__)
 
+# CreateVM tasks in flight during create_volumes
+DEFAULT_CREATE_WORKERS = 16
+
 
 class VMwareVolumeOps(object):
     """Manages volume operations. """
 
-    def __init__(self, content, max_objects=100):
+    def __init__(self, content, max_objects=100, folder_index=None):
         self._content = content
         self._max_objects = max_objects
         self._folder_cache = {}
+        # optional shared folder index (sdk.tools.folder_index.FolderIndex)
+        self._folder_index = folder_index
 
     def _get_volume_group_folder(self, dc_ref, folders):
         """Get inventory folder for organizing volume backings.
@@ -46,6 +54,21 @@ class VMwareVolumeOps(object):
         folders = folders or []
         folder_names = ['Volumes'] + folders
 
+        if self._folder_index is not None:
+            return self._folder_index.get_or_create('/'.join(folder_names),
+                                                    parent=dc_ref.vmFolder)
+
+        cache_key = (dc_ref._moId, tuple(folder_names))
+        vmfolder = self._folder_cache.get(cache_key)
+        if vmfolder is not None:
+            try:
+                # one property read, the folder may have been deleted
+                vmfolder.name
+                return vmfolder
+            except vmodl.fault.ManagedObjectNotFound:
+                LOG.info(_LI("Cached folder %s is gone, looking it up again."),
+                         vmfolder._moId)
+                self._folder_cache.pop(cache_key, None)
         vmfolder = dc_ref.vmFolder
         f_ref = None
         for folder_name in folder_names:
@@ -54,35 +77,36 @@ class VMwareVolumeOps(object):
                 vmfolder = f_ref
             else:
                 vmfolder = task_util.create_inventory_folder(vmfolder, folder_name)
+        self._folder_cache[cache_key] = vmfolder
         return vmfolder
 
     def _get_storage_profile_id(self, volume):
         pass
 
     def _select_ds_for_volume(self, dc_moid, cluster_moid, ds_moid,
-                              host_moid=None, folders=None):
+                              host_moid=None, folders=None, dc_ref=None):
         """Select datastore that can accommodate the given volume's backing.
 
         Returns the selected datastore summary along with a compute host and
         its resource pool and folder where the volume can be created
+        :param dc_ref: already resolved datacenter of dc_moid
         :return: (host, resource_pool, folder, summary)
         """
-        dc_ref = utils.get_datacenter_moref(self._content, moid=dc_moid)
+        if dc_ref is None:
+            dc_ref = utils.get_datacenter_moref(self._content, moid=dc_moid)
         if not dc_ref:
             LOG.error(_LE("No valid datacenter is available."))
             raise exception.NoValidDatacenter()
 
-        resource_pool = None
-        host_ref = None
         cluster_ref = utils.get_child_ref_by_moid(dc_ref.hostFolder, cluster_moid)
         if not cluster_ref:
             LOG.warn(_LW("No valid cluster is available."))
-            host_ref = utils.get_child_ref_by_moid(dc_ref.hostFolder, host_moid)
-            if not host_ref:
+            # a standalone host, its ComputeResource has the pool and datastores
+            cluster_ref = self._get_host_compute_resource(dc_ref, host_moid)
+            if not cluster_ref:
                 LOG.error(_LE("No valid host is available."))
                 raise exception.NoValidHost()
-        else:
-            resource_pool = cluster_ref.resourcePool
+        resource_pool = cluster_ref.resourcePool
 
         host_ref = utils.get_ref_from_array_by_moid(cluster_ref.host, host_moid)
         if not host_ref:
@@ -97,6 +121,20 @@ class VMwareVolumeOps(object):
 
         return (resource_pool, host_ref, ds_ref, folder_ref)
 
+    def _get_host_compute_resource(self, dc_ref, host_moid):
+        """The compute resource of dc_ref's host folder that is host_moid or
+        holds the host host_moid, None if there is none.
+        """
+        if not host_moid:
+            return None
+        for c_ref in dc_ref.hostFolder.childEntity:
+            if c_ref._moId == host_moid:
+                return c_ref
+            if (isinstance(c_ref, vim.ComputeResource) and
+                    utils.get_ref_from_array_by_moid(c_ref.host, host_moid)):
+                return c_ref
+        return None
+
     def create_volume(self, volume, dc_moid, cluster_moid, ds_moid,
                       host_moid=None, folders=None):
         """Create volume backing under the given host.
@@ -119,6 +157,12 @@ class VMwareVolumeOps(object):
                                                          host_moid,
                                                          folders)
 
+        create_spec = self._create_volume_spec(volume, ds_ref.name)
+        volume_ref = task_util.create_vm_task(folder_ref, resource_pool,
+                                              host_ref, create_spec)
+        return volume_ref
+
+    def _create_volume_spec(self, volume, ds_name):
         # check if a storage profile needs to be associated with the backing VM
         profile_id = self._get_storage_profile_id(volume)
 
@@ -130,18 +174,76 @@ class VMwareVolumeOps(object):
         disk_type = volume.get('disk_type', 'thin')
         size_kb = volume['size'] * units.Mi
         adapter_type = volume.get('adapter_type', 'lsiLogic')
-        create_spec = spec_util.create_volume_config_spec(display_name,
-                                                          uuid,
-                                                          ds_ref.name,
-                                                          size_kb,
-                                                          disk_type,
-                                                          adapter_type,
-                                                          hw_version=hw_version,
-                                                          profile_id=profile_id,
-                                                          description=description)
-        volume_ref = task_util.create_vm_task(folder_ref, resource_pool,
-                                              host_ref, create_spec)
-        return volume_ref
+        return spec_util.create_volume_config_spec(display_name,
+                                                   uuid,
+                                                   ds_name,
+                                                   size_kb,
+                                                   disk_type,
+                                                   adapter_type,
+                                                   hw_version=hw_version,
+                                                   profile_id=profile_id,
+                                                   description=description)
+
+    def create_volumes(self, volumes, max_workers=DEFAULT_CREATE_WORKERS):
+        """Create many volume backings at once.
+
+        Datacenter, cluster, host, datastore and folder are resolved once per
+        distinct target, the CreateVM tasks run max_workers at a time.
+
+        :param volumes: list of volume dicts as for create_volume, each with
+                        its target: dc_moid, cluster_moid, ds_moid and the
+                        optional host_moid and folders
+        :return: list in volumes order of
+                 {'name': .., 'uuid': .., 'ref': vm ref or None, 'error': msg or None}
+        """
+        results = [{'name': v.get('name'), 'uuid': v.get('uuid'),
+                    'ref': None, 'error': None} for v in volumes]
+        dc_refs = {}
+        targets = {}
+        # target key -> error, a bad target is resolved once
+        failed_targets = {}
+        jobs = []
+        for (volume, result) in zip(volumes, results):
+            key = (volume.get('dc_moid'), volume.get('cluster_moid'),
+                   volume.get('ds_moid'), volume.get('host_moid'),
+                   tuple(volume.get('folders') or []))
+            if key in failed_targets:
+                result['error'] = failed_targets[key]
+                continue
+            try:
+                if key not in targets:
+                    dc_moid = key[0]
+                    if dc_moid not in dc_refs:
+                        dc_refs[dc_moid] = utils.get_datacenter_moref(self._content,
+                                                                      moid=dc_moid)
+                    (resource_pool, host_ref, ds_ref,
+                        folder_ref) = self._select_ds_for_volume(*key[:4],
+                                                                 folders=list(key[4]),
+                                                                 dc_ref=dc_refs[dc_moid])
+                    targets[key] = (resource_pool, host_ref, ds_ref.name, folder_ref)
+                (resource_pool, host_ref, ds_name, folder_ref) = targets[key]
+                create_spec = self._create_volume_spec(volume, ds_name)
+            except Exception as ex:
+                LOG.exception(ex)
+                result['error'] = str(ex)
+                if key not in targets:
+                    failed_targets[key] = result['error']
+                continue
+            jobs.append((result, (folder_ref, resource_pool, host_ref, create_spec)))
+
+        LOG.debug("Creating %(n)d volume backings on %(t)d targets.",
+                  {'n': len(jobs), 't': len(targets)})
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            submitted = dict((executor.submit(task_util.create_vm_task, *args,
+                                              raise_on_error=True), result)
+                             for (result, args) in jobs)
+            for job in futures.as_completed(submitted):
+                result = submitted[job]
+                try:
+                    result['ref'] = job.result()
+                except Exception as ex:
+                    result['error'] = str(ex)
+        return results
 
     def destroy_volume(self, volume):
         """Delete volume